@@ -0,0 +1,160 @@
+"""
+benchmark.py
+
+Times the analysis pipeline on synthetic data of increasing size and compares it against a stored baseline.
+
+    python analysis/benchmark.py --sizes 1000 10000 --predictors 20 --baseline outputs/benchmark_baseline.json
+
+Each size runs process_data on a synthetic survey and telemetry file, then the regression functions on synthetic
+analysis data with the given number of predictors. Wall time is the fastest of --repeat runs, and peak memory comes
+from a separate run traced with tracemalloc, since tracing slows the pipeline down. Stages nested in another stage,
+e.g. the parsing of the survey within process_data, are reported as 'parent/stage'.
+
+With --baseline, the run fails if a stage is slower or uses more memory than the baseline by more than --tolerance.
+--update-baseline writes the run as the new baseline instead.
+"""
+import argparse
+import json
+import pathlib
+import sys
+import tempfile
+
+import instrumentation
+from instrumentation import stage
+from process_data import process_data
+from regression import f_stat_regression, multiple_regression, residual_significance, rsquared_contribution
+from synthetic_data import analysis_frame, predictor_names, write_survey, write_telemetry
+from variables import dependent_vars, demographics_dummies
+
+stages = ['process_data', 'f_stat_regression', 'multiple_regression', 'rsquared_contribution', 'residual_significance',
+          'visualize_incremental_graph']
+
+
+def run_pipeline(files, df, predictors, selected, residual_predictors=6, residual_levels=3):
+    """Run the selected stages once on the synthetic files and analysis data."""
+    if 'process_data' in selected:
+        process_data(files['survey'], files['telemetry'], files['merged'], 'What is your GitHub username?-Open-Ended Response')
+    if 'f_stat_regression' in selected:
+        f_stat_regression(df, predictors, dependent_vars)
+    if 'multiple_regression' in selected or 'rsquared_contribution' in selected:
+        ols = multiple_regression('ols', df, predictors, [], dependent_vars, demographics_dummies, verbose=False)
+        if 'rsquared_contribution' in selected:
+            full_rsquared = ols[['dependent', 'ols_model_rsquared', 'ols_model_rsquared_adj']].drop_duplicates()
+            rsquared_contribution(full_rsquared, df, predictors, dependent_vars, demographics_dummies, verbose=False)
+    if 'residual_significance' in selected or 'visualize_incremental_graph' in selected:
+        residuals = residual_significance(df, predictors[:residual_predictors], [], 'aggregate_productivity', [], levels=residual_levels)
+        if 'visualize_incremental_graph' in selected:
+            residuals.to_csv(files['residuals'])
+            # pyvis is only needed for this stage.
+            from visualization import visualize_incremental_graph
+            with stage('visualize_incremental_graph'):
+                visualize_incremental_graph(files['residuals'], str(files['graph']), max_levels=residual_levels)
+
+
+def stage_totals(report, metric):
+    """Total of a metric, or the maximum for peak memory, over the stages of a profile report with the same name and parent."""
+    totals = {}
+    for entry in report['stages']:
+        key = entry['stage'] if entry['parent'] is None else f"{entry['parent']}/{entry['stage']}"
+        totals[key] = max(totals.get(key, 0), entry[metric]) if metric == 'peak_memory_mb' else totals.get(key, 0) + entry[metric]
+    return totals
+
+
+def benchmark(n_respondents, n_predictors, selected=stages, repeat=3, trace_memory=True, seed=0, work_dir=None):
+    """
+    Benchmark the selected stages on n_respondents synthetic respondents.
+
+    :return: Dict mapping each stage to its 'wall_seconds', 'peak_memory_mb' (None if not traced) and 'model_fits'.
+    """
+    if 'visualize_incremental_graph' in selected:
+        try:
+            import visualization  # noqa: F401
+        except ImportError:
+            print('Skipping visualize_incremental_graph, which needs pyvis.')
+            selected = [name for name in selected if name != 'visualize_incremental_graph']
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        tmp = pathlib.Path(tmp)
+        files = {name: tmp / file for name, file in [('survey', 'survey.tsv'), ('telemetry', 'telemetry.csv'), ('merged', 'merged.csv'),
+                                                     ('residuals', 'residual_significance.csv'), ('graph', 'incremental_graph.html')]}
+        print(f'Generating {n_respondents} respondents with {n_predictors} predictors.')
+        if 'process_data' in selected:
+            write_survey(files['survey'], n_respondents, seed)
+            write_telemetry(files['telemetry'], n_respondents, seed)
+        df = analysis_frame(n_respondents, n_predictors, seed)
+        predictors = predictor_names(n_predictors)
+
+        runs = []
+        for _ in range(repeat):
+            instrumentation.enable(trace_memory=False)
+            run_pipeline(files, df, predictors, selected)
+            report = instrumentation.disable().report()
+            runs.append(stage_totals(report, 'wall_seconds'))
+        fits = stage_totals(report, 'model_fits')
+        results = {key: {'wall_seconds': min(run[key] for run in runs), 'peak_memory_mb': None, 'model_fits': fits[key]} for key in runs[0]}
+        if trace_memory:
+            instrumentation.enable(trace_memory=True)
+            run_pipeline(files, df, predictors, selected)
+            for key, peak in stage_totals(instrumentation.disable().report(), 'peak_memory_mb').items():
+                results[key]['peak_memory_mb'] = peak
+    return results
+
+
+def regressions(results, baseline, tolerance=0.25, min_seconds=0.05, min_memory_mb=1):
+    """
+    Stages slower or using more memory than in the baseline by more than tolerance, as readable messages. Differences
+    below min_seconds or min_memory_mb are ignored as noise.
+    """
+    messages = []
+    for run, run_results in results.items():
+        for key, result in run_results.items():
+            base = baseline.get(run, {}).get(key)
+            if base is None:
+                continue
+            for metric, slack in [('wall_seconds', min_seconds), ('peak_memory_mb', min_memory_mb)]:
+                if result[metric] is None or base.get(metric) is None:
+                    continue
+                if result[metric] > base[metric] * (1 + tolerance) + slack:
+                    messages.append(f'{run} {key}: {metric} {result[metric]:.3f} against baseline {base[metric]:.3f}')
+    return messages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the analysis pipeline on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help='Numbers of respondents.')
+    parser.add_argument('--predictors', type=int, default=None, help='Number of predictors. Defaults to the independent variables.')
+    parser.add_argument('--stages', nargs='+', choices=stages, default=stages)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='Skip the run traced for peak memory.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default=None, help='Directory for the generated files. Defaults to the system temp directory.')
+    parser.add_argument('--output', default=None, help='Path of a JSON file to write the results to.')
+    parser.add_argument('--baseline', default=None, help='JSON baseline to compare against.')
+    parser.add_argument('--update-baseline', action='store_true', help='Write the results to --baseline instead of comparing.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown or memory growth.')
+    args = parser.parse_args()
+
+    n_predictors = len(predictor_names()) if args.predictors is None else args.predictors
+    results = {}
+    for size in args.sizes:
+        run = f'n={size},predictors={n_predictors}'
+        results[run] = benchmark(size, n_predictors, args.stages, args.repeat, not args.no_memory, args.seed, args.work_dir)
+        for key, result in results[run].items():
+            memory = '' if result['peak_memory_mb'] is None else f", {result['peak_memory_mb']:.1f} MB"
+            print(f"{run} {key}: {result['wall_seconds']:.3f} s{memory}, {result['model_fits']} fits")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Wrote baseline to {args.baseline}.')
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = regressions(results, baseline, args.tolerance)
+        for message in failures:
+            print(f'Regression: {message}')
+        if failures:
+            sys.exit(1)
+        print(f'No regressions against {args.baseline}.')
@@ -6,6 +6,8 @@ Compute the correlation between pairs of variables.
 import numpy as np
 import pathlib
 import pandas as pd
+from process_data import load_data
+from survey_schema import matching_columns
 from variables import independent_vars, dependent_vars, demographics_ordinal, demographics_dummies, telemetry_name_mapping
 
 
@@ -28,8 +30,8 @@ def compute_correlations(df, vars_x, vars_y, tril=False, drop_na=False):
 
 
 if __name__ == '__main__':
-    df = pd.read_csv(pathlib.Path(__file__).parent.parent.resolve() / 'data_telemetry/survey_telemetry_merged_cleaned.csv').rename(columns=telemetry_name_mapping)
-    all_dummies = [col for col in df.columns for var in demographics_dummies if var in col]
+    df = load_data(pathlib.Path(__file__).parent.parent.resolve() / 'data_telemetry/survey_telemetry_merged_cleaned.csv').rename(columns=telemetry_name_mapping)
+    all_dummies = matching_columns(df.columns, demographics_dummies)
     correlations = compute_correlations(df, independent_vars + demographics_ordinal + all_dummies, dependent_vars)
     correlations.to_csv('outputs/analysis/correlations.csv')
     print(correlations)
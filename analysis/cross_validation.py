@@ -0,0 +1,156 @@
+"""
+cross_validation.py
+
+Out-of-sample comparison of OLS, ridge, lasso and PCA regression with k-fold cross-validation.
+"""
+import numpy as np
+import pathlib
+import pandas as pd
+import warnings
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import lasso_path
+
+from instrumentation import count_fits, profiled
+from process_data import load_data
+from regression import process_features_targets
+from variables import independent_vars, dependent_vars, demographics_dummies, demographics_ordinal, telemetry_name_mapping
+import worker_pool
+
+
+def fold_indices(n, n_folds=5, seed=None):
+    """Shuffle rows and split them into n_folds test folds of near equal size."""
+    return np.array_split(np.random.default_rng(seed).permutation(n), n_folds)
+
+
+def gram_paths(gram, xy, ridge_alphas, n_components):
+    """
+    Coefficients of OLS, ridge regression and PCA regression on centered features from one eigendecomposition of
+    their Gram matrix. Returns a list of (model, parameter, coefficients shaped (features, outcomes)).
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    eigenvalues, eigenvectors = eigenvalues[::-1], eigenvectors[:, ::-1]  # Largest variance first.
+    projected = eigenvectors.T @ xy
+    kept = eigenvalues > 1e-10 * eigenvalues[0]
+    inverse = np.where(kept, 1 / np.where(kept, eigenvalues, 1), 0)
+
+    # OLS uses the pseudo-inverse like sm.OLS, ridge shrinks every eigen-direction, PCA regression keeps the leading ones.
+    paths = [('ols', 0, eigenvectors @ (inverse[:, None] * projected))]
+    paths += [('ridge', alpha, eigenvectors @ (projected / (eigenvalues + alpha)[:, None])) for alpha in ridge_alphas]
+    paths += [('pca', k, eigenvectors[:, :k] @ (inverse[:k, None] * projected[:k])) for k in n_components if k <= len(eigenvalues)]
+    return paths
+
+
+def fit_fold(train, test, features, outcomes, n_standardized, ridge_alphas, lasso_alphas, n_components, lasso_max_iter=1000):
+    """
+    Fit every model on the train rows and score it on the test rows. The first n_standardized features are scaled
+    with train statistics only. Returns lists of model, parameter, outcome index, mean squared error, R² and whether
+    the fit converged, which only lasso fits reaching lasso_max_iter coordinate descent iterations do not.
+    """
+    means = features[train].mean(axis=0)
+    scales = np.ones(features.shape[1])
+    stds = features[train, :n_standardized].std(axis=0)
+    scales[:n_standardized] = np.where(stds > 0, stds, 1)
+    x_train = (features[train] - means) / scales
+    x_test = (features[test] - means) / scales
+    outcome_means = outcomes[train].mean(axis=0)
+    y_train = outcomes[train] - outcome_means
+
+    gram = x_train.T @ x_train
+    xy = x_train.T @ y_train
+    paths = [(model, parameter, coefs, np.ones(y_train.shape[1], dtype=bool)) for model, parameter, coefs in gram_paths(gram, xy, ridge_alphas, n_components)]
+    if len(lasso_alphas):
+        # lasso_path fits one outcome at a time; all of them share the precomputed Gram matrix.
+        # Fits that reach lasso_max_iter are reported in the converged column rather than warned about.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', ConvergenceWarning)
+            lasso_fits = [lasso_path(x_train, y_train[:, i], alphas=lasso_alphas, precompute=gram, Xy=xy[:, i],
+                                     max_iter=lasso_max_iter, return_n_iter=True)
+                          for i in range(y_train.shape[1])]
+        lasso_coefs = np.stack([fit[1] for fit in lasso_fits], axis=1)
+        lasso_converged = np.stack([np.asarray(fit[3]) < lasso_max_iter for fit in lasso_fits])
+        # lasso_path returns the path from the largest penalty down.
+        paths += [('lasso', alpha, lasso_coefs[:, :, j], lasso_converged[:, j]) for j, alpha in enumerate(np.sort(lasso_alphas)[::-1])]
+
+    results = {'model': [], 'parameter': [], 'outcome': [], 'mse': [], 'rsquared': [], 'converged': []}
+    y_test = outcomes[test]
+    tss = ((y_test - y_test.mean(axis=0)) ** 2).sum(axis=0)
+    for model, parameter, coefs, converged in paths:
+        sse = ((y_test - outcome_means - x_test @ coefs) ** 2).sum(axis=0)
+        results['model'] += [model] * len(sse)
+        results['parameter'] += [parameter] * len(sse)
+        results['outcome'] += list(range(len(sse)))
+        results['converged'] += converged.tolist()
+        results['mse'] += (sse / len(test)).tolist()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results['rsquared'] += (1 - sse / tss).tolist()
+    return results
+
+
+def _fit_fold(train, test):
+    return fit_fold(train, test, **worker_pool.shared_state)
+
+
+@profiled('cross_validate')
+def cross_validate(df, independent_vars, dependent_vars, dummies, n_folds=5, ridge_alphas=None, lasso_alphas=None, n_components=None,
+                   standardize=True, seed=0, n_jobs=None, lasso_max_iter=1000):
+    """
+    K-fold cross-validated mean squared error and R² of OLS, ridge, lasso and PCA regression of every outcome on the
+    same features. Each fold factorizes its Gram matrix once, so whole ridge and PCA paths cost a matrix product each.
+
+    :param ridge_alphas: L2 penalties on the sum of squared errors. Defaults to 20 values from 0.01 to 10^4.
+    :param lasso_alphas: L1 penalties as in sklearn's Lasso, on the mean squared error. Defaults to 20 values from
+        10^-4 to 1. Pass an empty list to skip lasso.
+    :param n_components: Numbers of leading principal components of the fold's features to regress on. Defaults to all.
+    :param n_jobs: Number of processes to fit folds in. Folds are fit in this process if None.
+    :param lasso_max_iter: Coordinate descent iterations per lasso fit, as sklearn's max_iter. 'converged' is False
+        for settings whose lasso fit reached it in any fold.
+    """
+    ridge_alphas = np.logspace(-2, 4, 20) if ridge_alphas is None else np.asarray(ridge_alphas, dtype=float)
+    lasso_alphas = np.logspace(-4, 0, 20) if lasso_alphas is None else np.asarray(lasso_alphas, dtype=float)
+    # Features are standardized again within each fold, which is the same as standardizing the raw train rows.
+    features, outcomes, all_dummies = process_features_targets(df, independent_vars, dependent_vars, dummies, standardize)
+    n_components = range(1, features.shape[1] + 1) if n_components is None else n_components
+    state = {
+        'features': features,
+        'outcomes': outcomes,
+        'n_standardized': len(independent_vars) if standardize else 0,
+        'ridge_alphas': ridge_alphas,
+        'lasso_alphas': lasso_alphas,
+        'n_components': list(n_components),
+        'lasso_max_iter': lasso_max_iter}
+
+    print(f'Running {n_folds}-fold cross-validation on {features.shape[0]} samples.')
+    folds = fold_indices(features.shape[0], n_folds, seed)
+    splits = [(np.concatenate(folds[:i] + folds[i + 1:]), test) for i, test in enumerate(folds)]
+    if n_jobs is None:
+        with worker_pool.local_state(state):
+            fold_results = [_fit_fold(train, test) for train, test in splits]
+    else:
+        with worker_pool.executor(state, n_jobs) as executor:
+            fold_results = list(executor.map(_fit_fold, *zip(*splits)))
+
+    scores = pd.concat([pd.DataFrame(results) for results in fold_results])
+    count_fits(len(scores))
+    scores = scores.groupby(['model', 'parameter', 'outcome'], sort=False).agg(
+        cv_mse=('mse', 'mean'),
+        cv_rsquared=('rsquared', 'mean'),
+        cv_rsquared_std=('rsquared', 'std'),
+        converged=('converged', 'all')).reset_index()
+    scores.insert(2, 'dependent', np.asarray(dependent_vars)[scores.pop('outcome')])
+    if not scores['converged'].all():
+        print(f"{(~scores['converged']).sum()} lasso settings did not converge within {lasso_max_iter} iterations in every fold.")
+    return scores.round(4)
+
+
+def best_models(scores):
+    """Highest cross-validated R² per model family and outcome, among the settings that converged in every fold."""
+    scores = scores[scores['converged']]
+    best = scores.loc[scores.groupby(['model', 'dependent'], sort=False)['cv_rsquared'].idxmax()]
+    return best.sort_values(by=['dependent', 'cv_rsquared'], ascending=[True, False])
+
+
+if __name__ == '__main__':
+    df = load_data(pathlib.Path(__file__).parent.parent.resolve() / 'data_telemetry/survey_telemetry_merged_cleaned.csv').rename(columns=telemetry_name_mapping)
+    cv_scores = cross_validate(df, independent_vars + demographics_ordinal, dependent_vars, demographics_dummies)
+    cv_scores.to_csv('outputs/analysis/cross_validation.csv', index=False)
+    print(best_models(cv_scores))
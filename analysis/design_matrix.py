@@ -0,0 +1,123 @@
+"""
+design_matrix.py
+
+A reusable numeric design matrix for the regression functions, built once from a DataFrame.
+"""
+import numpy as np
+import pandas as pd
+
+from survey_schema import matching_columns
+
+
+class DesignMatrix:
+    """
+    Numeric columns of a DataFrame copied once into a preallocated column-major array, with missing-value masks.
+
+    Column statistics, complete-case row masks and the feature/outcome matrices of process_features_targets are
+    cached, so repeated calls over the same columns do not copy or rescale the data again. Single columns are returned
+    as zero-copy views. Cached arrays are read-only; copy them before modifying in place.
+
+    :param df: DataFrame to copy.
+    :param columns: Columns to include. Defaults to all numeric and boolean columns.
+    :param dtype: np.float64 or np.float32.
+    """
+
+    def __init__(self, df, columns=None, dtype=np.float64):
+        if columns is None:
+            columns = df.select_dtypes(include=['number', 'bool']).columns
+        self.columns = list(columns)
+        self.positions = {column: i for i, column in enumerate(self.columns)}
+        self.values = np.empty((len(df), len(self.columns)), dtype=dtype, order='F')
+        for i, column in enumerate(self.columns):
+            self.values[:, i] = df[column].to_numpy(dtype=dtype, na_value=np.nan)
+        self.present = ~np.isnan(self.values)
+        self.values.flags.writeable = False
+        self.present.flags.writeable = False
+        self._means = np.nanmean(self.values, axis=0) if len(self) else np.full(len(self.columns), np.nan)
+        self._stds = np.nanstd(self.values, axis=0) if len(self) else np.full(len(self.columns), np.nan)
+        self._complete_rows = {}
+        self._features_targets = {}
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def _indices(self, columns):
+        missing = [column for column in columns if column not in self.positions]
+        if missing:
+            raise KeyError(f'Columns not in design matrix: {missing}')
+        return [self.positions[column] for column in columns]
+
+    def column(self, column):
+        """Zero-copy view of a single column."""
+        return self.values[:, self.positions[column]]
+
+    def block(self, columns, rows=None):
+        """Array of the given columns, optionally only the given rows (boolean mask or indices)."""
+        block = self.values[:, self._indices(columns)]
+        return block if rows is None else block[rows]
+
+    def mask(self, columns):
+        """Missing-value mask of the given columns, True where a value is present."""
+        return self.present[:, self._indices(columns)]
+
+    def complete_rows(self, columns):
+        """Boolean mask of rows where none of the given columns are missing."""
+        key = tuple(columns)
+        if key not in self._complete_rows:
+            self._complete_rows[key] = self.mask(columns).all(axis=1)
+        return self._complete_rows[key]
+
+    def means(self, columns):
+        """Means of the given columns over their present values."""
+        return self._means[self._indices(columns)]
+
+    def stds(self, columns):
+        """Population standard deviations of the given columns over their present values."""
+        return self._stds[self._indices(columns)]
+
+    def get_dummies(self, covariates):
+        """Dummy column names for the specified variables, dropping zero-variance values, as in regression.get_dummies."""
+        columns = matching_columns(self.columns, covariates)
+        return [column for column, std in zip(columns, self.stds(columns)) if std > 0]
+
+    def features_targets(self, independent_vars, dependent_vars, dummies, standardize=True, drop_na=True):
+        """
+        Feature and outcome matrices as built by regression.process_features_targets, cached per combination of
+        columns and options. Standardizing uses the means and standard deviations of the kept rows.
+        """
+        key = (tuple(independent_vars), tuple(dependent_vars), tuple(dummies), standardize, drop_na)
+        if key not in self._features_targets:
+            all_dummies = self.get_dummies(dummies)
+            rows = self.complete_rows(independent_vars + dependent_vars + all_dummies) if drop_na else slice(None)
+            n_rows = len(self) if not drop_na else int(rows.sum())
+
+            features = np.empty((n_rows, len(independent_vars) + len(all_dummies)), dtype=self.values.dtype, order='F')
+            features[:, :len(independent_vars)] = self.block(independent_vars, rows)
+            features[:, len(independent_vars):] = self.block(all_dummies, rows)
+            if standardize:
+                scaled = features[:, :len(independent_vars)]
+                if drop_na:
+                    means, stds = scaled.mean(axis=0), scaled.std(axis=0)
+                else:
+                    means, stds = self.means(independent_vars), self.stds(independent_vars)
+                scaled -= means
+                scaled /= np.where(stds > 0, stds, 1)
+            outcomes = np.asfortranarray(self.block(dependent_vars, rows))
+
+            features.flags.writeable = False
+            outcomes.flags.writeable = False
+            self._features_targets[key] = (features, outcomes, all_dummies)
+        features, outcomes, all_dummies = self._features_targets[key]
+        return features, outcomes, list(all_dummies)
+
+    def to_frame(self, columns=None):
+        """DataFrame of the given columns, for code paths that need pandas."""
+        columns = self.columns if columns is None else list(columns)
+        return pd.DataFrame(self.block(columns), columns=columns)
+
+
+def column_values(data, columns):
+    """Float array of the given columns of a DataFrame or DesignMatrix."""
+    if isinstance(data, DesignMatrix):
+        return data.block(columns)
+    return data[columns].to_numpy(dtype=float)
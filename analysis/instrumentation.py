@@ -0,0 +1,206 @@
+"""
+instrumentation.py
+
+Optional profiling of the analysis pipeline. Each stage records wall time, CPU time, peak traced memory, the rows and
+columns of its output and the number of models it fit, and the run is written out as a JSON report.
+
+Profiling is off by default and then costs a single check per stage. Turn it on with enable(), or by setting the
+ANALYSIS_PROFILE environment variable to the path of the report to write when the process exits ('1' prints the
+report instead).
+"""
+import atexit
+import contextlib
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+_profiler = None
+
+
+class _NullStage:
+    """Stand-in for a stage while profiling is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def record(self, data):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+class Stage:
+    """A timed section of the pipeline. Use through stage() or profiled()."""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.parent = None
+        self.rows = None
+        self.columns = None
+        self.fits = 0
+        self.peak = 0
+
+    def __enter__(self):
+        stack = self.profiler.stack
+        self.parent = stack[-1] if stack else None
+        if self.profiler.trace_memory:
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        self.profiler.stack.pop()
+        if self.profiler.trace_memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, self.peak)
+        self.profiler.stages.append({
+            'stage': self.name,
+            'parent': self.parent.name if self.parent is not None else None,
+            'wall_seconds': round(wall, 6),
+            'cpu_seconds': round(cpu, 6),
+            'peak_memory_mb': round(self.peak / 2 ** 20, 3) if self.profiler.trace_memory else None,
+            'rows': self.rows,
+            'columns': self.columns,
+            'model_fits': self.fits,
+            'failed': exc[0] is not None,
+        })
+        return False
+
+    def record(self, data):
+        """Record the rows and columns of a DataFrame or array, or of the first element of a tuple of them."""
+        if isinstance(data, tuple) and data:
+            data = data[0]
+        shape = getattr(data, 'shape', None)
+        if shape is not None and len(shape):
+            self.rows = int(shape[0])
+            self.columns = int(shape[1]) if len(shape) > 1 else 1
+
+
+class Profiler:
+    """Collects finished stages in the order they end."""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.stack = []
+        self.started = time.time()
+
+    def report(self):
+        """Run report as a JSON-serializable dict."""
+        return {
+            'started': self.started,
+            'argv': sys.argv,
+            'pid': os.getpid(),
+            'trace_memory': self.trace_memory,
+            'stages': list(self.stages),
+        }
+
+    def write(self, path=None):
+        """Write the report as JSON to path, or print it if path is None."""
+        report = json.dumps(self.report(), indent=2)
+        if path is None:
+            print(report)
+        else:
+            with open(path, 'w') as f:
+                f.write(report)
+
+
+def enable(trace_memory=True):
+    """Start profiling, discarding any earlier stages. Returns the Profiler."""
+    global _profiler
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _profiler = Profiler(trace_memory)
+    return _profiler
+
+
+def disable():
+    """Stop profiling. Returns the Profiler with the stages recorded so far, or None if profiling was off."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None and profiler.trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return profiler
+
+
+def enabled():
+    return _profiler is not None
+
+
+@contextlib.contextmanager
+def profiling(path, trace_memory=True):
+    """
+    Context manager profiling its body and writing the report to path when the body ends, also when it raises, so
+    profiling never stays on after a failed run. Does nothing if path is None.
+    """
+    if path is None:
+        yield None
+        return
+    profiler = enable(trace_memory)
+    try:
+        yield profiler
+    finally:
+        disable()
+        profiler.write(path)
+
+
+def stage(name):
+    """
+    Context manager timing a stage. Call record(data) on it to note the rows and columns of its output.
+    Does nothing while profiling is off.
+    """
+    if _profiler is None:
+        return _null_stage
+    return Stage(_profiler, name)
+
+
+def count_fits(n=1):
+    """Add n model fits to the innermost running stage."""
+    if _profiler is not None and _profiler.stack:
+        _profiler.stack[-1].fits += n
+
+
+def profiled(name, detail=None):
+    """
+    Decorator running a function as a stage, recording the shape of what it returns.
+
+    :param detail: Optional function of the call's arguments whose result is appended to the stage name, e.g. the model type.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            stage_name = name if detail is None else f'{name}[{detail(*args, **kwargs)}]'
+            with Stage(_profiler, stage_name) as current:
+                result = fn(*args, **kwargs)
+                current.record(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def _enable_from_environment():
+    setting = os.environ.get('ANALYSIS_PROFILE')
+    if not setting:
+        return
+    profiler = enable()
+    atexit.register(profiler.write, None if setting == '1' else setting)
+
+
+_enable_from_environment()
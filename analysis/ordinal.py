@@ -0,0 +1,217 @@
+"""
+ordinal.py
+
+Cumulative link (proportional odds) models for Likert outcomes, fit by Newton's method with an analytic gradient and
+Hessian for many outcomes at once.
+
+As in statsmodels' OrderedModel, P(y <= j | x) = F(threshold_j - x'beta), the design has no constant column, and
+the thresholds play the role of the intercept.
+"""
+import numpy as np
+from scipy import stats
+from scipy.special import expit
+
+distributions = {
+    # Distribution function, density and derivative of the density.
+    'probit': (stats.norm.cdf, stats.norm.pdf, lambda u, f: -u * f),
+    'logit': (expit, lambda u: expit(u) * expit(-u), lambda u, f: f * (1 - 2 * expit(u))),
+}
+
+
+def _link_terms(features, codes, params, n_thresholds, distr):
+    """
+    Per-observation terms of the likelihood and its derivatives: the probability of the observed category, and the
+    density and its derivative at the category's upper and lower cut points. All terms are shaped (observations, outcomes).
+    """
+    cdf, pdf, pdf_derivative = distributions[distr]
+    betas, thresholds = params[:, :-n_thresholds], params[:, -n_thresholds:]
+    eta = features @ betas.T
+    # Cut points -inf and +inf around the thresholds, indexed per observed category.
+    cuts = np.concatenate([np.full((len(params), 1), -np.inf), thresholds, np.full((len(params), 1), np.inf)], axis=1)
+    outcome_index = np.arange(len(params))
+    upper = cuts[outcome_index, codes + 1] - eta
+    lower = cuts[outcome_index, codes] - eta
+    with np.errstate(invalid='ignore'):
+        prob = np.clip(cdf(upper) - cdf(lower), 1e-300, None)
+        f_upper, f_lower = pdf(upper), pdf(lower)
+        df_upper = np.nan_to_num(pdf_derivative(upper, f_upper))
+        df_lower = np.nan_to_num(pdf_derivative(lower, f_lower))
+    return prob, f_upper, f_lower, df_upper, df_lower
+
+
+def _loglike(features, codes, weights, params, n_thresholds, distr):
+    prob = _link_terms(features, codes, params, n_thresholds, distr)[0]
+    return weights @ np.log(prob)
+
+
+def _gradient_hessian(features, codes, weights, params, n_thresholds, distr):
+    """
+    Analytic gradient and Hessian of the log-likelihood for every outcome, shaped (outcomes, parameters) and
+    (outcomes, parameters, parameters), with parameters ordered as (betas, thresholds).
+
+    For an observation in category k with d = F(u) - F(l), u = threshold_k - x'beta and l = threshold_{k-1} - x'beta:
+    dl/dthreshold_k = f(u)/d, dl/dthreshold_{k-1} = -f(l)/d and dl/dbeta = -x (f(u) - f(l))/d,
+    and the Hessian follows from differentiating these once more.
+    """
+    prob, a, b, da, db = _link_terms(features, codes, params, n_thresholds, distr)
+    n, n_features = features.shape
+    n_outcomes = len(params)
+    w = weights[:, None]
+
+    # Per observation derivatives with respect to the upper and lower cut points and the linear predictor.
+    g_upper = w * a / prob
+    g_lower = -w * b / prob
+    h_upper = w * (da / prob - (a / prob) ** 2)
+    h_lower = w * (-db / prob - (b / prob) ** 2)
+    h_cross = w * a * b / prob ** 2
+    h_eta = w * ((da - db) / prob - ((a - b) / prob) ** 2)
+    h_eta_upper = w * (-da / prob + a * (a - b) / prob ** 2)
+    h_eta_lower = w * (db / prob - b * (a - b) / prob ** 2)
+
+    n_params = n_features + n_thresholds
+    gradient = np.zeros((n_outcomes, n_params))
+    hessian = np.zeros((n_outcomes, n_params, n_params))
+    gradient[:, :n_features] = -(features.T @ (g_upper + g_lower)).T
+    hessian[:, :n_features, :n_features] = np.einsum('ni,nm,nj->mij', features, h_eta, features)
+
+    # Thresholds: category k has upper cut point k and lower cut point k - 1. The outermost cut points are infinite
+    # and their terms vanish.
+    for m in range(n_outcomes):
+        upper_index = codes[:, m]
+        lower_index = codes[:, m] - 1
+        has_upper = upper_index < n_thresholds
+        has_lower = lower_index >= 0
+        theta_gradient = (np.bincount(upper_index[has_upper], g_upper[has_upper, m], n_thresholds)
+                          + np.bincount(lower_index[has_lower], g_lower[has_lower, m], n_thresholds))
+        theta_hessian = np.diag(np.bincount(upper_index[has_upper], h_upper[has_upper, m], n_thresholds)
+                                + np.bincount(lower_index[has_lower], h_lower[has_lower, m], n_thresholds))
+        both = has_upper & has_lower
+        cross = np.bincount(lower_index[both], h_cross[both, m], n_thresholds)[:n_thresholds - 1]
+        theta_hessian += np.diag(cross, 1) + np.diag(cross, -1)
+
+        # Cross derivatives between betas and thresholds, from indicator matrices of each observation's cut points.
+        indicators = np.zeros((n, n_thresholds))
+        indicators[np.flatnonzero(has_upper), upper_index[has_upper]] += h_eta_upper[has_upper, m]
+        indicators[np.flatnonzero(has_lower), lower_index[has_lower]] += h_eta_lower[has_lower, m]
+        gradient[m, n_features:] = theta_gradient
+        hessian[m, n_features:, n_features:] = theta_hessian
+        hessian[m, :n_features, n_features:] = features.T @ indicators
+        hessian[m, n_features:, :n_features] = hessian[m, :n_features, n_features:].T
+    return gradient, hessian
+
+
+def start_thresholds(codes, n_thresholds, weights, distr):
+    """Thresholds reproducing the observed cumulative category shares when all betas are zero."""
+    ppf = stats.norm.ppf if distr == 'probit' else stats.logistic.ppf
+    shares = np.stack([np.bincount(codes[:, m], weights, n_thresholds + 1) for m in range(codes.shape[1])])
+    cumulative = np.cumsum(shares, axis=1)[:, :-1] / shares.sum(axis=1, keepdims=True)
+    return ppf(np.clip(cumulative, 1e-6, 1 - 1e-6))
+
+
+def category_groups(outcomes):
+    """Column indices of outcomes grouped by their number of observed categories, so that each group can be fit together."""
+    n_levels = np.array([len(np.unique(outcomes[:, m])) for m in range(outcomes.shape[1])])
+    return [np.flatnonzero(n_levels == k) for k in np.unique(n_levels)]
+
+
+def _unfitted(n_features, n_outcomes):
+    """Result of fit_ordinal for outcomes with fewer than two categories: missing statistics and no thresholds."""
+    missing = np.full((n_features, n_outcomes), np.nan)
+    return {
+        'params': missing,
+        'bse': missing.copy(),
+        'pvalues': missing.copy(),
+        'thresholds': np.empty((0, n_outcomes)),
+        'llf': np.full(n_outcomes, np.nan),
+        'converged': np.zeros(n_outcomes, dtype=bool),
+        'n_iter': np.zeros(n_outcomes, dtype=int),
+        'params_full': missing.T.copy(),
+    }
+
+
+def fit_ordinal(features, outcomes, distr='probit', weights=None, start_params=None, max_iter=100, tol=1e-8):
+    """
+    Fit a cumulative link model of every column of outcomes on the same features by Newton's method, with step
+    halving to keep thresholds ordered and the log-likelihood increasing. Outcomes are fit together, and each outcome
+    stops updating once it converges.
+
+    :param features: Design matrix without a constant column.
+    :param outcomes: Ordinal outcomes, one per column. Their sorted unique values are the categories.
+    :param distr: 'probit' (OrderedModel's default) or 'logit' for proportional odds.
+    :param weights: Optional frequency weights per observation.
+    :param start_params: Optional warm start shaped (outcomes, features + thresholds), e.g. the 'params_full' of an
+        earlier fit with a zero added for each new feature.
+    :param tol: Convergence tolerance on the largest absolute gradient entry, relative to the number of observations.
+    :return: Dict with 'params', 'bse' and 'pvalues' (z-test) of the betas shaped (features, outcomes), 'thresholds',
+        'llf', 'converged' and 'n_iter' per outcome, and 'params_full' for warm starts. Outcomes with fewer than two
+        observed categories are not fit, and get missing statistics with converged False.
+    """
+    if distr not in distributions:
+        raise ValueError('Distribution must be either "probit" or "logit".')
+    n, n_features = features.shape
+    weights = np.ones(n) if weights is None else np.asarray(weights, dtype=float)
+    levels = [np.unique(outcomes[:, m]) for m in range(outcomes.shape[1])]
+    if len({len(level) for level in levels}) > 1:
+        raise ValueError('All outcomes must have the same number of observed categories, see category_groups.')
+    codes = np.stack([np.searchsorted(level, outcomes[:, m]) for m, level in enumerate(levels)], axis=1)
+    n_thresholds = len(levels[0]) - 1
+    n_outcomes = codes.shape[1]
+    if n_thresholds < 1:
+        # With a single observed category, e.g. in a small segment or window, there is no ordering to fit.
+        return _unfitted(n_features, n_outcomes)
+
+    if start_params is None:
+        params = np.concatenate([np.zeros((n_outcomes, n_features)), start_thresholds(codes, n_thresholds, weights, distr)], axis=1)
+    else:
+        params = np.array(start_params, dtype=float)
+    llf = _loglike(features, codes, weights, params, n_thresholds, distr)
+    done = np.zeros(n_outcomes, dtype=bool)
+    n_iter = np.zeros(n_outcomes, dtype=int)
+    for _ in range(max_iter):
+        active = np.flatnonzero(~done)
+        if not len(active):
+            break
+        gradient, hessian = _gradient_hessian(features, codes[:, active], weights, params[active], n_thresholds, distr)
+        small = np.abs(gradient).max(axis=1) < tol * weights.sum()
+        done[active[small]] = True
+        active, gradient, hessian = active[~small], gradient[~small], hessian[~small]
+        if not len(active):
+            break
+        try:
+            steps = -np.linalg.solve(hessian, gradient[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            steps = -(np.linalg.pinv(hessian) @ gradient[..., None])[..., 0]
+
+        # Halve steps that leave thresholds unordered or lower the log-likelihood.
+        step_size = np.ones(len(active))
+        for _ in range(30):
+            candidate = params[active] + step_size[:, None] * steps
+            ordered = (np.diff(candidate[:, n_features:], axis=1) > 0).all(axis=1)
+            candidate_llf = _loglike(features, codes[:, active], weights, np.where(ordered[:, None], candidate, params[active]), n_thresholds, distr)
+            improved = ordered & (candidate_llf >= llf[active] - 1e-10 * np.abs(llf[active]))
+            if improved.all():
+                break
+            step_size = np.where(improved, step_size, step_size / 2)
+        params[active[improved]] = candidate[improved]
+        llf[active[improved]] = candidate_llf[improved]
+        n_iter[active] += 1
+        # Outcomes whose steps no longer improve the likelihood stop here, converged or not.
+        done[active[~improved]] = True
+
+    gradient, hessian = _gradient_hessian(features, codes, weights, params, n_thresholds, distr)
+    converged = np.abs(gradient).max(axis=1) < tol * weights.sum()
+    with np.errstate(invalid='ignore'):
+        cov = np.linalg.pinv(-hessian)
+        bse = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        z = params / bse
+    pvalues = 2 * stats.norm.sf(np.abs(z))
+    return {
+        'params': params[:, :n_features].T,
+        'bse': bse[:, :n_features].T,
+        'pvalues': pvalues[:, :n_features].T,
+        'thresholds': params[:, n_features:].T,
+        'llf': llf,
+        'converged': converged,
+        'n_iter': n_iter,
+        'params_full': params,
+    }
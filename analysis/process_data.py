@@ -4,22 +4,34 @@ process_data.py
 Cleans and processes input data for analysis.
 Optionally generate visualizations for descriptive stats. 
 """
+import hashlib
 import numpy as np
 import pandas as pd
 import pathlib
+import pickle
 from sklearn.decomposition import PCA
 from sklearn.impute import SimpleImputer
 from sklearn.preprocessing import StandardScaler
 
-from variables import independent_vars, dependent_vars, dependent_mapping, demographics_dummies, demographics_ordinal_mapping, telemetry_name_mapping
+from instrumentation import profiled, stage
+from sufficient_stats import accumulate
+from survey_schema import compile_header, matching_columns, schema_for_columns
+from variables import independent_vars, dependent_vars, dependent_mapping, demographics_dummies, demographics_ordinal_mapping, derived_metrics, telemetry_name_mapping
 
+likert_values = ['Strongly Agree', 'Agree', 'Neither Agree or Disagree', 'Disagree', 'Strongly Disagree']
 
+
+@profiled('process_data')
 def process_data(survey_input,
                  telemetry_input,
                  output_file,
                  deduplication_column,
                  impute=True,
-                 pca=True):
+                 pca=True,
+                 telemetry_chunksize=None,
+                 state_dir=None,
+                 refit=False,
+                 metrics=None):
     """
     Process input data, merging survey and telemtry files.
 
@@ -27,71 +39,188 @@ def process_data(survey_input,
     :param telemetry_input: Path to telemetry file.
     :param output_file: Path to file to write cleaned data to.
     :param impute: If True, impute missing values for independent and dependent vars.
+    :param telemetry_chunksize: If set, stream the telemetry file in chunks of this many rows,
+        keeping only rows of survey respondents, so memory is bounded by the merged data rather than the telemetry file.
+    :param state_dir: If set, process the survey incrementally, persisting processed respondents and fitted transforms
+        in this directory, see process_survey_incremental.
+    :param refit: If True, refit imputation and PCA on all respondents when processing incrementally.
+    :param metrics: Telemetry metrics to compute and keep, see normalize_vars. Defaults to computing all derived
+        metrics and keeping variables.independent_vars.
     """
-    survey_df = process_survey(survey_input, deduplication_column, impute=impute, pca=pca)
-    telemetry_df = process_telemetry(telemetry_input)
+    if state_dir is None:
+        survey_df = process_survey(survey_input, deduplication_column, impute=impute, pca=pca)
+    else:
+        survey_df = process_survey_incremental(survey_input, deduplication_column, state_dir, impute=impute, pca=pca, refit=refit)
+    if telemetry_chunksize is None:
+        telemetry_df = process_telemetry(telemetry_input, metrics=metrics)
+    else:
+        telemetry_df = process_telemetry(telemetry_input, telemetry_chunksize, tracking_ids=survey_df['copilot_trackingId'], metrics=metrics)
 
     # Merge survey and telemetry data
-    merged_df = pd.merge(survey_df, telemetry_df, on='copilot_trackingId')
+    with stage('merge') as current:
+        merged_df = pd.merge(survey_df, telemetry_df, on='copilot_trackingId')
+        current.record(merged_df)
 
     # Keep only variables used in analysis, i.e. those specified in variables.py
-    all_dummies = [col for col in merged_df.columns for var in demographics_dummies if var in col]
-    all_cols_keep = ['copilot_trackingId'] + independent_vars + dependent_vars + [f'{v}_bool' for v in dependent_vars if 'aggregate' not in v] + all_dummies + list(demographics_ordinal_mapping.keys())
+    all_dummies = matching_columns(merged_df.columns, demographics_dummies)
+    kept_metrics = independent_vars if metrics is None else list(metrics)
+    all_cols_keep = ['copilot_trackingId', 'Start Date'] + kept_metrics + dependent_vars + [f'{v}_bool' for v in dependent_vars if 'aggregate' not in v] + all_dummies + list(demographics_ordinal_mapping.keys())
     if pca:
         all_cols_keep += ['pca_survey_first_component']
     if impute:
         all_cols_keep += [f'{v}_imp_neutral' for v in dependent_vars if 'aggregate' not in v]
         all_cols_keep += [f'{v}_imp_median' for v in dependent_vars if 'aggregate' not in v]
 
-    merged_df[all_cols_keep].dropna(how='all').to_csv(output_file, index=False)
+    cleaned_df = merged_df[all_cols_keep].dropna(how='all')
+    with stage('csv_write') as current:
+        cleaned_df.to_csv(output_file, index=False)
+        current.record(cleaned_df)
+    # The cache is built from the written CSV rather than cleaned_df, so every load returns the same data.
+    cache_data(output_file)
 
     return merged_df
 
 
+def process_data_stats(survey_input,
+                       telemetry_input,
+                       deduplication_column,
+                       telemetry_chunksize,
+                       columns=None,
+                       complete_columns=None,
+                       shift=None,
+                       impute=True,
+                       pca=True,
+                       metrics=None):
+    """
+    Accumulate sufficient statistics of the merged survey and telemetry data, streaming the telemetry in chunks
+    without materializing the merged data. See sufficient_stats.SufficientStats.
+
+    :param telemetry_chunksize: Number of telemetry rows per chunk.
+    :param columns: Columns to accumulate. Defaults to the independent and dependent vars, demographic dummies and
+        ordinal demographics.
+    :param complete_columns: Columns for the complete-case statistics used by OLS. Defaults to all columns.
+    :param shift: Optional per-column values subtracted before accumulating, see SufficientStats.
+    :param metrics: Telemetry metrics to compute, see normalize_vars. Defaults to all derived metrics. If set, the
+        default columns include these metrics instead of the independent vars.
+    """
+    survey_df = process_survey(survey_input, deduplication_column, impute=impute, pca=pca)
+    if columns is None:
+        all_dummies = matching_columns(survey_df.columns, demographics_dummies)
+        columns = (independent_vars if metrics is None else list(metrics)) + dependent_vars + all_dummies + list(demographics_ordinal_mapping.keys())
+    chunks = (
+        pd.merge(survey_df, chunk, on='copilot_trackingId')
+        for chunk in iter_telemetry(telemetry_input, telemetry_chunksize, tracking_ids=survey_df['copilot_trackingId'], metrics=metrics))
+    return accumulate(chunks, columns, complete_columns, shift)
+
+
+def data_cache_key(data_file, contents=False):
+    """
+    Key of a data file, of the variable definitions in variables.py and of this module, whose load_data and
+    downcast_dtypes decide what the cache holds. The data file is identified by its size and modification time, or
+    with contents=True by a hash of its contents, which reads the whole file but still matches after the file is
+    copied or touched. The inputs of process_data are not part of the key: rerunning it rewrites the data file, which
+    changes the key.
+    """
+    digest = hashlib.sha256()
+    if contents:
+        with open(data_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    else:
+        stat = pathlib.Path(data_file).stat()
+        digest.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    for source in [pathlib.Path(__file__).parent / 'variables.py', pathlib.Path(__file__)]:
+        digest.update(source.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def data_cache_file(data_file, key):
+    """Path of the columnar cache of a data file for the given cache key."""
+    data_file = pathlib.Path(data_file)
+    return data_file.with_name(f'{data_file.stem}.{key}.feather')
+
+
+def downcast_dtypes(df):
+    """Downcast integer columns to the smallest integer type that holds them. Floats keep their precision."""
+    integer_columns = df.select_dtypes(include='integer').columns
+    return df.assign(**{col: pd.to_numeric(df[col], downcast='integer') for col in integer_columns})
+
+
+def cache_data(data_file):
+    """
+    Parse data_file and write it, with integer columns downcast, as an uncompressed Feather file next to it, keyed by
+    data_cache_key and replacing any cache left from earlier versions. The hash of the contents of data_file is kept
+    in the file's metadata for load_data to fall back on. Returns the data read back from the cache, so the first load
+    is identical to later ones, or None without pyarrow installed.
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import feather
+    except ImportError:
+        return None
+    df = downcast_dtypes(pd.read_csv(data_file))
+    data_file = pathlib.Path(data_file)
+    for stale_file in data_file.parent.glob(f'{data_file.stem}.*.feather'):
+        stale_file.unlink()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'contents_key': data_cache_key(data_file, contents=True).encode()})
+    cache_file = data_cache_file(data_file, data_cache_key(data_file))
+    feather.write_feather(table, cache_file, compression='uncompressed')
+    return feather.read_table(cache_file, memory_map=True).to_pandas()
+
+
+def find_data_cache(data_file):
+    """
+    Path of the columnar cache of a data file, or None without an up-to-date cache. A cache of a file whose size or
+    modification time changed is still used if the file's contents did not, and is renamed to the new key.
+    """
+    import pyarrow as pa
+    cache_file = data_cache_file(data_file, data_cache_key(data_file))
+    if cache_file.exists():
+        return cache_file
+    data_file = pathlib.Path(data_file)
+    contents_key = None
+    for stale_file in data_file.parent.glob(f'{data_file.stem}.*.feather'):
+        with pa.memory_map(str(stale_file)) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+        if contents_key is None:
+            contents_key = data_cache_key(data_file, contents=True).encode()
+        if metadata.get(b'contents_key') == contents_key:
+            return stale_file.replace(cache_file)
+    return None
+
+
+def load_data(data_file):
+    """
+    Load a processed data file through its columnar cache, memory-mapping the cache when it is up to date
+    and parsing the CSV (then refreshing the cache) when the file, variables.py or this module changed.
+    Integer columns are downcast as in the cache, so both paths return the same dtypes.
+    Without pyarrow installed this parses the CSV every time.
+    """
+    try:
+        from pyarrow import feather
+    except ImportError:
+        return downcast_dtypes(pd.read_csv(data_file))
+    cache_file = find_data_cache(data_file)
+    if cache_file is not None:
+        return feather.read_table(cache_file, memory_map=True).to_pandas()
+    return cache_data(data_file)
+
+
+@profiled('process_survey')
 def process_survey(input_file, deduplication_column, impute=True, pca=True):
     """
     Process survey data.
 
     :param input_file: Path to file containing raw data to read in.
     """
-    # Top two rows of file have question and responses
-    survey_df = pd.read_csv(input_file, sep='\t', header=[0, 1])
+    survey_df, schema = read_survey(input_file)
 
-    # Process first two headers into a single column header and clean up excess text
-    last_question = None
-    new_cols = []
-    for question, response in survey_df.columns:
-        question = question.replace(
-            'Thinking of your experience using Copilot so far, please indicate your level of agreement with the following statements.', '')
-        if 'Unnamed:' not in question:
-            last_question = question
-        response = '' if 'Unnamed:' in response else response
-        if last_question and response:
-            new_col = f'{last_question}-{response}'
-        elif last_question:
-            new_col = last_question
-        else:
-            new_col = response
-        new_cols.append(new_col)
-    survey_df.columns = new_cols
-    
     # Drop duplicates
-    survey_df = survey_df.drop_duplicates()
-
-    unskipped_columns = [col for col in survey_df if not col.endswith('N/A')]
-    # how often do these hold a pd.notna string? write that to a new column
-    survey_df['n_notna'] = survey_df[unskipped_columns].apply(lambda row: sum(pd.notna(row)), axis=1)
-    survey_df = survey_df.sort_values(by='n_notna', ascending=False)
-    survey_df = survey_df.drop_duplicates(subset=deduplication_column, keep='first')
-    survey_df = survey_df.sort_values(by='Start Date', ascending=True)
-    
-    # Generate boolean dummies for demographic vars
-    for covariate in demographics_dummies:
-        for value in [c for c in new_cols if covariate in c]:
-            survey_df[value] = survey_df[value].notnull().astype(int)
+    survey_df, removed = deduplicate_responses(survey_df, deduplication_column)
+    print(f"Removed {removed['exact_duplicates']} exact duplicate rows and {removed['repeat_responses']} repeat responses by {deduplication_column}.")
 
-    # Combine single-choice questions currently dummy-coded into single column
-    survey_df = combine_survey_vars(survey_df, impute=impute)
+    survey_df = encode_survey(survey_df, impute=impute, schema=schema)
 
     # PCA on target variables
     if pca:
@@ -104,45 +233,230 @@ def process_survey(input_file, deduplication_column, impute=True, pca=True):
     return survey_df
 
 
-def process_telemetry(input_file):
+@profiled('survey_parse')
+def read_survey(input_file):
+    """
+    Read raw survey data, flattening its two header rows into a single column header.
+    Returns the data and the SurveySchema compiled from its header.
+
+    :param input_file: Path to file containing raw data to read in.
+    """
+    # Top two rows of file have question and responses
+    survey_df = pd.read_csv(input_file, sep='\t', header=[0, 1])
+
+    # Process first two headers into a single column header and clean up excess text
+    schema = compile_header(tuple(survey_df.columns))
+    survey_df.columns = schema.columns
+
+    return survey_df, schema
+
+
+def encode_survey(survey_df, impute=True, schema=None):
+    """
+    Encode demographic answers as boolean dummies and combine single-choice answers into single columns.
+
+    :param schema: SurveySchema of the raw header, as returned by read_survey. Built from the column names if None.
+    """
+    schema = schema or schema_for_columns(tuple(survey_df.columns))
+
+    # Generate boolean dummies for demographic vars
+    for covariate in demographics_dummies:
+        for value in schema.answer_columns(covariate):
+            survey_df[value] = survey_df[value].notnull().astype(int)
+
+    # Combine single-choice questions currently dummy-coded into single column
+    return combine_survey_vars(survey_df, impute=impute, schema=schema)
+
+
+@profiled('process_survey_incremental')
+def process_survey_incremental(input_file, deduplication_column, state_dir, impute=True, pca=True, refit=False):
+    """
+    Process survey data, only decoding responses that are new or changed since the state in state_dir was saved.
+
+    The state holds the processed respondents and the fitted imputation medians and PCA loadings, which are applied
+    to new responses as they are. A new response replaces a stored one for the same respondent only if it is more
+    complete, so the respondents kept are those of process_survey on the combined responses. The state is created on the first run and updated on every run.
+
+    :param input_file: Path to file containing raw data to read in, e.g. the latest full export.
+    :param state_dir: Directory holding the persisted state.
+    :param refit: If True, refit the medians and PCA loadings on all respondents and reapply them to everyone.
+    """
+    state_dir = pathlib.Path(state_dir)
+    respondents_file = state_dir / 'respondents.pkl'
+    transforms_file = state_dir / 'transforms.pkl'
+    seen_file = state_dir / 'seen_responses.npy'
+    if respondents_file.exists():
+        respondents = pd.read_pickle(respondents_file)
+        with open(transforms_file, 'rb') as f:
+            transforms = pickle.load(f)
+        seen = np.load(seen_file)
+    else:
+        respondents, transforms, seen = None, {}, np.array([], dtype=np.uint64)
+
+    # Skip responses that were seen in earlier runs, whether kept or not, identified by a hash of their raw values.
+    survey_df, schema = read_survey(input_file)
+    response_hashes = pd.util.hash_pandas_object(survey_df, index=False)
+    is_new = ~np.isin(response_hashes.to_numpy(), seen)
+    seen = np.union1d(seen, response_hashes.to_numpy())
+    survey_df = survey_df[is_new]
+    survey_df, removed = deduplicate_responses(survey_df, deduplication_column)
+    survey_df['response_hash'] = response_hashes.loc[survey_df.index].to_numpy()
+    if respondents is not None:
+        stored_notna = survey_df[deduplication_column].map(respondents.set_index(deduplication_column)['n_notna'])
+        # Like deduplicate_responses, keep the earlier response unless the new one is more complete.
+        survey_df = survey_df[~(stored_notna >= survey_df['n_notna'])]
+        respondents = respondents[~respondents[deduplication_column].isin(survey_df[deduplication_column])]
+    print(f"Processing {len(survey_df)} new or changed responses, after removing {removed['exact_duplicates']} exact duplicate rows and {removed['repeat_responses']} repeat responses.")
+
+    survey_df = encode_survey(survey_df, impute=False, schema=schema)
+    respondents = pd.concat([respondents, survey_df], ignore_index=True) if respondents is not None else survey_df
+    respondents = respondents.sort_values(by='Start Date', ascending=True, kind='stable')
+
+    # Apply the stored transforms to new responses only, unless they are refit on everyone.
+    refit = refit or not transforms
+    updated = None if refit else respondents['response_hash'].isin(survey_df['response_hash']).to_numpy()
+    if updated is None or updated.any():
+        if impute:
+            if refit:
+                transforms['imputer'] = fit_likert_imputer(respondents)
+            respondents = impute_likert(respondents, transforms['imputer'], rows=updated)
+        if pca:
+            pca_vars = [f'{k}_imp_neutral' for k in dependent_mapping.keys()]
+            if refit:
+                transforms['pca'] = fit_pca(respondents, pca_vars, n_components=1)
+            scaler, pca_model = transforms['pca']
+            rows = slice(None) if updated is None else updated
+            features = respondents.loc[rows, pca_vars].to_numpy()
+            respondents.loc[rows, 'pca_survey_first_component'] = pca_model.transform(scaler.transform(features))[:, 0]
+
+    state_dir.mkdir(parents=True, exist_ok=True)
+    respondents.to_pickle(respondents_file)
+    with open(transforms_file, 'wb') as f:
+        pickle.dump(transforms, f)
+    np.save(seen_file, seen)
+
+    return respondents
+
+
+@profiled('dedup')
+def deduplicate_responses(df, deduplication_column):
+    """
+    Drop exact duplicate rows, then keep the most complete response for each value of deduplication_column,
+    ordered by 'Start Date'. Returns the deduplicated data and the number of rows removed by each rule.
+    """
+    n_rows = len(df)
+    # Compare row hashes rather than the wide object columns themselves.
+    df = df[~pd.util.hash_pandas_object(df, index=False).duplicated().to_numpy()]
+    n_unique = len(df)
+
+    # How often do the unskipped columns hold a value? Keep the first response with the most values per respondent.
+    unskipped_columns = [col for col in df if not col.endswith('N/A')]
+    n_notna = df[unskipped_columns].notna().to_numpy().sum(axis=1)
+    keep = pd.Series(n_notna).groupby(df[deduplication_column].to_numpy(), dropna=False, sort=False).idxmax()
+    keep = np.sort(keep.to_numpy())
+    df = df.iloc[keep].assign(n_notna=n_notna[keep])
+    df = df.sort_values(by='Start Date', ascending=True, kind='stable')
+
+    return df, {'exact_duplicates': n_rows - n_unique, 'repeat_responses': n_unique - len(df)}
+
+
+@profiled('process_telemetry')
+def process_telemetry(input_file, chunksize=None, tracking_ids=None, metrics=None):
     """
     Process telemetry data.
 
     :param input_file: Path to file containing raw data to read in.
+    :param chunksize: If set, stream the file in chunks of this many rows instead of reading it at once.
+    :param tracking_ids: If given, only keep rows whose copilot_trackingId is one of these.
+    :param metrics: Derived metrics to compute, see normalize_vars. Defaults to all.
     """
+    if chunksize is not None:
+        return pd.concat(iter_telemetry(input_file, chunksize, tracking_ids, metrics), ignore_index=True)
+
     # Top two rows of file have question and responses
     telemetry_df = pd.read_csv(input_file).rename(columns=telemetry_name_mapping)
+    if tracking_ids is not None:
+        telemetry_df = telemetry_df[telemetry_df['copilot_trackingId'].isin(tracking_ids)].copy()
 
     # Compute normalized variables
-    telemetry_df = normalize_vars(telemetry_df)
+    telemetry_df = normalize_vars(telemetry_df, metrics)
 
     return telemetry_df
 
 
-def normalize_vars(df):
+def iter_telemetry(input_file, chunksize, tracking_ids=None, metrics=None):
+    """
+    Stream telemetry data in chunks, renaming and normalizing each chunk as it is read.
+    Rows are filtered before normalizing, so only telemetry for the given tracking ids is ever held in memory.
 
-    # calculate mostly_unchanged_X measure
-    for duration in [30,120,300,600]:
-        df["mostly_unchanged_%s" % duration] = df["accepted"] - df["substantially_changed_%s" % duration]
+    :param input_file: Path to file containing raw data to read in.
+    :param chunksize: Number of rows per chunk.
+    :param tracking_ids: If given, only keep rows whose copilot_trackingId is one of these.
+    :param metrics: Derived metrics to compute, see normalize_vars. Defaults to all.
+    """
+    if tracking_ids is not None:
+        tracking_ids = pd.Index(tracking_ids).dropna().unique()
+    for chunk in pd.read_csv(input_file, chunksize=chunksize):
+        chunk = chunk.rename(columns=telemetry_name_mapping)
+        if tracking_ids is not None:
+            chunk = chunk[chunk['copilot_trackingId'].isin(tracking_ids)].copy()
+        yield normalize_vars(chunk, metrics)
 
-    normalizing_events = ["active_hour",
-              "opportunity", 
-              "shown", 
-              "accepted"]
 
-    extra_events = ["accepted_char",
-                    "mostly_unchanged_30", "mostly_unchanged_120", "mostly_unchanged_300", "mostly_unchanged_600",
-                    "unchanged_30", "unchanged_120", "unchanged_300", "unchanged_600"]
+def resolve_metrics(metrics=None):
+    """
+    Names of the derived metrics needed to compute the requested metrics, in registry order.
 
-    for (i,event) in enumerate(normalizing_events):
-        for other_event in normalizing_events[0:i]:
-            df["%s_per_%s" % (event, other_event)] = df[event] / df[other_event]
-    
-    for event in extra_events:
-        for other_event in normalizing_events:
-            df["%s_per_%s" % (event, other_event)] = df[event] / df[other_event]
+    :param metrics: Names of requested metrics. Names that are not derived metrics are ignored. Defaults to all.
+    """
+    if metrics is None:
+        return list(derived_metrics)
+    needed = set()
+    to_visit = [metric for metric in metrics if metric in derived_metrics]
+    while to_visit:
+        metric = to_visit.pop()
+        if metric not in needed:
+            needed.add(metric)
+            to_visit += [source for source in derived_metrics[metric][:2] if source in derived_metrics]
+    return [metric for metric in derived_metrics if metric in needed]
+
+
+@profiled('telemetry_normalize')
+def normalize_vars(df, metrics=None):
+    """
+    Compute derived telemetry metrics as defined in variables.derived_metrics.
+    All metrics are written into a single preallocated block that is joined to df once.
 
-    return df
+    :param metrics: Names of metrics to compute, along with the metrics they are derived from. Defaults to all.
+    """
+    names = resolve_metrics(metrics)
+    values = np.empty((len(df), len(names)), order='F')
+    positions = {name: k for k, name in enumerate(names)}
+
+    # Differences of integer counts are cast back to their integer dtype, as subtracting the columns directly would give.
+    dtypes = {}
+
+    def column(name):
+        return values[:, positions[name]] if name in positions else df[name].to_numpy(dtype=float)
+
+    def dtype(name):
+        return dtypes.get(name, np.dtype(float)) if name in positions else df[name].dtype
+
+    for k, name in enumerate(names):
+        numerator, denominator, derivation = derived_metrics[name]
+        if derivation == 'difference':
+            np.subtract(column(numerator), column(denominator), out=values[:, k])
+            if all(isinstance(dtype(source), np.dtype) and dtype(source).kind in 'iu' for source in (numerator, denominator)):
+                dtypes[name] = np.result_type(dtype(numerator), dtype(denominator))
+        elif derivation == 'ratio':
+            denominators = column(denominator)
+            values[:, k] = np.nan
+            np.divide(column(numerator), denominators, out=values[:, k], where=denominators != 0)
+        else:
+            raise ValueError(f'Unknown derivation "{derivation}" for metric {name}.')
+
+    derived = pd.DataFrame(values, index=df.index, columns=names).astype(dtypes)
+    return pd.concat([df.drop(columns=df.columns.intersection(names)), derived], axis=1)
 
 
 def combine_likert(row):
@@ -178,38 +492,116 @@ def combine_bool(row):
         return None
 
 
-def combine_survey_vars(df, likert_mapping=dependent_mapping, ordinal_mapping=demographics_ordinal_mapping, impute=True):
+def first_notnull(block):
+    """
+    Vectorized scan of single-choice columns: returns the position of the first non-null column
+    in each row, or -1 where every column in the row is null.
+    """
+    answered = block.notna().to_numpy()
+    first = answered.argmax(axis=1)
+    first[~answered.any(axis=1)] = -1
+    return first
+
+
+def decode_likert(block):
+    """Vectorized equivalent of applying combine_likert to each row of block."""
+    first = first_notnull(block)
+    return _decoded_series(np.where(first >= 0, 5 - first, -1), block.index)
+
+
+def decode_ordinal(block):
+    """Vectorized equivalent of applying combine_ordinal to each row of block."""
+    return _decoded_series(first_notnull(block) + 1, block.index, missing=0)
+
+
+def decode_bool(block):
+    """Vectorized equivalent of applying combine_bool to each row of block."""
+    # Like combine_bool, only the first four answer columns are consulted.
+    first = first_notnull(block.iloc[:, :4])
+    return _decoded_series(np.select([first >= 2, first >= 0], [0, 1], -1), block.index)
+
+
+def _decoded_series(values, index, missing=-1):
+    """Wrap decoded values in a Series, matching the dtype DataFrame.apply infers for the row-wise functions."""
+    values = pd.Series(values, index=index, dtype='int64')
+    if (values == missing).any():
+        return values.where(values != missing).astype('float64')
+    return values
+
+
+@profiled('likert_decode')
+def combine_survey_vars(df, likert_mapping=dependent_mapping, ordinal_mapping=demographics_ordinal_mapping, impute=True, engine='numpy', schema=None):
+    """
+    Combine dummy-coded single-choice survey answers into single columns.
+
+    :param schema: SurveySchema used to look up answer columns. Built from the column names if None. Raises a
+        ValueError if a question is missing.
+    :param engine: 'numpy' decodes each block of answer columns at once, 'apply' calls combine_likert,
+        combine_bool and combine_ordinal row by row. Both give identical output.
+    """
+    if engine == 'numpy':
+        likert_fn, bool_fn, ordinal_fn = decode_likert, decode_bool, decode_ordinal
+    elif engine == 'apply':
+        likert_fn = lambda block: block.apply(combine_likert, axis=1)
+        bool_fn = lambda block: block.apply(combine_bool, axis=1)
+        ordinal_fn = lambda block: block.apply(combine_ordinal, axis=1)
+    else:
+        raise ValueError('Engine must be either "numpy" or "apply".')
+    schema = schema or schema_for_columns(tuple(df.columns))
+
     # Combine Likert variables into single variable
     for var, text in likert_mapping.items():
-        df[var] = df[[
-            f'{text} - {val}'
-            for val in ['Strongly Agree', 'Agree', 'Neither Agree or Disagree', 'Disagree', 'Strongly Disagree']
-            ]].apply(
-        lambda x: combine_likert(x), axis=1)
+        df[var] = likert_fn(df[schema.likert_columns(text, likert_values)])
     if impute:
-        imputer = SimpleImputer(missing_values=np.nan, strategy='median')
-        median_imputed = imputer.fit_transform(df[list(likert_mapping.keys())].to_numpy())
-        df[[f'{v}_imp_median' for v in likert_mapping.keys()]] = None  # Get a weird NotImplementedError without this
-        df[[f'{v}_imp_median' for v in likert_mapping.keys()]] = median_imputed
-        df[[f'{v}_imp_neutral' for v in likert_mapping.keys()]] = df[likert_mapping.keys()].fillna(3)
+        df = impute_likert(df, fit_likert_imputer(df, likert_mapping), likert_mapping)
     df['aggregate_productivity'] = df[list(likert_mapping.keys())].mean(axis=1)
 
     # Create binary variables for Likert outcomes
     for var, text in likert_mapping.items():
-        df[f'{var}_bool'] = df[[
-            f'{text} - {val}'
-            for val in ['Strongly Agree', 'Agree', 'Neither Agree or Disagree', 'Disagree', 'Strongly Disagree']
-            ]].apply(
-        lambda x: combine_bool(x), axis=1)
+        df[f'{var}_bool'] = bool_fn(df[schema.likert_columns(text, likert_values)])
 
     # Combine values for ordinal demographic vars
     for var, text in ordinal_mapping.items():
-        df[var] = df[[c for c in df.columns if text in c]].apply(
-            lambda x: combine_ordinal(x), axis=1)
+        df[var] = ordinal_fn(df[schema.answer_columns(text)])
 
     return df
 
 
+def fit_likert_imputer(df, likert_mapping=dependent_mapping):
+    """Fit median imputation of the combined Likert variables."""
+    imputer = SimpleImputer(missing_values=np.nan, strategy='median')
+    return imputer.fit(df[list(likert_mapping.keys())].to_numpy())
+
+
+def impute_likert(df, imputer, likert_mapping=dependent_mapping, rows=None):
+    """
+    Add median-imputed and neutral-imputed copies of the combined Likert variables.
+
+    :param imputer: Fitted imputer, see fit_likert_imputer.
+    :param rows: Boolean mask of rows to impute. If set, the imputed columns must already exist.
+    """
+    likert_vars = list(likert_mapping.keys())
+    median_vars = [f'{v}_imp_median' for v in likert_vars]
+    neutral_vars = [f'{v}_imp_neutral' for v in likert_vars]
+    if rows is None:
+        median_imputed = imputer.transform(df[likert_vars].to_numpy())
+        df[median_vars] = None  # Get a weird NotImplementedError without this
+        df[median_vars] = median_imputed
+        df[neutral_vars] = df[likert_vars].fillna(3)
+    else:
+        df.loc[rows, median_vars] = imputer.transform(df.loc[rows, likert_vars].to_numpy())
+        df.loc[rows, neutral_vars] = df.loc[rows, likert_vars].fillna(3).to_numpy()
+    return df
+
+
+def fit_pca(df, vars, n_components=None):
+    """Fit the standardization and PCA used by run_pca, so they can be applied to new data. Returns (scaler, pca_model)."""
+    features = df[vars].dropna().to_numpy()
+    scaler = StandardScaler().fit(features)
+    pca_model = PCA(n_components=n_components).fit(scaler.transform(features))
+    return scaler, pca_model
+
+
 def run_pca(df, vars, n_components=None, standardize=True, explained_variance=0.95):
     """Select k features with PCA that explains at least the specified percent of variance."""
     df = df[vars].dropna()
@@ -3,17 +3,27 @@ regression.py
 
 Fit regression models to the data.
 """
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from math import sqrt
+from multiprocessing import shared_memory
+import hashlib
 import numpy as np
 import pathlib
 import pandas as pd
 import statsmodels.api as sm
 import warnings
+from scipy import stats
 from sklearn.feature_selection import f_regression, r_regression
 from sklearn.preprocessing import StandardScaler
 from statsmodels.miscmodels.ordinal_model import OrderedModel
 from statsmodels.tools.sm_exceptions import ConvergenceWarning, IterationLimitWarning
-from process_data import run_pca
+from design_matrix import DesignMatrix, column_values
+from instrumentation import count_fits, profiled
+from ordinal import category_groups, fit_ordinal
+from process_data import load_data, run_pca
+from sufficient_stats import SufficientStats
+from survey_schema import matching_columns
 from variables import independent_vars, dependent_vars, demographics_dummies, demographics_ordinal, telemetry_name_mapping
 
 warnings.simplefilter('ignore', ConvergenceWarning)
@@ -22,13 +32,19 @@ warnings.simplefilter('ignore', IterationLimitWarning)
 
 def get_dummies(df, covariates):
     """Get dummy variable names for the specified variables, dropping zero-variance values."""
-    columns = [col for col in df.columns for var in covariates if var in col]
+    if isinstance(df, DesignMatrix):
+        return df.get_dummies(covariates)
+    columns = matching_columns(df.columns, covariates)
     std = df[columns].std()
     non_constant = std[std > 0].index
     return list(non_constant)
 
 
 def process_features_targets(df, independent_vars, dependent_vars, dummies, standardize=True, drop_na=True):
+    # A DesignMatrix builds these once per combination of arguments and returns its cached, read-only arrays.
+    if isinstance(df, DesignMatrix):
+        return df.features_targets(independent_vars, dependent_vars, dummies, standardize, drop_na)
+
     # Get dummy variable names for categorical covariates, dropping zero-variance values.
     all_dummies = get_dummies(df, dummies)
 
@@ -55,8 +71,116 @@ def process_features_targets(df, independent_vars, dependent_vars, dummies, stan
     return features, outcomes, all_dummies
 
 
-def f_stat_regression(df, independent_vars, dependent_vars, standardize=True):
-    """F-regression for the impact of a single variable."""
+def ols_fit(features, outcomes):
+    """
+    Fit OLS for every column of outcomes against the same design matrix from a single SVD.
+
+    Mirrors sm.OLS, including the pseudo-inverse for rank-deficient designs. The design matrix
+    must include a constant column. Coefficient statistics are shaped (features, outcomes).
+    """
+    nobs = features.shape[0]
+    u, singular_values, vt = np.linalg.svd(features, full_matrices=False)
+    kept = singular_values > 1e-15 * singular_values.max()
+    inverse = np.where(kept, 1 / np.where(kept, singular_values, 1), 0)
+    rank = np.linalg.matrix_rank(np.diag(singular_values))
+
+    params = vt.T @ (inverse[:, None] * (u.T @ outcomes))
+    resid = outcomes - features @ params
+    ssr = (resid ** 2).sum(axis=0)
+    centered_tss = ((outcomes - outcomes.mean(axis=0)) ** 2).sum(axis=0)
+    df_resid = nobs - rank
+    normalized_cov = (vt.T * inverse ** 2) @ vt
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bse = np.sqrt(np.outer(np.diag(normalized_cov), ssr / df_resid))
+        pvalues = 2 * stats.t.sf(np.abs(params / bse), df_resid)
+        rsquared = 1 - ssr / centered_tss
+    return {
+        'params': params,
+        'bse': bse,
+        'pvalues': pvalues,
+        'ssr': ssr,
+        'centered_tss': centered_tss,
+        'rsquared': rsquared,
+        'rsquared_adj': 1 - (nobs - 1) / df_resid * (1 - rsquared),
+        'df_resid': df_resid,
+        'rank': rank,
+        'normalized_cov': normalized_cov,
+    }
+
+
+def pairwise_correlation(x, y, x_present=None, y_present=None):
+    """
+    Pearson correlation between every column of x and every column of y, with missing values dropped
+    pairwise rather than across all columns. Returns correlations and sample counts, both shaped (x columns, y columns).
+
+    :param x_present: Optional precomputed mask of present values in x, e.g. from DesignMatrix.mask. Same for y_present.
+    """
+    x_present = ~np.isnan(x) if x_present is None else x_present
+    y_present = ~np.isnan(y) if y_present is None else y_present
+    x_weights = x_present.astype(float)
+    y_weights = y_present.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Shift by column means so the masked sums below stay well conditioned.
+        x = np.where(x_present, x - np.nansum(x, axis=0) / x_weights.sum(axis=0), 0.0)
+        y = np.where(y_present, y - np.nansum(y, axis=0) / y_weights.sum(axis=0), 0.0)
+
+        # Each product sums only over the rows where both variables of a pair are present.
+        n = x_weights.T @ y_weights
+        sum_x = x.T @ y_weights
+        sum_y = x_weights.T @ y
+        cov = x.T @ y - sum_x * sum_y / n
+        var_x = (x ** 2).T @ y_weights - sum_x ** 2 / n
+        var_y = x_weights.T @ (y ** 2) - sum_y ** 2 / n
+        corrs = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
+    return corrs, n.round().astype(int)
+
+
+def correlation_f_test(corrs, n):
+    """F-statistics and p-values for correlations, matching sklearn.feature_selection.f_regression."""
+    dof = n - 2
+    corrs = np.nan_to_num(corrs, nan=0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f_stats = corrs ** 2 / (1 - corrs ** 2) * dof
+        p_values = stats.f.sf(f_stats, 1, dof)
+    # Perfect (anti-)correlations get the largest finite F-statistic, undefined ones the smallest.
+    perfect = np.isinf(f_stats)
+    f_stats[perfect] = np.finfo(f_stats.dtype).max
+    undefined = np.isnan(f_stats)
+    f_stats[undefined] = 0.0
+    p_values[undefined] = 1.0
+    return f_stats, p_values
+
+
+@profiled('f_stat_regression')
+def f_stat_regression(df, independent_vars, dependent_vars, standardize=True, engine='numpy'):
+    """
+    F-regression for the impact of a single variable.
+
+    :param engine: 'numpy' computes every pair at once with masked matrix products, 'sklearn' fits each pair
+        separately with f_regression and r_regression. Both drop missing values pairwise. With the numpy engine, df
+        can also be a SufficientStats accumulator of the variables.
+    """
+    count_fits(len(independent_vars) * len(dependent_vars))
+    if isinstance(df, SufficientStats) and engine != 'numpy':
+        raise ValueError('Sufficient statistics are only supported by the numpy engine.')
+    if engine == 'numpy':
+        # Standardizing does not change correlations, so the raw values are used directly.
+        if isinstance(df, SufficientStats):
+            corrs, n = df.pairwise_correlation(independent_vars, dependent_vars)
+        else:
+            masks = (df.mask(independent_vars), df.mask(dependent_vars)) if isinstance(df, DesignMatrix) else (None, None)
+            corrs, n = pairwise_correlation(column_values(df, independent_vars), column_values(df, dependent_vars), *masks)
+        f_stats, p_values = correlation_f_test(corrs, n)
+        return pd.DataFrame({
+            'independent': independent_vars * len(dependent_vars),
+            'dependent': np.repeat(dependent_vars, len(independent_vars)),
+            'n': n.T.ravel(),
+            'corr_coef': np.nan_to_num(corrs, nan=0.0).T.ravel(),
+            'corr_f_stat': f_stats.T.ravel(),
+            'corr_p_value': p_values.T.ravel()}).round(4)
+    elif engine != 'sklearn':
+        raise ValueError('Engine must be either "numpy" or "sklearn".')
+
     results = {'independent': [], 'dependent': [], 'n': [], 'corr_coef': [], 'corr_f_stat': [], 'corr_p_value': []}
     for outcome in dependent_vars:
         for predictor in independent_vars:  # Extra loop to only drop missing values pairwise rather than across all
@@ -76,8 +200,81 @@ def f_stat_regression(df, independent_vars, dependent_vars, standardize=True):
     return pd.DataFrame(results).round(4)
 
 
-def multiple_regression_single_pred(model_type, df, independent_vars, controls, dependent_vars, dummies, standardize=True, verbose=True):
-    """OLS linear regression or ordinal regression for multivariate models."""
+def single_pred_ols_fit(features, controls_dummies, outcomes):
+    """
+    Fit OLS of each outcome on the controls plus one predictor at a time, for every predictor at once.
+
+    By Frisch-Waugh-Lovell, each predictor's coefficient equals the slope of the outcome residualized on the controls
+    against the predictor residualized on the controls, so the controls are projected out once for all models.
+    Features exclude the constant, controls_dummies include it. Statistics are shaped (features, outcomes).
+    """
+    baseline = ols_fit(controls_dummies, outcomes)
+    u, _, _ = np.linalg.svd(controls_dummies, full_matrices=False)
+    basis = u[:, :baseline['rank']]
+    features = features - basis @ (basis.T @ features)
+    outcomes = outcomes - basis @ (basis.T @ outcomes)
+
+    df_resid = features.shape[0] - baseline['rank'] - 1
+    sxx = (features ** 2).sum(axis=0)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        params = features.T @ outcomes / sxx
+        ssr = baseline['ssr'] - params ** 2 * sxx
+        pvalues = 2 * stats.t.sf(np.abs(params / np.sqrt(ssr / df_resid / sxx)), df_resid)
+    rsquared = 1 - ssr / baseline['centered_tss']
+    return baseline, {
+        'params': params,
+        'pvalues': pvalues,
+        'rsquared': rsquared,
+        'rsquared_adj': 1 - (features.shape[0] - 1) / df_resid * (1 - rsquared),
+    }
+
+
+def ordinal_fit(features, outcomes, start_params=None):
+    """
+    Fit ordinal (cumulative probit) models of every outcome with ordinal.fit_ordinal, fitting outcomes with the same
+    number of categories together. Coefficient statistics are shaped (features, outcomes), and 'params_full' lists each
+    outcome's betas and thresholds for warm starts.
+
+    :param start_params: Optional list of warm starts, one per outcome.
+    """
+    n_outcomes = outcomes.shape[1]
+    fit = {
+        'params': np.empty((features.shape[1], n_outcomes)),
+        'pvalues': np.empty((features.shape[1], n_outcomes)),
+        'llf': np.empty(n_outcomes),
+        'converged': np.empty(n_outcomes, dtype=bool),
+        'params_full': [None] * n_outcomes,
+    }
+    for columns in category_groups(outcomes):
+        group_start = None if start_params is None else np.stack([start_params[i] for i in columns])
+        group_fit = fit_ordinal(features, outcomes[:, columns], start_params=group_start)
+        for key in ('params', 'pvalues'):
+            fit[key][:, columns] = group_fit[key]
+        fit['llf'][columns] = group_fit['llf']
+        fit['converged'][columns] = group_fit['converged']
+        for k, i in enumerate(columns):
+            fit['params_full'][i] = group_fit['params_full'][k]
+    return fit
+
+
+@profiled('multiple_regression_single_pred', detail=lambda model_type, *args, **kwargs: model_type)
+def multiple_regression_single_pred(model_type, df, independent_vars, controls, dependent_vars, dummies, standardize=True, verbose=True, engine='numpy'):
+    """
+    OLS linear regression or ordinal regression for multivariate models.
+
+    :param engine: With 'numpy', models that are not printed (verbose=False) skip statsmodels: OLS models are fit for
+        every predictor at once by residualizing outcomes and predictors on the controls, and ordinal models are fit for
+        all outcomes at once with ordinal.fit_ordinal. 'statsmodels' fits one model per predictor and outcome.
+        Logit models and statsmodels ordinal models are warm-started from the baseline fit.
+    """
+    count_fits(len(dependent_vars) * (len(independent_vars) + 1))
+    if engine not in ('numpy', 'statsmodels'):
+        raise ValueError('Engine must be either "numpy" or "statsmodels".')
+    # A predictor that is also a control would enter its models twice, which leaves its coefficient undetermined.
+    overlap = [var for var in independent_vars if var in controls]
+    if overlap:
+        raise ValueError(f'Independent variables cannot also be controls: {", ".join(overlap)}.')
+
     # Features are our behavioral metrics from telemetry data and user demographics.
     # Outcomes are self-reported measures of user productivity.
     features, outcomes, all_dummies = process_features_targets(df, independent_vars + controls, dependent_vars, dummies, standardize)
@@ -96,17 +293,60 @@ def multiple_regression_single_pred(model_type, df, independent_vars, controls,
         results['logit_pseudo_rsquared'] = []
         model = sm.Logit
     elif model_type == 'ordinal':
+        # OrderedModel does not take a constant, its thresholds play the role of the intercept.
+        controls_dummies_baseline = controls_dummies
         results['ordinal_model_log_likelihood'] = []
+        results['ordinal_converged'] = []
         model = OrderedModel
     else:
         raise ValueError('Model type must be either "ols" or "ordinal" or "logit".')
 
+    if model_type == 'ordinal':
+        def predictor_design(j):
+            return np.concatenate([features[:, j][:, None], controls_dummies], axis=1)
+
+        def warm_start(baseline_params):
+            return np.r_[0, baseline_params]
+    else:
+        def predictor_design(j):
+            return np.concatenate([features[:, 0][:, None], features[:, j + 1][:, None], controls_dummies], axis=1)
+
+        def warm_start(baseline_params):
+            return np.r_[baseline_params[0], 0, baseline_params[1:]]
+
     print(f'Running {model_type} regression on {features.shape[0]} samples.')
+    if model_type == 'ols' and engine == 'numpy' and not verbose:
+        baseline, fits = single_pred_ols_fit(features[:, 1:], controls_dummies_baseline, outcomes)
+        for i, outcome in enumerate(dependent_vars):
+            results['independent'] += controls + all_dummies + independent_vars
+            results['dependent'] += [outcome] * (controls_dummies.shape[1] + len(independent_vars))
+            results['ols_model_rsquared'] += [baseline['rsquared'][i]] * controls_dummies.shape[1] + fits['rsquared'][:, i].tolist()
+            results['ols_model_rsquared_adj'] += [baseline['rsquared_adj'][i]] * controls_dummies.shape[1] + fits['rsquared_adj'][:, i].tolist()
+            results['ols_coefficient'] += baseline['params'][1:, i].tolist() + fits['params'][:, i].tolist()  # Drop intercept coefficient.
+            results['ols_t_p-value'] += baseline['pvalues'][1:, i].tolist() + fits['pvalues'][:, i].tolist()  # Drop intercept coefficient.
+        return pd.DataFrame(results).round(4).sort_values(by='independent')
+    if model_type == 'ordinal' and engine == 'numpy' and not verbose:
+        baseline = ordinal_fit(controls_dummies_baseline, outcomes)
+        # Start each predictor model from the baseline fit, with a zero coefficient for the added predictor.
+        start_params = [warm_start(params) for params in baseline['params_full']]
+        fits = [ordinal_fit(predictor_design(j), outcomes, start_params) for j in range(len(independent_vars))]
+        for i, outcome in enumerate(dependent_vars):
+            results['independent'] += controls + all_dummies + independent_vars
+            results['dependent'] += [outcome] * (controls_dummies.shape[1] + len(independent_vars))
+            results['ordinal_coefficient'] += baseline['params'][:, i].tolist() + [fit['params'][0, i] for fit in fits]
+            results['ordinal_t_p-value'] += baseline['pvalues'][:, i].tolist() + [fit['pvalues'][0, i] for fit in fits]
+            results['ordinal_model_log_likelihood'] += [baseline['llf'][i]] * controls_dummies.shape[1] + [fit['llf'][i] for fit in fits]
+            results['ordinal_converged'] += [baseline['converged'][i]] * controls_dummies.shape[1] + [fit['converged'][i] for fit in fits]
+        return pd.DataFrame(results).round(4).sort_values(by='independent')
+
     # Fit regression model for each dependent variable.
     for i, outcome in enumerate(dependent_vars):
         # Fit the base model with controls only.
+        start_params = None
         try:
             regression = model(outcomes[:, i], controls_dummies_baseline).fit(disp=0)
+            if model_type != 'ols':
+                start_params = warm_start(regression.params)
             results['independent'] += controls + all_dummies
             results['dependent'] += [outcome] * controls_dummies.shape[1]
             if model_type == 'ols':
@@ -120,6 +360,7 @@ def multiple_regression_single_pred(model_type, df, independent_vars, controls,
                 results[f'{model_type}_t_p-value'] += regression.pvalues[1:].tolist()  # Drop intercept coefficient.
             else:
                 results['ordinal_model_log_likelihood'] += [regression.llf] * controls_dummies.shape[1]
+                results['ordinal_converged'] += [regression.mle_retvals['converged']] * controls_dummies.shape[1]
                 results[f'{model_type}_coefficient'] += regression.params[:-4].tolist()
                 results[f'{model_type}_t_p-value'] += regression.pvalues[:-4].tolist()
         except Exception:
@@ -128,13 +369,11 @@ def multiple_regression_single_pred(model_type, df, independent_vars, controls,
         # Fit a model with all demographics and controls plus each predictor.
         for j, predictor in enumerate(independent_vars):
             try:
-                regression = model(
-                    outcomes[:, i], 
-                    np.concatenate([
-                        features[:, 0][:, None],
-                        features[:, j + 1][:, None],
-                        controls_dummies
-                    ], axis=1)).fit(disp=0)
+                if start_params is None:
+                    regression = model(outcomes[:, i], predictor_design(j)).fit(disp=0)
+                else:
+                    # Start from the baseline fit, with a zero coefficient for the added predictor.
+                    regression = model(outcomes[:, i], predictor_design(j)).fit(start_params=start_params, disp=0)
             except Exception:
                 print('Failed to fit predictor model for', outcome)
                 continue
@@ -155,13 +394,39 @@ def multiple_regression_single_pred(model_type, df, independent_vars, controls,
                 results[f'{model_type}_t_p-value'] += [regression.pvalues[1]]  # Drop intercept coefficient.
             else:
                 results['ordinal_model_log_likelihood'] += [regression.llf]
+                results['ordinal_converged'] += [regression.mle_retvals['converged']]
                 results[f'{model_type}_coefficient'] += [regression.params[0]]
                 results[f'{model_type}_t_p-value'] += [regression.pvalues[0]]
     return pd.DataFrame(results).round(4).sort_values(by='independent')
 
 
-def multiple_regression(model_type, df, independent_vars, controls, dependent_vars, dummies, standardize=True, verbose=True):
-    """OLS linear regression or ordinal regression for multivariate models."""
+@profiled('multiple_regression', detail=lambda model_type, *args, **kwargs: model_type)
+def multiple_regression(model_type, df, independent_vars, controls, dependent_vars, dummies, standardize=True, verbose=True, engine='numpy'):
+    """
+    OLS linear regression or ordinal regression for multivariate models.
+
+    :param engine: With 'numpy', models that are not printed (verbose=False) skip statsmodels: OLS models are solved for
+        all outcomes at once from a single factorization of the shared design matrix, and ordinal models are fit for all
+        outcomes at once with ordinal.fit_ordinal. 'statsmodels' fits one sm.OLS or OrderedModel per outcome.
+        OLS models can also be solved from a SufficientStats accumulator passed as df, with the numpy engine.
+    """
+    count_fits(len(dependent_vars))
+    if engine not in ('numpy', 'statsmodels'):
+        raise ValueError('Engine must be either "numpy" or "statsmodels".')
+    if isinstance(df, SufficientStats):
+        if model_type != 'ols' or engine != 'numpy':
+            raise ValueError('Sufficient statistics only support OLS with the numpy engine.')
+        all_dummies = df.get_dummies(dummies)
+        predictors = independent_vars + controls + all_dummies
+        fit = df.ols_fit(predictors, dependent_vars, len(independent_vars + controls) if standardize else 0)
+        print(f'Running ols regression on {fit["nobs"]} samples.')
+        return pd.DataFrame({
+            'independent': predictors * len(dependent_vars),
+            'dependent': np.repeat(dependent_vars, len(predictors)).tolist(),
+            'ols_coefficient': fit['params'].T.ravel(),
+            'ols_t_p-value': fit['pvalues'].T.ravel(),
+            'ols_model_rsquared': np.repeat(fit['rsquared'], len(predictors)),
+            'ols_model_rsquared_adj': np.repeat(fit['rsquared_adj'], len(predictors))}).round(4).sort_values(by='independent')
     # Features are our behavioral metrics from telemetry data and user demographics.
     # Outcomes are self-reported measures of user productivity.
     features, outcomes, all_dummies = process_features_targets(df, independent_vars + controls, dependent_vars, dummies, standardize)
@@ -178,11 +443,31 @@ def multiple_regression(model_type, df, independent_vars, controls, dependent_va
         n_features = features.shape[1] - 1
     elif model_type == 'ordinal':
         results['ordinal_model_log_likelihood'] = []
+        results['ordinal_converged'] = []
         n_features = features.shape[1]
     else:
         raise ValueError('Model type must be either "ols" or "ordinal" or "logit".')
 
     print(f'Running {model_type} regression on {features.shape[0]} samples.')
+    if model_type == 'ols' and engine == 'numpy' and not verbose:
+        fit = ols_fit(features, outcomes)
+        results['independent'] = (independent_vars + controls + all_dummies) * len(dependent_vars)
+        results['dependent'] = np.repeat(dependent_vars, n_features).tolist()
+        results['ols_coefficient'] = fit['params'][1:].T.ravel()  # Drop intercept coefficient.
+        results['ols_t_p-value'] = fit['pvalues'][1:].T.ravel()  # Drop intercept coefficient.
+        results['ols_model_rsquared'] = np.repeat(fit['rsquared'], n_features)
+        results['ols_model_rsquared_adj'] = np.repeat(fit['rsquared_adj'], n_features)
+        return pd.DataFrame(results).round(4).sort_values(by='independent')
+    if model_type == 'ordinal' and engine == 'numpy' and not verbose:
+        fit = ordinal_fit(features, outcomes)
+        results['independent'] = (independent_vars + controls + all_dummies) * len(dependent_vars)
+        results['dependent'] = np.repeat(dependent_vars, n_features).tolist()
+        results['ordinal_coefficient'] = fit['params'].T.ravel()
+        results['ordinal_t_p-value'] = fit['pvalues'].T.ravel()
+        results['ordinal_model_log_likelihood'] = np.repeat(fit['llf'], n_features)
+        results['ordinal_converged'] = np.repeat(fit['converged'], n_features)
+        return pd.DataFrame(results).round(4).sort_values(by='independent')
+
     # Fit regression model for each dependent variable.
     for i, outcome in enumerate(dependent_vars):
         try:
@@ -194,6 +479,7 @@ def multiple_regression(model_type, df, independent_vars, controls, dependent_va
                 regression = sm.Logit(outcomes[:, i], features).fit()
         except Exception:
             print('Failed to fit model for', outcome)
+            continue
         if verbose:
             print(f'{outcome}:\n{regression.summary()}')
 
@@ -211,13 +497,18 @@ def multiple_regression(model_type, df, independent_vars, controls, dependent_va
             results[f'{model_type}_t_p-value'] += regression.pvalues[1:].tolist()  # Drop intercept coefficient.
         else:
             results['ordinal_model_log_likelihood'] += [regression.llf] * n_features
+            results['ordinal_converged'] += [regression.mle_retvals['converged']] * n_features
             results[f'{model_type}_coefficient'] += regression.params[:-4].tolist()
             results[f'{model_type}_t_p-value'] += regression.pvalues[:-4].tolist()
 
     return pd.DataFrame(results).round(4).sort_values(by='independent')
 
 
+@profiled('ols_pca')
 def ols_pca(df, independent_vars, dependent_vars, dummies, explained_variance=0.95, verbose=True):
+    count_fits(len(dependent_vars))
+    if isinstance(df, DesignMatrix):
+        df = df.to_frame()
     all_dummies = get_dummies(df, dummies)
     df = df[independent_vars + dependent_vars + all_dummies].dropna()
 
@@ -251,24 +542,58 @@ def ols_pca(df, independent_vars, dependent_vars, dummies, explained_variance=0.
     return pd.DataFrame(results).round(4).sort_values(by='component'), components
 
 
-def rsquared_contribution(full_rsquared, df, independent_vars, dependent_vars, dummies, standardize=True, verbose=True):
-    """Calculate the decrease in Rsquared for each independent variable when removed from model."""
-    features, outcomes, all_dummies = process_features_targets(df, independent_vars, dependent_vars, dummies, standardize)
+@profiled('rsquared_contribution')
+def rsquared_contribution(full_rsquared, df, independent_vars, dependent_vars, dummies, standardize=True, verbose=True, engine='numpy'):
+    """
+    Calculate the decrease in Rsquared for each independent variable when removed from model.
 
+    :param engine: 'numpy' fits the full model once for all outcomes and downdates it to get every drop-one fit,
+        'statsmodels' refits sm.OLS without each regressor. Rank-deficient designs always use 'statsmodels'.
+        With a SufficientStats accumulator passed as df, the numpy engine works from its Gram matrix.
+    """
+    count_fits(len(dependent_vars) * len(independent_vars))
+    if engine not in ('numpy', 'statsmodels'):
+        raise ValueError('Engine must be either "numpy" or "statsmodels".')
     results = {'independent': [], 'dependent': [], 'adj_rsquared_without': [], 'rsquared_without': []}
-    features = sm.add_constant(features)
 
-    # Fit regression model for each dependent variable without each independent variable and with only each independent variable.
-    for i, outcome in enumerate(dependent_vars):
-        for j, regressor in enumerate(independent_vars):
-            features_dropped = np.delete(features, j + 1, axis=1)
-            regression = sm.OLS(outcomes[:, i], features_dropped).fit()
-
-            # Add results to full results dictionary.
-            results['independent'].append(regressor)
-            results['dependent'].append(outcome)
-            results['adj_rsquared_without'].append(regression.rsquared_adj)
-            results['rsquared_without'].append(regression.rsquared)
+    if isinstance(df, SufficientStats):
+        if engine != 'numpy':
+            raise ValueError('Sufficient statistics are only supported by the numpy engine.')
+        all_dummies = df.get_dummies(dummies)
+        full_fit = df.ols_fit(independent_vars + all_dummies, dependent_vars, len(independent_vars) if standardize else 0)
+        if full_fit['rank'] != len(independent_vars + all_dummies) + 1:
+            raise ValueError('Rank-deficient designs need row-level data.')
+        n_params, nobs = full_fit['rank'], full_fit['nobs']
+        dropped = np.arange(len(independent_vars))  # The accumulator's fit has no intercept coefficient.
+    else:
+        features, outcomes, all_dummies = process_features_targets(df, independent_vars, dependent_vars, dummies, standardize)
+        features = sm.add_constant(features)
+        full_fit = ols_fit(features, outcomes) if engine == 'numpy' else None
+        n_params, nobs = features.shape[1], features.shape[0]
+        dropped = np.arange(1, len(independent_vars) + 1)
+
+    if full_fit is not None and full_fit['rank'] == n_params:
+        # Dropping regressor j raises the SSR by its squared coefficient over its diagonal entry of (X'X)^-1.
+        ssr_without = full_fit['ssr'] + full_fit['params'][dropped] ** 2 / np.diag(full_fit['normalized_cov'])[dropped, None]
+        rsquared_without = 1 - ssr_without / full_fit['centered_tss']
+        adj_rsquared_without = 1 - (nobs - 1) / (full_fit['df_resid'] + 1) * (1 - rsquared_without)
+
+        results['independent'] = list(independent_vars) * len(dependent_vars)
+        results['dependent'] = np.repeat(dependent_vars, len(independent_vars)).tolist()
+        results['adj_rsquared_without'] = adj_rsquared_without.T.ravel()
+        results['rsquared_without'] = rsquared_without.T.ravel()
+    else:
+        # Fit regression model for each dependent variable without each independent variable and with only each independent variable.
+        for i, outcome in enumerate(dependent_vars):
+            for j, regressor in enumerate(independent_vars):
+                features_dropped = np.delete(features, j + 1, axis=1)
+                regression = sm.OLS(outcomes[:, i], features_dropped).fit()
+
+                # Add results to full results dictionary.
+                results['independent'].append(regressor)
+                results['dependent'].append(outcome)
+                results['adj_rsquared_without'].append(regression.rsquared_adj)
+                results['rsquared_without'].append(regression.rsquared)
 
     results = pd.DataFrame(results).round(4)
     results = pd.merge(results, full_rsquared, on=['dependent'], how='left')
@@ -280,11 +605,201 @@ def rsquared_contribution(full_rsquared, df, independent_vars, dependent_vars, d
     return pd.DataFrame(results).round(4).sort_values(by=['dependent', 'rsquared_contribution_pct'], ascending=False)
 
 
-def residual_significance(df, independent_vars, controls, dependent_var, dummies, levels=4):
-    """Calculate the p-value for each residual for each independent variable."""
-    results = {'n_predictors': [], 'baseline': [], 'independent': [], 'dependent': [], 'coefficient': [], 'p-value': [], 'ssr': []}
+class ResidualFits:
+    """
+    Closed-form univariate fits of residual vectors against every candidate feature at once.
+
+    Each residual vector is fit against all candidates with a single matrix-vector product, and the fits are
+    memoized on the residual values so identical residuals reached along different paths are only fit once.
+
+    :param cache_size: Number of fits kept, the least recently used are dropped first. Each fit holds
+        n_samples + 3 * n_candidates floats. The search reuses a node's fit for all its children, which is free while
+        fewer than cache_size other residuals were fit in the meantime, see residual_cache_size.
+    """
+
+    def __init__(self, features, outcome, cache_size=1024, center=True):
+        self.n = features.shape[0]
+        self.outcome = outcome
+        # Features that are already centered, e.g. views onto shared memory, are used without copying.
+        self.centered = features - features.mean(axis=0) if center else features
+        self.sxx = (self.centered ** 2).sum(axis=0)
+        self.varying = self.sxx > 0
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        # The fitted values of every node are affine in its candidate, so their correlation with the outcome
+        # is the candidate's correlation with the outcome, signed by the fitted coefficient.
+        centered_outcome = outcome - outcome.mean()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            outcome_corrs = self.centered.T @ centered_outcome / np.sqrt(self.sxx * (centered_outcome @ centered_outcome))
+        self.outcome_corrs = np.nan_to_num(outcome_corrs, nan=0.0)
+
+    def fit(self, residuals):
+        """Return centered residuals plus coefficients, SSRs and p-values of fitting them to each candidate."""
+        key = hashlib.blake2b(residuals.tobytes(), digest_size=16).digest()
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        centered = residuals - residuals.mean()
+        sst = centered @ centered
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coefs = np.where(self.varying, self.centered.T @ centered / self.sxx, 0.0)
+            ssr = np.maximum(sst - coefs ** 2 * self.sxx, 0.0)
+            t_stats = coefs / np.sqrt(ssr / (self.n - 2) / self.sxx)
+        p_values = np.where(self.varying, 2 * stats.t.sf(np.abs(t_stats), self.n - 2), np.nan)
+
+        self.cache[key] = fits = (centered, coefs, ssr, p_values)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return fits
+
+    def correlation(self, coefs, i):
+        """Correlation of the outcome with the fitted values of candidate i."""
+        return np.sign(coefs[i]) * self.outcome_corrs[i]
+
+    def residuals(self, fits, i):
+        """Residuals left after fitting candidate i."""
+        centered, coefs, _, _ = fits
+        return centered - coefs[i] * self.centered[:, i]
+
+
+def select_candidates(fits, candidates, top_k=None):
+    """Keep the top_k candidates with the lowest SSR, in their original order."""
+    if top_k is None or len(candidates) <= top_k:
+        return candidates
+    ssr = fits[2]
+    return sorted(sorted(candidates, key=lambda i: ssr[i])[:top_k])
+
+
+def _log_node(logger, candidate, predictors, correlation, outcome, ssr):
+    if logger is None:
+        return
+    logger.debug('candidate %s from predictors %s', candidate, predictors)
+    logger.debug('  correlation outcomes with fitted values: %s', correlation)
+    logger.debug('  maximal var in data: %s', np.var(outcome) * len(outcome))
+    logger.debug('  var remaining %s', ssr)
+    logger.debug('  cor coeff: %s', sqrt(max(1 - ssr / np.var(outcome) / len(outcome), 0)))
+
+
+def residual_cache_size(n_candidates, levels):
+    """
+    ResidualFits cache size for a search of the given depth. A node's fit is kept while its children's subtrees are
+    searched if they have fewer nodes than this, which holds in the deepest levels where most nodes are. Nodes higher
+    up are fit again for each child, which adds about one fit per n_candidates fits, but memory stays linear in
+    n_candidates * levels instead of growing as n_candidates ** levels.
+    """
+    return n_candidates * (levels + 1)
+
+
+def _residual_search(residual_fits, independent_vars, roots, levels, max_pvalue=None, top_k=None, logger=None):
+    """Depth first search over ordered predictor paths, starting from the given root candidates."""
+    results = {'n_predictors': [], 'baseline': [], 'independent': [], 'coefficient': [], 'p-value': [], 'ssr': []}
+    search_frontier = [([], residual_fits.outcome, i) for i in roots]
+
+    while search_frontier:
+        predictors, residuals, i = search_frontier.pop()
+        fits = residual_fits.fit(residuals)
+        _, coefs, ssr, p_values = fits
+        correlation = residual_fits.correlation(coefs, i)
+        _log_node(logger, independent_vars[i], predictors, correlation, residual_fits.outcome, ssr[i])
+
+        results['n_predictors'].append(len(predictors) + 1)
+        results['baseline'].append(predictors)
+        results['independent'].append(independent_vars[i])
+        results['coefficient'].append(correlation)
+        results['p-value'].append(p_values[i])
+        results['ssr'].append(ssr[i])
+
+        if len(predictors) < levels and (max_pvalue is None or p_values[i] < max_pvalue):
+            updated_predictors = predictors + [independent_vars[i]]
+            new_residuals = residual_fits.residuals(fits, i)
+            remaining_candidates = [j for j, cand in enumerate(independent_vars) if cand not in updated_predictors]
+            if top_k is not None:
+                remaining_candidates = select_candidates(residual_fits.fit(new_residuals), remaining_candidates, top_k)
+            for j in remaining_candidates:
+                search_frontier.append((updated_predictors, new_residuals, j))
+
+    return results
+
+
+# Per-process state of residual_significance worker processes, set up by _attach_residual_fits.
+_worker_state = {}
+
+
+def _attach_residual_fits(features_name, outcome_name, shape, cache_size):
+    """Process pool initializer that maps the shared centered features and outcome into a ResidualFits."""
+    features_buffer = shared_memory.SharedMemory(name=features_name)
+    outcome_buffer = shared_memory.SharedMemory(name=outcome_name)
+    features = np.ndarray(shape, dtype=np.float64, buffer=features_buffer.buf)
+    outcome = np.ndarray(shape[:1], dtype=np.float64, buffer=outcome_buffer.buf)
+    _worker_state['buffers'] = (features_buffer, outcome_buffer)
+    _worker_state['residual_fits'] = ResidualFits(features, outcome, cache_size, center=False)
+
+
+def _search_subtree(independent_vars, root, levels, max_pvalue, top_k, logger):
+    return _residual_search(_worker_state['residual_fits'], independent_vars, [root], levels, max_pvalue, top_k, logger)
+
+
+def _parallel_residual_search(residual_fits, independent_vars, roots, levels, max_pvalue, top_k, logger, n_jobs):
+    """Run the subtree under each root candidate in a process pool, sharing the feature matrix through shared memory."""
+    buffers = []
+    try:
+        for array in (residual_fits.centered, residual_fits.outcome):
+            buffer = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=np.float64, buffer=buffer.buf)[:] = array
+            buffers.append(buffer)
+        with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                initializer=_attach_residual_fits,
+                initargs=(buffers[0].name, buffers[1].name, residual_fits.centered.shape, residual_fits.cache_size)) as executor:
+            # The serial search pops roots from the end of its stack, so visit them in reverse for identical ordering.
+            subtrees = list(executor.map(
+                _search_subtree,
+                *zip(*[(independent_vars, root, levels, max_pvalue, top_k, logger) for root in reversed(roots)])))
+    finally:
+        for buffer in buffers:
+            buffer.close()
+            buffer.unlink()
+
+    columns = ['n_predictors', 'baseline', 'independent', 'coefficient', 'p-value', 'ssr']
+    return {column: [value for subtree in subtrees for value in subtree[column]] for column in columns}
+
+
+@profiled('residual_significance')
+def residual_significance(df, independent_vars, controls, dependent_var, dummies, levels=4, engine='numpy',
+                          max_pvalue=None, top_k=None, logger=None, n_jobs=None):
+    """
+    Calculate the p-value for each residual for each independent variable.
+
+    :param engine: 'numpy' fits every node in closed form and shares fits between identical residuals,
+        'statsmodels' fits a separate sm.OLS per node.
+    :param max_pvalue: If set, only expand nodes whose p-value is below this threshold (numpy engine only).
+    :param top_k: If set, only keep the top_k lowest-SSR children of each node, and the top_k roots (numpy engine only).
+    :param logger: Optional logging.Logger that receives per-node diagnostics at debug level.
+    :param n_jobs: If greater than 1, search the subtrees under each root candidate in a pool of this many
+        processes (numpy engine only). Output is identical to the serial search.
+    """
     features, outcomes, all_dummies = process_features_targets(df, independent_vars + controls, [dependent_var], dummies)
 
+    if engine == 'numpy':
+        residual_fits = ResidualFits(features[:, :len(independent_vars)], outcomes[:, 0], residual_cache_size(len(independent_vars), levels))
+        roots = select_candidates(residual_fits.fit(residual_fits.outcome), list(range(len(independent_vars))), top_k)
+        if n_jobs is not None and n_jobs > 1:
+            results = _parallel_residual_search(residual_fits, independent_vars, roots, levels, max_pvalue, top_k, logger, n_jobs)
+        else:
+            results = _residual_search(residual_fits, independent_vars, roots, levels, max_pvalue, top_k, logger)
+        results['dependent'] = [dependent_var] * len(results['independent'])
+        count_fits(len(results['independent']))
+        results = pd.DataFrame(results)[['n_predictors', 'baseline', 'independent', 'dependent', 'coefficient', 'p-value', 'ssr']]
+        return results.round(4).sort_values(by=['n_predictors', 'ssr'], ascending=True)
+    elif engine != 'statsmodels':
+        raise ValueError('Engine must be either "numpy" or "statsmodels".')
+    if max_pvalue is not None or top_k is not None or n_jobs is not None:
+        raise ValueError('Pruning and n_jobs are only supported by the numpy engine.')
+
+    results = {'n_predictors': [], 'baseline': [], 'independent': [], 'dependent': [], 'coefficient': [], 'p-value': [], 'ssr': []}
+
     # Breadth first search where for every independent variable, try fitting its residual to all not-yet-modeled independent variables.
     search_frontier = [([], outcomes, v, i) for i, v in enumerate(independent_vars)]
     # Note: Not checking for visited paths because it turns out the order of the path does matter.
@@ -297,23 +812,7 @@ def residual_significance(df, independent_vars, controls, dependent_var, dummies
         correlation = r_regression(
                 X=outcomes,
                 y=regression.fittedvalues)
-        
-        print(f"candidate {candidate} from predictors {predictors}")
-
-        print(f"  correlation outcomes with fitted values: {correlation}")
-        
-        # print variation in outcomes:
-        print(f"  maximal var in data: {np.var(outcomes) * len(outcomes)}")
-        print(f"  var remaining {regression.ssr}")
-        print(f"'  cor' coeff: {sqrt(1 - regression.ssr / np.var(outcomes) / len(outcomes))}")
-
-        #print(f"predictors: {predictors}")
-        #print(f"residuals: {residuals}")
-        #print(f"regression: {regression}")
-        #print(f"target: {outcomes}")
-        #print(f"regression params: {regression.params}")
-        #print(f"new_residuals: {new_residuals}")
-        #assert False
+        _log_node(logger, candidate, predictors, correlation, outcomes, regression.ssr)
 
         # Add results to full results dictionary.
         results['baseline'].append(predictors)
@@ -330,23 +829,24 @@ def residual_significance(df, independent_vars, controls, dependent_var, dummies
             for new_candidate in remaining_candidates:
                 search_frontier.append((updated_predictors, new_residuals, new_candidate[1], new_candidate[0]))
 
+    count_fits(len(results['independent']))
     return pd.DataFrame(results).round(4).sort_values(by=['n_predictors', 'ssr'], ascending=True)
 
 
 if __name__ == '__main__':
-    df = pd.read_csv(pathlib.Path(__file__).parent.parent.resolve() / 'data_telemetry/survey_telemetry_merged_cleaned.csv').rename(columns=telemetry_name_mapping)
+    df = load_data(pathlib.Path(__file__).parent.parent.resolve() / 'data_telemetry/survey_telemetry_merged_cleaned.csv').rename(columns=telemetry_name_mapping)
     # F-regression for single variable
     f_regression_results = f_stat_regression(df, independent_vars + demographics_ordinal, dependent_vars, demographics_dummies)
 
     # Multivariate linear regression
-    ols_regression_results = multiple_regression('ols', df, independent_vars + demographics_ordinal, dependent_vars, demographics_dummies, verbose=False)
-    # ordinal_dependents = dependent_vars
-    # ordinal_dependents.remove('aggregate_productivity')
-    # ordinal_regression_results = multiple_regression('ordinal', df, independent_vars + demographics_ordinal, ordinal_dependents, demographics_dummies, verbose=True)
+    ols_regression_results = multiple_regression('ols', df, independent_vars + demographics_ordinal, [], dependent_vars, demographics_dummies, verbose=False)
+    # Multivariate ordinal regression for the Likert outcomes
+    ordinal_dependents = [d for d in dependent_vars if d != 'aggregate_productivity']
+    ordinal_regression_results = multiple_regression('ordinal', df, independent_vars + demographics_ordinal, [], ordinal_dependents, demographics_dummies, verbose=False)
 
     # Combine results and write out to CSV
     merged = pd.merge(f_regression_results, ols_regression_results, on=['independent', 'dependent'], how='outer')
-    # merged = pd.merge(merged, ordinal_regression_results, on=['independent', 'dependent'], how='outer')
+    merged = pd.merge(merged, ordinal_regression_results, on=['independent', 'dependent'], how='outer')
     merged.sort_values(by='independent').to_csv('outputs/analysis/regression_results.csv', index=False)
 
     # Print statistically significant results
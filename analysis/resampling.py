@@ -0,0 +1,286 @@
+"""
+resampling.py
+
+Bootstrap confidence intervals and permutation tests for the correlation and regression outputs.
+"""
+from collections import deque
+import numpy as np
+import pandas as pd
+from statsmodels.stats.multitest import multipletests
+
+from design_matrix import column_values
+from instrumentation import count_fits, profiled
+from regression import ols_fit, pairwise_correlation, process_features_targets
+import worker_pool
+
+# Largest number of permuted values gathered at once by permuted_correlations, bounding its memory whatever the chunk size.
+permutation_block_size = 1 << 22
+
+
+def replicate_seeds(n_replicates, seed=None):
+    """
+    One child seed per replicate, spawned from a single root seed. Replicate i draws the same sample
+    whatever the chunking or number of processes.
+    """
+    return np.random.SeedSequence(seed).spawn(n_replicates)
+
+
+def bootstrap_indices(seeds, n):
+    """Index matrix of shape (replicates, n), one row of row indices drawn with replacement per seed."""
+    return np.stack([np.random.default_rng(s).integers(0, n, n) for s in seeds])
+
+
+def permutation_indices(seeds, n):
+    """Index matrix of shape (permutations, n), one permutation of the rows per seed."""
+    return np.stack([np.random.default_rng(s).permutation(n) for s in seeds])
+
+
+def standardize_columns(values, n_columns):
+    """Scale the first n_columns to zero mean and unit variance, leaving columns without variance centered."""
+    values = values.copy()
+    means = values[:, :n_columns].mean(axis=0)
+    stds = values[:, :n_columns].std(axis=0)
+    values[:, :n_columns] = (values[:, :n_columns] - means) / np.where(stds > 0, stds, 1)
+    return values
+
+
+def correlation_replicates(indices, x, y):
+    """Pairwise-complete correlations of every bootstrap sample, shaped (replicates, y columns, x columns)."""
+    return np.stack([pairwise_correlation(x[rows], y[rows])[0].T for rows in indices])
+
+
+def ols_replicates(indices, features, outcomes, n_standardized):
+    """
+    Coefficients and R² of every bootstrap sample, refitting all outcomes from one factorization per sample.
+    The first n_standardized features are rescaled within each sample, as for the full sample.
+    Returns coefficients shaped (replicates, outcomes, features) and R² shaped (replicates, outcomes).
+    """
+    params, rsquared = [], []
+    for rows in indices:
+        sample = standardize_columns(features[rows], n_standardized)
+        fit = ols_fit(np.column_stack([np.ones(len(rows)), sample]), outcomes[rows])
+        params.append(fit['params'][1:].T)  # Drop intercept coefficient.
+        rsquared.append(fit['rsquared'])
+    return np.stack(params), np.stack(rsquared)
+
+
+def _run_chunk(seeds):
+    state = dict(worker_pool.shared_state)
+    statistic = state.pop('statistic')
+    draw = state.pop('draw')
+    return statistic(draw(seeds, state.pop('n')), **state)
+
+
+def iter_chunks(statistic, state, seeds, n_jobs=None, chunk_size=100, draw=bootstrap_indices):
+    """
+    Evaluate a replicate statistic over resampled rows in chunks, yielding each chunk's result in order.
+    Only a couple of chunks per process are queued ahead, so closing the iterator early skips the rest.
+
+    :param statistic: Function of (indices, **state) returning an array, or tuple of arrays, with one row per replicate.
+    :param state: Keyword arguments passed to statistic, including the number of rows 'n' to resample.
+    :param seeds: One seed per replicate, from replicate_seeds.
+    :param n_jobs: Number of processes. Chunks run in this process if None.
+    :param chunk_size: Number of replicates whose index matrix is drawn and evaluated at once.
+    :param draw: Function of (seeds, n) returning the index matrix of a chunk.
+    """
+    chunks = [seeds[start:start + chunk_size] for start in range(0, len(seeds), chunk_size)]
+    state = dict(state, statistic=statistic, draw=draw)
+    if n_jobs is None:
+        with worker_pool.local_state(state):
+            for chunk in chunks:
+                yield _run_chunk(chunk)
+        return
+
+    executor = worker_pool.executor(state, n_jobs)
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_run_chunk, chunk))
+            if len(pending) > 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def run_replicates(statistic, state, n_replicates, seed=None, n_jobs=None, chunk_size=100):
+    """Evaluate a replicate statistic over bootstrap samples, see iter_chunks, and concatenate the replicates."""
+    results = list(iter_chunks(statistic, state, replicate_seeds(n_replicates, seed), n_jobs, chunk_size))
+    if isinstance(results[0], tuple):
+        return tuple(np.concatenate(parts) for parts in zip(*results))
+    return np.concatenate(results)
+
+
+def percentile_interval(replicates, confidence=0.95):
+    """Lower and upper percentile bounds over the first axis, ignoring replicates where a statistic is undefined."""
+    tail = 100 * (1 - confidence) / 2
+    with np.errstate(invalid='ignore'):
+        return np.nanpercentile(replicates, [tail, 100 - tail], axis=0)
+
+
+@profiled('bootstrap_correlation')
+def bootstrap_correlation(df, independent_vars, dependent_vars, n_replicates=1000, confidence=0.95, seed=None, n_jobs=None, chunk_size=100):
+    """
+    Bootstrap percentile intervals for the correlations reported by regression.f_stat_regression, with missing values
+    dropped pairwise within each sample.
+    """
+    count_fits(n_replicates * len(independent_vars) * len(dependent_vars))
+    x = column_values(df, independent_vars)
+    y = column_values(df, dependent_vars)
+    print(f'Running {n_replicates} bootstrap replicates of {x.shape[1] * y.shape[1]} correlations on {x.shape[0]} samples.')
+    corrs = run_replicates(correlation_replicates, {'n': x.shape[0], 'x': x, 'y': y}, n_replicates, seed, n_jobs, chunk_size)
+    lower, upper = percentile_interval(corrs, confidence)
+    return pd.DataFrame({
+        'independent': independent_vars * len(dependent_vars),
+        'dependent': np.repeat(dependent_vars, len(independent_vars)),
+        'corr_coef_ci_lower': lower.ravel(),
+        'corr_coef_ci_upper': upper.ravel()}).round(4)
+
+
+@profiled('bootstrap_ols')
+def bootstrap_ols(df, independent_vars, controls, dependent_vars, dummies, standardize=True, n_replicates=1000, confidence=0.95,
+                  seed=None, n_jobs=None, chunk_size=100):
+    """
+    Bootstrap percentile intervals for the OLS coefficients and R² reported by regression.multiple_regression.
+    """
+    count_fits(n_replicates * len(dependent_vars))
+    # Rescaling the standardized features within each sample is the same as standardizing that sample of the raw features.
+    features, outcomes, all_dummies = process_features_targets(df, independent_vars + controls, dependent_vars, dummies, standardize)
+    predictors = independent_vars + controls + all_dummies
+    n_standardized = len(independent_vars + controls) if standardize else 0
+    print(f'Running {n_replicates} bootstrap replicates of ols regression on {features.shape[0]} samples.')
+    params, rsquared = run_replicates(
+        ols_replicates,
+        {'n': features.shape[0], 'features': features, 'outcomes': outcomes, 'n_standardized': n_standardized},
+        n_replicates, seed, n_jobs, chunk_size)
+    params_lower, params_upper = percentile_interval(params, confidence)
+    rsquared_lower, rsquared_upper = percentile_interval(rsquared, confidence)
+    return pd.DataFrame({
+        'independent': predictors * len(dependent_vars),
+        'dependent': np.repeat(dependent_vars, len(predictors)),
+        'ols_coefficient_ci_lower': params_lower.ravel(),
+        'ols_coefficient_ci_upper': params_upper.ravel(),
+        'ols_model_rsquared_ci_lower': np.repeat(rsquared_lower, len(predictors)),
+        'ols_model_rsquared_ci_upper': np.repeat(rsquared_upper, len(predictors))}).round(4)
+
+
+def unit_columns(values):
+    """Center columns and scale them to unit norm, so products of columns are correlations."""
+    values = values - values.mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values / np.sqrt((values ** 2).sum(axis=0))
+
+
+def correlation_blocks(values, masked):
+    """
+    Columns of values prepared once for permuted_correlations. Without missing values these are unit columns. With
+    masked=True they are the masks of present values, the values centered and zeroed where missing, and their squares,
+    side by side, so products with another set of blocks give every pairwise-complete sum of a correlation.
+    """
+    if not masked:
+        return unit_columns(values)
+    present = ~np.isnan(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Shift by column means so the masked sums stay well conditioned, as in pairwise_correlation.
+        centered = np.where(present, values - np.nansum(values, axis=0) / present.sum(axis=0), 0.0)
+    return np.column_stack([present.astype(float), centered, centered ** 2])
+
+
+def permuted_correlations(indices, x, y, masked):
+    """
+    Correlations of x with the rows of y taken in the order of each row of indices, shaped (permutations, y columns,
+    x columns), from blocks of correlation_blocks. Only the permuted rows of y are gathered, in batches of at most
+    permutation_block_size values, and each batch takes a single matrix product per sum.
+    """
+    n_permutations, n = indices.shape
+    q = y.shape[1] // 3 if masked else y.shape[1]
+    batch = max(1, permutation_block_size // (n * y.shape[1]))
+    corrs = []
+    for start in range(0, n_permutations, batch):
+        rows = indices[start:start + batch]
+        permuted = y[rows].transpose(1, 0, 2)
+        if not masked:
+            corrs.append((x.T @ permuted.reshape(n, -1)).reshape(x.shape[1], len(rows), q).transpose(1, 2, 0))
+            continue
+        p = x.shape[1] // 3
+        present, centered, squared = (permuted[:, :, k * q:(k + 1) * q].reshape(n, -1) for k in range(3))
+        # Sums over the rows where both variables of a pair are present, as in pairwise_correlation.
+        n_pairs, sum_x, sum_xx = (x.T @ present).reshape(3, p, len(rows), q)
+        sum_y, sum_yy = (x[:, :p].T @ np.column_stack([centered, squared])).reshape(p, 2, len(rows), q).transpose(1, 0, 2, 3)
+        sum_xy = (x[:, p:2 * p].T @ centered).reshape(p, len(rows), q)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = sum_xy - sum_x * sum_y / n_pairs
+            var_x = sum_xx - sum_x ** 2 / n_pairs
+            var_y = sum_yy - sum_y ** 2 / n_pairs
+            corrs.append(np.clip(cov / np.sqrt(var_x * var_y), -1, 1).transpose(1, 2, 0))
+    return np.concatenate(corrs)
+
+
+def permuted_correlation_counts(indices, x, y, masked, observed):
+    """
+    Correlations of x with every row permutation of y, see permuted_correlations. Returns, per pair, how many
+    permutations reach the observed absolute correlation, shaped (y columns, x columns), and the largest absolute
+    correlation of each permutation.
+    """
+    corrs = np.abs(np.nan_to_num(permuted_correlations(indices, x, y, masked), nan=0.0))
+    return (corrs >= observed - 1e-12).sum(axis=0), corrs.reshape(len(indices), -1).max(axis=1)
+
+
+@profiled('permutation_correlation')
+def permutation_correlation(df, independent_vars, dependent_vars, n_permutations=1000, seed=None, n_jobs=None, chunk_size=100,
+                            precision=None, alpha=0.05):
+    """
+    Permutation tests for the correlations reported by regression.f_stat_regression. Outcome rows are permuted jointly,
+    keeping the dependence between outcomes and between predictors, for:
+    * corr_perm_p_value: the share of permutations whose absolute correlation reaches the observed one.
+    * corr_maxt_p_value: the same against the largest absolute correlation over all pairs, controlling the family-wise error rate.
+    * corr_fdr_bh_p_value: corr_perm_p_value adjusted with Benjamini-Hochberg to control the false discovery rate.
+
+    Missing values are dropped pairwise, as for the observed correlations. The masked and centered columns are
+    prepared once, and each permutation only reorders the rows of the outcomes' columns.
+
+    :param precision: If set, stop once every p-value has a Monte Carlo standard error below precision, or is more than
+        three standard errors away from alpha, checking after each chunk of permutations.
+    """
+    x = column_values(df, independent_vars)
+    y = column_values(df, dependent_vars)
+    masked = bool(np.isnan(x).any() or np.isnan(y).any())
+    x, y = correlation_blocks(x, masked), correlation_blocks(y, masked)
+    n = x.shape[0]
+    observed = np.abs(np.nan_to_num(permuted_correlations(np.arange(n)[None], x, y, masked)[0], nan=0.0))
+    print(f'Running up to {n_permutations} permutations of {observed.size} correlations on {n} samples.')
+
+    exceed = np.zeros(observed.shape, dtype=int)
+    maxt_exceed = np.zeros(observed.shape, dtype=int)
+    done = 0
+    chunks = iter_chunks(
+        permuted_correlation_counts,
+        {'n': n, 'x': x, 'y': y, 'masked': masked, 'observed': observed},
+        replicate_seeds(n_permutations, seed), n_jobs, chunk_size, draw=permutation_indices)
+    for counts, max_corrs in chunks:
+        exceed += counts
+        maxt_exceed += (max_corrs[:, None, None] >= observed - 1e-12).sum(axis=0)
+        done += len(max_corrs)
+        if precision is not None:
+            p_values = np.stack([(exceed + 1) / (done + 1), (maxt_exceed + 1) / (done + 1)])
+            se = np.sqrt(p_values * (1 - p_values) / done)
+            if ((se <= precision) | (np.abs(p_values - alpha) > 3 * se)).all():
+                chunks.close()
+                break
+    print(f'Stopped after {done} permutations.')
+    count_fits(done * observed.size)
+
+    perm_p_values = ((exceed + 1) / (done + 1)).ravel()
+    return pd.DataFrame({
+        'independent': independent_vars * len(dependent_vars),
+        'dependent': np.repeat(dependent_vars, len(independent_vars)),
+        'n_permutations': done,
+        'corr_perm_p_value': perm_p_values,
+        'corr_maxt_p_value': ((maxt_exceed + 1) / (done + 1)).ravel(),
+        'corr_fdr_bh_p_value': multipletests(perm_p_values, method='fdr_bh')[1]}).round(4)
+
+
+def merge_pairs(results, pair_results):
+    """Merge columns computed per (independent, dependent) pair into a result table, keeping its row order."""
+    return results.merge(pair_results, on=['independent', 'dependent'], how='left')
@@ -0,0 +1,109 @@
+"""
+rolling.py
+
+Correlations and OLS fits over rolling or expanding windows of survey date, to track how the relationships between
+telemetry metrics and survey outcomes drift over time.
+"""
+import numpy as np
+import pathlib
+import pandas as pd
+
+from instrumentation import count_fits, profiled
+from process_data import load_data
+from regression import correlation_f_test
+from sufficient_stats import SufficientStats
+from survey_schema import matching_columns
+from variables import demographics_dummies, telemetry_name_mapping
+
+
+def window_rows(dates, window, step, expanding=False):
+    """
+    Windows ending every step from the first full window onwards, as (start, end, first row, end row). Rolling windows
+    cover the dates in [end - window, end), so the first one starts with the earliest responses, and expanding windows
+    every date before end. The last window ends after the latest date.
+
+    :param dates: Sorted dates.
+    """
+    window, step = pd.Timedelta(window), pd.Timedelta(step)
+    ends = pd.date_range(dates[0] + window, dates[-1] + step, freq=step)
+    if not len(ends):
+        # All dates fall within a single window.
+        ends = pd.DatetimeIndex([dates[0] + window])
+    starts = ends - window
+    first = np.zeros(len(ends), dtype=int) if expanding else np.searchsorted(dates, starts, side='left')
+    last = np.searchsorted(dates, ends, side='left')
+    return [(dates[0] if expanding else start, end, lo, hi) for start, end, lo, hi in zip(starts, ends, first, last)]
+
+
+@profiled('rolling_analysis')
+def rolling_analysis(df, independent_vars, controls, dependent_var, dummies, window='30D', step='7D', expanding=False,
+                     standardize=True, min_size=30, date_column='Start Date'):
+    """
+    Correlations of every independent variable with the outcome and an OLS model of the outcome on all of them, as
+    regression.f_stat_regression and regression.multiple_regression compute them, within each window of survey date.
+
+    Sufficient statistics are updated as the window slides, adding the rows that enter it and subtracting the rows
+    that leave it, so each row is accumulated at most twice however much windows overlap.
+
+    :param window: Length of rolling windows, as a pandas Timedelta string.
+    :param step: Time between the ends of consecutive windows.
+    :param expanding: If True, every window starts at the first survey response.
+    :param min_size: Windows with fewer respondents are skipped.
+    :return: One row per window and independent variable with the window's start and end, the number of respondents
+        in it, the pairwise n, correlation and p-value, and the OLS coefficient, p-value, model R² and model n.
+    """
+    dates = pd.to_datetime(df[date_column])
+    df = df[dates.notna().to_numpy()].iloc[np.argsort(dates.dropna().to_numpy(), kind='stable')]
+    dates = pd.to_datetime(df[date_column]).to_numpy()
+    all_dummies = matching_columns(df.columns, dummies)
+    columns = list(dict.fromkeys(independent_vars + controls + [dependent_var] + all_dummies))
+    values = df[columns].to_numpy(dtype=float)
+    # Centering on the overall means keeps the sums small, so subtracting rows that leave the window stays accurate.
+    shift = np.nan_to_num(np.nanmean(values, axis=0))
+    windows = window_rows(dates, window, step, expanding)
+    print(f'Running rolling analysis over {len(windows)} windows of {len(df)} samples.')
+
+    results = {'window_start': [], 'window_end': [], 'n_window': [], 'independent': [], 'dependent': [], 'n': [],
+               'corr_coef': [], 'corr_p_value': [], 'ols_coefficient': [], 'ols_t_p-value': [], 'ols_model_rsquared': [],
+               'ols_nobs': []}
+    accumulator = SufficientStats(columns, shift=shift)
+    lo, hi = 0, 0
+    for start, end, first, last in windows:
+        if first >= hi:
+            # The window moved past every accumulated row.
+            accumulator = SufficientStats(columns, shift=shift).update(values[first:last])
+        else:
+            accumulator.update(values[hi:last])
+            if first > lo:
+                accumulator = accumulator - SufficientStats(columns, shift=shift).update(values[lo:first])
+        lo, hi = first, last
+        if last - first < min_size:
+            continue
+
+        corrs, n = accumulator.pairwise_correlation(independent_vars, [dependent_var])
+        _, p_values = correlation_f_test(corrs, n)
+        predictors = independent_vars + controls + accumulator.get_dummies(dummies)
+        fit = accumulator.ols_fit(predictors, [dependent_var], len(independent_vars + controls) if standardize else 0)
+        count_fits(len(independent_vars) + 1)
+
+        k = len(independent_vars)
+        results['window_start'] += [start] * k
+        results['window_end'] += [end] * k
+        results['n_window'] += [last - first] * k
+        results['independent'] += independent_vars
+        results['dependent'] += [dependent_var] * k
+        results['n'] += n[:, 0].tolist()
+        results['corr_coef'] += np.nan_to_num(corrs[:, 0], nan=0.0).tolist()
+        results['corr_p_value'] += p_values[:, 0].tolist()
+        results['ols_coefficient'] += fit['params'][:k, 0].tolist()
+        results['ols_t_p-value'] += fit['pvalues'][:k, 0].tolist()
+        results['ols_model_rsquared'] += [fit['rsquared'][0]] * k
+        results['ols_nobs'] += [fit['nobs']] * k
+    return pd.DataFrame(results).round(4)
+
+
+if __name__ == '__main__':
+    df = load_data(pathlib.Path(__file__).parent.parent.resolve() / 'data_telemetry/survey_telemetry_merged_cleaned.csv').rename(columns=telemetry_name_mapping)
+    metrics = ['accepted_per_shown', 'accepted_per_opportunity', 'accepted_char_per_active_hour']
+    rolling_analysis(df, metrics, [], 'aggregate_productivity', demographics_dummies).to_csv('outputs/analysis/rolling.csv', index=False)
+    rolling_analysis(df, metrics, [], 'aggregate_productivity', demographics_dummies, expanding=True).to_csv('outputs/analysis/expanding.csv', index=False)
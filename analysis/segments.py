@@ -0,0 +1,91 @@
+"""
+segments.py
+
+Correlations and regressions run separately within demographic segments of the respondents.
+"""
+import numpy as np
+import pathlib
+import pandas as pd
+
+from design_matrix import DesignMatrix
+from instrumentation import profiled
+from process_data import load_data
+from regression import f_stat_regression, multiple_regression
+from resampling import merge_pairs
+from survey_schema import matching_columns
+from variables import independent_vars, dependent_vars, demographics_dummies, demographics_ordinal, telemetry_name_mapping
+import worker_pool
+
+# Dummies of the languages respondents usually use, one segment per language.
+language_dummies = [var for var in demographics_dummies if 'programming languages' in var]
+
+
+def segment_rows(df, ordinal_vars=demographics_ordinal, dummies=language_dummies):
+    """
+    Rows of each segment: one per value of each ordinal variable, and one per dummy column of the given variables
+    with the rows where it is 1. Segments of different variables overlap.
+
+    :return: Dict mapping segment labels, e.g. 'programming_experience=3' or the dummy column name, to row positions.
+    """
+    segments = {}
+    for var in ordinal_vars:
+        values = df[var].to_numpy(dtype=float)
+        for value in np.unique(values[~np.isnan(values)]):
+            segments[f'{var}={value:g}'] = np.flatnonzero(values == value)
+    for column in matching_columns(df.columns, dummies):
+        segments[column] = np.flatnonzero(df[column].to_numpy(dtype=float) == 1)
+    return segments
+
+
+def analyze_segment(rows):
+    """Correlations and a multiple regression of the segment's rows, from the worker state set by segment_analysis."""
+    state = worker_pool.shared_state
+    design = DesignMatrix(state['df'].iloc[rows])
+    correlations = f_stat_regression(design, state['independent_vars'], state['dependent_vars'])
+    regressions = multiple_regression(state['model_type'], design, state['independent_vars'], state['controls'],
+                                      state['dependent_vars'], state['dummies'], verbose=False)
+    return merge_pairs(regressions, correlations)
+
+
+@profiled('segment_analysis')
+def segment_analysis(df, independent_vars, controls, dependent_vars, dummies, model_type='ols', segments=None, min_size=30, n_jobs=None):
+    """
+    regression.f_stat_regression and regression.multiple_regression within each segment, in one table with a
+    'segment' and a 'segment_size' column. Dummies that are constant within a segment, such as the segment's own
+    dummy, are dropped from its models.
+
+    :param segments: Dict of segment labels to row positions. Defaults to segment_rows(df).
+    :param min_size: Segments with fewer respondents are skipped.
+    :param n_jobs: Number of processes to analyze segments in. Segments are analyzed in this process if None.
+    """
+    segments = segment_rows(df) if segments is None else segments
+    skipped = {label: len(rows) for label, rows in segments.items() if len(rows) < min_size}
+    if skipped:
+        print(f'Skipping {len(skipped)} segments with fewer than {min_size} respondents: {skipped}')
+    segments = {label: rows for label, rows in segments.items() if label not in skipped}
+
+    columns = list(dict.fromkeys(independent_vars + controls + dependent_vars + matching_columns(df.columns, dummies)))
+    state = {
+        'df': df[columns],
+        'independent_vars': independent_vars,
+        'controls': controls,
+        'dependent_vars': dependent_vars,
+        'dummies': dummies,
+        'model_type': model_type}
+    if n_jobs is None:
+        with worker_pool.local_state(state):
+            segment_results = [analyze_segment(rows) for rows in segments.values()]
+    else:
+        with worker_pool.executor(state, n_jobs) as executor:
+            segment_results = list(executor.map(analyze_segment, segments.values()))
+
+    for (label, rows), results in zip(segments.items(), segment_results):
+        results.insert(0, 'segment', label)
+        results.insert(1, 'segment_size', len(rows))
+    return pd.concat(segment_results, ignore_index=True)
+
+
+if __name__ == '__main__':
+    df = load_data(pathlib.Path(__file__).parent.parent.resolve() / 'data_telemetry/survey_telemetry_merged_cleaned.csv').rename(columns=telemetry_name_mapping)
+    segment_results = segment_analysis(df, independent_vars, [], dependent_vars, demographics_dummies)
+    segment_results.to_csv('outputs/analysis/segments.csv', index=False)
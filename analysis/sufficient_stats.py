@@ -0,0 +1,196 @@
+"""
+sufficient_stats.py
+
+Sufficient statistics for correlations and OLS, accumulated chunk by chunk so regressions can be solved without
+holding row-level data in memory.
+"""
+import numpy as np
+from scipy import stats
+
+from design_matrix import column_values
+from survey_schema import matching_columns
+
+
+class SufficientStats:
+    """
+    Counts, sums and cross-products of a fixed set of columns, accumulated over chunks of rows.
+
+    Two kinds of statistics are kept:
+    * Pairwise-complete: for every pair of columns, the number of rows where both are present and the sums, sums of
+      squares and cross-products over those rows. These give the correlations of regression.f_stat_regression.
+    * Complete-case: the count, sums and Gram matrix of complete_columns over rows where all of them are present.
+      These give the OLS fits of regression.multiple_regression and regression.rsquared_contribution, which drop rows
+      with a missing value in any model column. To match them exactly, complete_columns should be the model's columns.
+
+    Accumulators over the same columns can be added to merge shards, or subtracted to remove rows added earlier.
+
+    :param columns: Columns to accumulate.
+    :param complete_columns: Columns for the complete-case statistics. Defaults to all columns.
+    :param shift: Optional per-column values, e.g. rough means, subtracted before accumulating so that sums of squares
+        of large values stay well conditioned. Defaults to zero.
+    """
+
+    def __init__(self, columns, complete_columns=None, shift=None):
+        self.columns = list(columns)
+        self.complete_columns = self.columns if complete_columns is None else list(complete_columns)
+        self.positions = {column: i for i, column in enumerate(self.columns)}
+        missing = [column for column in self.complete_columns if column not in self.positions]
+        if missing:
+            raise ValueError(f'Complete-case columns must be accumulated columns: {missing}')
+        self.complete_positions = {column: i for i, column in enumerate(self.complete_columns)}
+        k, k_complete = len(self.columns), len(self.complete_columns)
+        self.shift = np.zeros(k) if shift is None else np.asarray(shift, dtype=float)
+
+        self.count = np.zeros((k, k))
+        self.sums = np.zeros((k, k))
+        self.sums_sq = np.zeros((k, k))
+        self.cross = np.zeros((k, k))
+        self.n_complete = 0
+        self.complete_sums = np.zeros(k_complete)
+        self.complete_gram = np.zeros((k_complete, k_complete))
+
+    def update(self, data):
+        """
+        Add the rows of a DataFrame or DesignMatrix, or of an array whose columns are self.columns. Returns self.
+        """
+        values = data if isinstance(data, np.ndarray) else column_values(data, self.columns)
+        values = values - self.shift
+        present = ~np.isnan(values)
+        weights = present.astype(float)
+        values = np.where(present, values, 0.0)
+
+        # sums[i, j] is the sum of column i over rows where column j is also present, likewise sums_sq.
+        self.count += weights.T @ weights
+        self.sums += values.T @ weights
+        self.sums_sq += (values ** 2).T @ weights
+        self.cross += values.T @ values
+
+        complete_index = [self.positions[column] for column in self.complete_columns]
+        rows = present[:, complete_index].all(axis=1)
+        complete = values[rows][:, complete_index]
+        self.n_complete += int(rows.sum())
+        self.complete_sums += complete.sum(axis=0)
+        self.complete_gram += complete.T @ complete
+        return self
+
+    def _check_compatible(self, other):
+        if self.columns != other.columns or self.complete_columns != other.complete_columns or not np.array_equal(self.shift, other.shift):
+            raise ValueError('Accumulators must have the same columns, complete-case columns and shift.')
+
+    def _combine(self, other, sign):
+        self._check_compatible(other)
+        combined = SufficientStats(self.columns, self.complete_columns, self.shift)
+        for name in ('count', 'sums', 'sums_sq', 'cross', 'n_complete', 'complete_sums', 'complete_gram'):
+            setattr(combined, name, getattr(self, name) + sign * getattr(other, name))
+        return combined
+
+    def __add__(self, other):
+        return self._combine(other, 1)
+
+    def __sub__(self, other):
+        return self._combine(other, -1)
+
+    def merge(self, other):
+        """Merge another accumulator, e.g. of a different shard, into a new one."""
+        return self + other
+
+    def save(self, path):
+        """Save the accumulator to an .npz file."""
+        np.savez(
+            path, columns=np.array(self.columns, dtype=object), complete_columns=np.array(self.complete_columns, dtype=object),
+            shift=self.shift, count=self.count, sums=self.sums, sums_sq=self.sums_sq, cross=self.cross,
+            n_complete=self.n_complete, complete_sums=self.complete_sums, complete_gram=self.complete_gram)
+
+    @classmethod
+    def load(cls, path):
+        """Load an accumulator saved with save."""
+        with np.load(path, allow_pickle=True) as saved:
+            accumulator = cls(saved['columns'].tolist(), saved['complete_columns'].tolist(), saved['shift'])
+            for name in ('count', 'sums', 'sums_sq', 'cross', 'complete_sums', 'complete_gram'):
+                setattr(accumulator, name, saved[name])
+            accumulator.n_complete = int(saved['n_complete'])
+        return accumulator
+
+    def get_dummies(self, covariates):
+        """Dummy column names for the specified variables, dropping zero-variance values, as in regression.get_dummies."""
+        columns = matching_columns(self.columns, covariates)
+        index = [self.positions[column] for column in columns]
+        n = np.diag(self.count)[index]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = np.diag(self.sums_sq)[index] - np.diag(self.sums)[index] ** 2 / n
+        return [column for column, var in zip(columns, variance) if var > 1e-12 * max(n.max(), 1)]
+
+    def pairwise_correlation(self, x_columns, y_columns):
+        """
+        Pairwise-complete correlations and sample counts of every pair, shaped (x columns, y columns), as
+        regression.pairwise_correlation computes them from rows.
+        """
+        x = [self.positions[column] for column in x_columns]
+        y = [self.positions[column] for column in y_columns]
+        grid = np.ix_(x, y)
+        n = self.count[grid]
+        sum_x, sum_y = self.sums[grid], self.sums.T[grid]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = self.cross[grid] - sum_x * sum_y / n
+            var_x = self.sums_sq[grid] - sum_x ** 2 / n
+            var_y = self.sums_sq.T[grid] - sum_y ** 2 / n
+            corrs = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
+        return corrs, n.round().astype(int)
+
+    def ols_fit(self, feature_columns, outcome_columns, n_standardized=0):
+        """
+        OLS with an intercept of every outcome on the same features from the complete-case Gram matrix, as
+        regression.ols_fit on the rows of process_features_targets. The first n_standardized features are scaled to
+        unit variance, which rescales their coefficients and standard errors. Coefficient statistics are shaped
+        (features, outcomes) and exclude the intercept.
+        """
+        missing = [column for column in feature_columns + outcome_columns if column not in self.complete_positions]
+        if missing:
+            raise ValueError(f'Columns are not among the complete-case columns of the accumulator: {missing}')
+        features = [self.complete_positions[column] for column in feature_columns]
+        outcomes = [self.complete_positions[column] for column in outcome_columns]
+        n = self.n_complete
+        # Centering removes the intercept and the shift.
+        means = self.complete_sums / n
+        centered = self.complete_gram - n * np.outer(means, means)
+        c_xx = centered[np.ix_(features, features)]
+        c_xy = centered[np.ix_(features, outcomes)]
+        c_yy = np.diag(centered)[outcomes]
+
+        scales = np.ones(len(features))
+        scales[:n_standardized] = np.sqrt(np.diag(c_xx)[:n_standardized] / n)
+        scales = np.where(scales > 0, scales, 1)
+        c_xx = c_xx / np.outer(scales, scales)
+        c_xy = c_xy / scales[:, None]
+
+        eigenvalues = np.linalg.eigvalsh(c_xx) if len(features) else np.array([])
+        rank = int((eigenvalues > 1e-10 * max(eigenvalues.max(initial=0), 1e-300)).sum()) + 1  # Plus the intercept.
+        normalized_cov = np.linalg.pinv(c_xx, hermitian=True)
+        params = normalized_cov @ c_xy
+        ssr = c_yy - (params * c_xy).sum(axis=0)
+        df_resid = n - rank
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bse = np.sqrt(np.outer(np.diag(normalized_cov), ssr / df_resid))
+            pvalues = 2 * stats.t.sf(np.abs(params / bse), df_resid)
+            rsquared = 1 - ssr / c_yy
+        return {
+            'params': params,
+            'bse': bse,
+            'pvalues': pvalues,
+            'ssr': ssr,
+            'centered_tss': c_yy,
+            'rsquared': rsquared,
+            'rsquared_adj': 1 - (n - 1) / df_resid * (1 - rsquared),
+            'df_resid': df_resid,
+            'rank': rank,
+            'normalized_cov': normalized_cov,
+            'nobs': n,
+        }
+
+
+def accumulate(chunks, columns, complete_columns=None, shift=None):
+    """Accumulate SufficientStats over an iterable of DataFrame chunks, e.g. from process_data.iter_telemetry."""
+    accumulator = SufficientStats(columns, complete_columns, shift)
+    for chunk in chunks:
+        accumulator.update(chunk)
+    return accumulator
@@ -0,0 +1,88 @@
+"""
+survey_schema.py
+
+Parses the two-row survey header once into flattened column names and an index from each question to its
+answer columns. Schemas and column lookups are cached per header signature, so repeated lookups do not rescan columns.
+"""
+from functools import lru_cache
+
+agreement_prefix = 'Thinking of your experience using Copilot so far, please indicate your level of agreement with the following statements.'
+
+
+class SurveySchema:
+    """Flattened survey columns plus an index from question text to the columns holding its answers."""
+
+    def __init__(self, columns, questions=None):
+        self.columns = list(columns)
+        self.column_set = set(self.columns)
+        self.questions = questions or {}
+        self._answer_columns = {}
+
+    def answer_columns(self, text):
+        """
+        Columns holding the answers to a question. Looks the question up in the header index, falling back to all
+        columns containing the text. Raises a ValueError if nothing matches.
+        """
+        if text not in self._answer_columns:
+            columns = self.questions.get(text) or [col for col in self.columns if text in col]
+            if not columns:
+                raise ValueError(f'Survey question not found in header: "{text}"')
+            self._answer_columns[text] = columns
+        return self._answer_columns[text]
+
+    def likert_columns(self, statement, answers):
+        """Columns holding each answer to an agreement statement, named '<statement> - <answer>'."""
+        columns = [f'{statement} - {answer}' for answer in answers]
+        missing = [col for col in columns if col not in self.column_set]
+        if missing:
+            raise ValueError(f'Survey statement "{statement}" is missing answer columns: {missing}')
+        return columns
+
+
+@lru_cache(maxsize=None)
+def compile_header(header):
+    """
+    Flatten a two-row survey header, given as a tuple of (question, response) pairs, into a SurveySchema.
+
+    Answers inherit the last named question. Statements of the agreement grid have the grid prompt stripped,
+    so their columns are named after the statement and indexed under it.
+    """
+    last_question = None
+    columns = []
+    questions = {}
+    for question, response in header:
+        question = question.replace(agreement_prefix, '')
+        if 'Unnamed:' not in question:
+            last_question = question
+        response = '' if 'Unnamed:' in response else response
+        if last_question and response:
+            column = f'{last_question}-{response}'
+        elif last_question:
+            column = last_question
+        else:
+            column = response
+        columns.append(column)
+
+        if last_question:
+            questions.setdefault(last_question, []).append(column)
+        elif ' - ' in response:
+            questions.setdefault(response.rsplit(' - ', 1)[0], []).append(column)
+    return SurveySchema(columns, questions)
+
+
+@lru_cache(maxsize=None)
+def schema_for_columns(columns):
+    """SurveySchema for already flattened columns, given as a tuple, where lookups match on column text."""
+    return SurveySchema(columns)
+
+
+def matching_columns(columns, texts):
+    """
+    Columns containing any of the given texts, in column order. Cached per column signature and texts.
+    """
+    return list(_matching_columns(tuple(columns), tuple(texts)))
+
+
+@lru_cache(maxsize=256)
+def _matching_columns(columns, texts):
+    return [col for col in columns for text in texts if text in col]
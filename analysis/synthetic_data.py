@@ -0,0 +1,169 @@
+"""
+synthetic_data.py
+
+Synthetic survey and telemetry files in the format of the raw inputs of process_data, at any number of respondents,
+for benchmarking the pipeline. Respondents are generated in fixed-size blocks from seeds derived from the block number,
+so files of any size are written in bounded memory and the survey and telemetry of a respondent agree.
+
+Survey outcomes and telemetry both depend on a latent productivity per respondent, so correlations and regressions
+find real effects.
+"""
+import csv
+import numpy as np
+import pandas as pd
+
+from process_data import likert_values, normalize_vars
+from survey_schema import agreement_prefix
+from variables import independent_vars, dependent_mapping, demographics_ordinal_mapping, telemetry_name_mapping, unchanged_windows
+
+block_size = 20000
+
+# Answers as worded in the survey, see survey_sanitized.md.
+dummy_answers = {
+    'Which of the following best describes what you do?': [
+        'Student, full-time or part-time', 'Professional programmer, writing code for work',
+        'Hobbyist programmer, writing code for fun or outside of work', 'Consultant/Freelancer', 'Researcher',
+        'Other, please specify'],
+    'What programming languages do you usually use? Choose up to three from the list': [
+        'Python', 'JavaScript', 'TypeScript', 'Java', 'Ruby', 'Go', 'C#', 'Rust', 'Html', 'Other, please specify'],
+}
+ordinal_answers = {
+    'language_proficiency': ['Beginner', 'Intermediate', 'Advanced'],
+    'programming_experience': [
+        'I’m a student/learning to program', '0 to 2 years professional programming experience',
+        '3 to 5 years professional programming experience', '6 to 10 years professional programming experience',
+        '11 to 15 years professional programming experience', 'More than 16 years professional programming experience'],
+}
+
+
+def _blocks(n_respondents):
+    for start in range(0, n_respondents, block_size):
+        yield start // block_size, start, min(start + block_size, n_respondents)
+
+
+def latent_productivity(block, n, seed=0):
+    """Latent productivity of the first n respondents of a block, shared by their survey and telemetry."""
+    return np.random.default_rng((seed, 0, block)).standard_normal(block_size)[:n]
+
+
+def survey_header():
+    """Two header rows of the survey, as (question, response) pairs with empty continuation questions."""
+    header = [('Respondent ID', ''), ('Start Date', ''), ('What is your GitHub username?', 'Open-Ended Response'),
+              ('copilot_trackingId', '')]
+    for question, answers in dummy_answers.items():
+        header += [(question if k == 0 else '', answer) for k, answer in enumerate(answers)]
+    for var, question in demographics_ordinal_mapping.items():
+        header += [(question if k == 0 else '', answer) for k, answer in enumerate(ordinal_answers[var])]
+    statements = [(statement, answer) for statement in dependent_mapping.values() for answer in likert_values + ['N/A']]
+    header += [(agreement_prefix if k == 0 else '', f'{statement} - {answer}') for k, (statement, answer) in enumerate(statements)]
+    return header
+
+
+def survey_block(block, start, stop, seed=0, repeat_rate=0.05, missing_rate=0.05, start_date='2022-02-10', days=30):
+    """
+    Raw survey rows of respondents start to stop, as strings in the column order of survey_header.
+
+    :param repeat_rate: Share of rows that repeat an earlier respondent of the block, for deduplication to remove.
+    :param missing_rate: Share of agreement statements answered N/A.
+    """
+    rng = np.random.default_rng((seed, 1, block))
+    n = stop - start
+    z = latent_productivity(block, n, seed)
+    respondents = np.arange(start, stop)
+    repeats = np.flatnonzero(rng.random(n) < repeat_rate)
+    repeats = repeats[repeats > 0]
+    respondents[repeats] = start + rng.integers(0, repeats)
+
+    dates = pd.Timestamp(start_date) + pd.to_timedelta(np.sort(rng.integers(0, days * 86400, n)), unit='s')
+    columns = [np.arange(start, stop).astype(str), dates.strftime('%Y-%m-%d %H:%M:%S').to_numpy(),
+               np.char.add('user', respondents.astype(str)), np.char.add('tid', respondents.astype(str))]
+    for answers in dummy_answers.values():
+        # One to three answers per respondent.
+        chosen = rng.random((n, len(answers))) < 1.5 / len(answers)
+        chosen[np.arange(n), rng.integers(0, len(answers), n)] = True
+        columns += [np.where(chosen[:, k], answer, '') for k, answer in enumerate(answers)]
+    for var, answers in ordinal_answers.items():
+        choice = np.clip(np.round((len(answers) - 1) / 2 + rng.standard_normal(n) * len(answers) / 4), 0, len(answers) - 1)
+        columns += [np.where(choice == k, answer, '') for k, answer in enumerate(answers)]
+    for _ in dependent_mapping:
+        # Answer index 0 is Strongly Agree, 4 Strongly Disagree and 5 N/A.
+        agreement = np.clip(np.round(1.5 - 0.8 * z + rng.standard_normal(n)), 0, 4)
+        agreement[rng.random(n) < missing_rate] = len(likert_values)
+        columns += [np.where(agreement == k, answer, '') for k, answer in enumerate(likert_values + ['N/A'])]
+    return columns
+
+
+def write_survey(path, n_respondents, seed=0, **kwargs):
+    """Write a raw survey TSV with the two-row header read by process_data.read_survey. See survey_block for options."""
+    header = survey_header()
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow([question for question, _ in header])
+        writer.writerow([response for _, response in header])
+        for block, start, stop in _blocks(n_respondents):
+            writer.writerows(zip(*survey_block(block, start, stop, seed, **kwargs)))
+
+
+def telemetry_block(block, start, stop, seed=0):
+    """Raw telemetry counters, as in summary_by_id.csv, of the respondents start to stop."""
+    rng = np.random.default_rng((seed, 2, block))
+    n = stop - start
+    z = latent_productivity(block, n, seed)
+    hours = np.maximum(1, np.round(rng.lognormal(3 + 0.2 * z, 0.8))).astype(np.int64)
+    issued = rng.poisson(hours * rng.uniform(5, 30, n))
+    shown = rng.binomial(issued, 0.6)
+    accepted = rng.binomial(shown, 1 / (1 + np.exp(1.4 - 0.3 * z)))
+    telemetry = {'copilot_trackingId': np.char.add('tid', np.arange(start, stop).astype(str)),
+                 'n_issued': issued, 'n_shown': shown, 'n_acc': accepted}
+    unchanged = accepted
+    for duration in unchanged_windows:
+        unchanged = rng.binomial(unchanged, 0.85)
+        telemetry[f'n_unchanged_{duration}_s'] = unchanged
+    for duration in unchanged_windows:
+        telemetry[f'n_substantially_changed_{duration}_s'] = rng.binomial(accepted - telemetry[f'n_unchanged_{duration}_s'], 0.4)
+    languages = rng.multinomial(1, [0.4, 0.2, 0.2, 0.2], size=n).astype(bool)
+    for k, counter in enumerate(['n_py', 'n_js', 'n_ts']):
+        telemetry[counter] = np.where(languages[:, k], shown, 0)
+    telemetry['sum_char'] = rng.poisson(accepted * 45)
+    telemetry['n_partial_hours'] = hours
+    return pd.DataFrame(telemetry)[['copilot_trackingId'] + [column for column in telemetry_name_mapping if column in telemetry]]
+
+
+def write_telemetry(path, n_users, seed=0):
+    """Write a telemetry CSV in the format of summary_by_id.csv for tracking ids tid0 to tid{n_users - 1}."""
+    for block, start, stop in _blocks(n_users):
+        telemetry_block(block, start, stop, seed).to_csv(path, index=False, mode='w' if block == 0 else 'a', header=block == 0)
+
+
+def predictor_names(n_predictors=None):
+    """Names of n_predictors telemetry predictors: the independent variables, then synthetic metrics beyond them."""
+    if n_predictors is None:
+        return list(independent_vars)
+    return (list(independent_vars) + [f'synthetic_metric_{i}' for i in range(max(0, n_predictors - len(independent_vars)))])[:n_predictors]
+
+
+def analysis_frame(n_respondents, n_predictors=None, seed=0):
+    """
+    Merged analysis data as process_data produces it, generated directly rather than from raw files, with
+    n_predictors predictors named by predictor_names.
+    """
+    frames = []
+    for block, start, stop in _blocks(n_respondents):
+        rng = np.random.default_rng((seed, 3, block))
+        n = stop - start
+        z = latent_productivity(block, n, seed)
+        df = normalize_vars(telemetry_block(block, start, stop, seed).rename(columns=telemetry_name_mapping))
+        for name in predictor_names(n_predictors):
+            if name not in df:
+                df[name] = 0.3 * z + rng.standard_normal(n)
+        outcomes = np.clip(np.round(3 + 0.8 * z[:, None] + rng.standard_normal((n, len(dependent_mapping)))), 1, 5)
+        for k, var in enumerate(dependent_mapping):
+            df[var] = outcomes[:, k]
+        df['aggregate_productivity'] = outcomes.mean(axis=1)
+        for question, answers in dummy_answers.items():
+            for answer in answers:
+                df[f'{question}-{answer}'] = (rng.random(n) < 1.5 / len(answers)).astype(int)
+        for var, answers in ordinal_answers.items():
+            df[var] = rng.integers(1, len(answers) + 1, n)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,193 @@
+"""
+telemetry_aggregation.py
+
+Builds the per-user telemetry summary (summary_by_id.csv) from raw completion event logs in a single streaming pass.
+
+Event logs are JSON lines or CSV files with one event per record and the fields:
+* `copilot_trackingId`: The user. Events without one are ignored.
+* `event`: 'issued', 'shown', 'accepted' or 'postInsertion'. A namespace such as 'copilot/ghostText.' is ignored.
+* `timestamp`: ISO 8601 time or epoch seconds. The hours of shown events give `n_partial_hours`.
+* `language`: Language id of the completion, e.g. 'python', for shown events.
+* `num_chars`: Number of characters of an accepted completion.
+* `seconds`: For postInsertion events, the seconds after acceptance at which the accepted completion was checked.
+    Checks at one of variables.unchanged_windows count towards that window, others are ignored.
+* `edit_fraction`: For postInsertion events, the fraction of the completion's characters changed since acceptance.
+    0 counts as unchanged, and more than `substantial_change` as substantially changed.
+
+Memory grows with the number of users and their active hours, not with the number of events.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pathlib
+
+from instrumentation import profiled
+from variables import telemetry_name_mapping, unchanged_windows
+
+languages = {
+    'n_py': ['python'],
+    'n_js': ['javascript', 'javascriptreact'],
+    'n_ts': ['typescript', 'typescriptreact'],
+}
+
+counters = (['n_issued', 'n_shown', 'n_acc']
+            + [f'n_unchanged_{duration}_s' for duration in unchanged_windows]
+            + [f'n_substantially_changed_{duration}_s' for duration in unchanged_windows]
+            + list(languages) + ['sum_char'])
+
+event_fields = ['copilot_trackingId', 'event', 'timestamp', 'language', 'num_chars', 'seconds', 'edit_fraction']
+
+
+class TelemetryAggregate:
+    """
+    Per-user event counters and active hours, accumulated over chunks of events. Aggregates of different shards can
+    be added together.
+
+    :param substantial_change: Fraction of an accepted completion's characters that must have changed for it to count
+        as substantially changed.
+    """
+
+    def __init__(self, substantial_change=0.5):
+        self.substantial_change = substantial_change
+        self.counts = pd.DataFrame(columns=counters, index=pd.Index([], dtype=object, name='copilot_trackingId'), dtype=float)
+        self.hours = pd.DataFrame({'copilot_trackingId': pd.Series(dtype=object), 'hour': pd.Series(dtype=np.int64)})
+        self._pending_counts = []
+        self._pending_hours = []
+        self._n_pending = 0
+
+    def update(self, events):
+        """Add a DataFrame of events, see the module docstring for its fields. Returns self."""
+        events = events[events['copilot_trackingId'].notna()]
+        ids = events['copilot_trackingId'].astype(str).to_numpy()
+
+        def field(name, numeric=True):
+            if name not in events:
+                return np.full(len(events), np.nan) if numeric else np.full(len(events), None, dtype=object)
+            return pd.to_numeric(events[name], errors='coerce').to_numpy(dtype=float) if numeric else events[name].to_numpy()
+
+        kind = events['event'].astype(str).str.rsplit('.', n=1).str[-1].to_numpy()
+        shown = kind == 'shown'
+        accepted = kind == 'accepted'
+        positions = {name: k for k, name in enumerate(counters)}
+        values = np.zeros((len(events), len(counters)))
+        values[:, positions['n_issued']] = kind == 'issued'
+        values[:, positions['n_shown']] = shown
+        values[:, positions['n_acc']] = accepted
+        language = pd.Series(field('language', numeric=False))
+        for counter, language_ids in languages.items():
+            values[:, positions[counter]] = shown & language.isin(language_ids).to_numpy()
+        values[:, positions['sum_char']] = np.where(accepted, np.nan_to_num(field('num_chars')), 0)
+
+        # Every check is matched to its window at once, and marks that window's unchanged and substantially changed
+        # columns, so all windows are counted in the same pass.
+        windows = np.array(unchanged_windows, dtype=float)
+        seconds = field('seconds')
+        window = np.minimum(np.searchsorted(windows, seconds), len(windows) - 1)
+        checks = np.flatnonzero((kind == 'postInsertion') & (windows[window] == seconds))
+        edit_fraction = field('edit_fraction')[checks]
+        values[checks, positions[f'n_unchanged_{unchanged_windows[0]}_s'] + window[checks]] = edit_fraction == 0
+        values[checks, positions[f'n_substantially_changed_{unchanged_windows[0]}_s'] + window[checks]] = edit_fraction > self.substantial_change
+
+        self._pending_counts.append(pd.DataFrame(values, index=ids, columns=counters).groupby(level=0, sort=False).sum())
+        timestamps = events['timestamp'][shown] if 'timestamp' in events else pd.Series(dtype=float)
+        self._pending_hours.append(pd.DataFrame({'copilot_trackingId': ids[shown], 'hour': event_hours(timestamps)}).drop_duplicates())
+        self._n_pending += len(self._pending_counts[-1]) + len(self._pending_hours[-1])
+        # Compacting only once the pending partial results outgrow the compacted ones keeps updates linear overall.
+        if self._n_pending > len(self.counts) + len(self.hours):
+            self._compact()
+        return self
+
+    def _compact(self):
+        if self._pending_counts:
+            counts = pd.concat([self.counts] + self._pending_counts)
+            self.counts = counts.groupby(level=0, sort=False).sum().rename_axis('copilot_trackingId')
+        if self._pending_hours:
+            self.hours = pd.concat([self.hours] + self._pending_hours, ignore_index=True).drop_duplicates(ignore_index=True)
+        self._pending_counts, self._pending_hours, self._n_pending = [], [], 0
+
+    def __add__(self, other):
+        if self.substantial_change != other.substantial_change:
+            raise ValueError('Aggregates must use the same substantial_change.')
+        combined = TelemetryAggregate(self.substantial_change)
+        combined._pending_counts = [self.counts, other.counts] + self._pending_counts + other._pending_counts
+        combined._pending_hours = [self.hours, other.hours] + self._pending_hours + other._pending_hours
+        combined._compact()
+        return combined
+
+    def merge(self, other):
+        """Merge another aggregate, e.g. of a different shard, into a new one."""
+        return self + other
+
+    def to_frame(self):
+        """Per-user summary with copilot_trackingId and the columns of variables.telemetry_name_mapping."""
+        self._compact()
+        summary = self.counts.astype(np.int64)
+        summary['n_partial_hours'] = self.hours.groupby('copilot_trackingId').size()
+        summary['n_partial_hours'] = summary['n_partial_hours'].fillna(0).astype(np.int64)
+        summary = summary[[column for column in telemetry_name_mapping if column in summary]]
+        return summary.sort_index().reset_index()
+
+
+def event_hours(timestamps):
+    """Hours since the epoch of ISO 8601 or epoch-second timestamps."""
+    if pd.api.types.is_numeric_dtype(timestamps):
+        return np.floor_divide(timestamps.to_numpy(dtype=float), 3600).astype(np.int64)
+    times = pd.to_datetime(timestamps, utc=True, format='ISO8601')
+    return times.dt.floor('h').to_numpy(dtype='datetime64[h]').astype(np.int64)
+
+
+def read_events(input_file, chunksize):
+    """Stream a JSON lines or CSV event log in chunks of DataFrames. Files are JSON lines unless their suffix is .csv."""
+    suffixes = pathlib.Path(input_file).suffixes
+    if '.csv' in suffixes:
+        yield from pd.read_csv(input_file, chunksize=chunksize, usecols=lambda column: column in event_fields,
+                               dtype={'copilot_trackingId': str, 'event': str, 'language': str})
+    else:
+        with pd.read_json(input_file, lines=True, chunksize=chunksize, dtype=False, convert_dates=False) as reader:
+            yield from reader
+
+
+def aggregate_file(input_file, chunksize=100000, substantial_change=0.5):
+    """Aggregate one event log shard."""
+    aggregate = TelemetryAggregate(substantial_change)
+    for chunk in read_events(input_file, chunksize):
+        aggregate.update(chunk)
+    return aggregate
+
+
+@profiled('telemetry_aggregate')
+def aggregate_events(input_files, chunksize=100000, substantial_change=0.5, n_jobs=None):
+    """
+    Per-user telemetry summary, as in summary_by_id.csv, of one or more event log shards.
+
+    :param input_files: Paths of the event logs, see the module docstring for their fields.
+    :param chunksize: Number of events held in memory at once per shard.
+    :param substantial_change: See TelemetryAggregate.
+    :param n_jobs: If set, aggregate shards in a process pool with this many workers and merge their aggregates.
+    """
+    input_files = list(input_files)
+    args = (input_files, [chunksize] * len(input_files), [substantial_change] * len(input_files))
+    if n_jobs is None or n_jobs == 1:
+        aggregates = map(aggregate_file, *args)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            aggregates = list(executor.map(aggregate_file, *args))
+    total = TelemetryAggregate(substantial_change)
+    for aggregate in aggregates:
+        total += aggregate
+    return total.to_frame()
+
+
+if __name__ == '__main__':
+    parent_dir = pathlib.Path(__file__).parent.parent.resolve()
+    parser = argparse.ArgumentParser(description='Aggregate completion event logs into the per-user telemetry summary.')
+    parser.add_argument('input_files', nargs='+', help='JSON lines or CSV event logs, one per shard.')
+    parser.add_argument('--output', default=parent_dir / 'data_telemetry/summary_by_id.csv')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--substantial-change', type=float, default=0.5)
+    parser.add_argument('--n-jobs', type=int, default=None)
+    args = parser.parse_args()
+    summary = aggregate_events(args.input_files, args.chunksize, args.substantial_change, args.n_jobs)
+    summary.to_csv(args.output, index=False)
+    print(f'Wrote telemetry summary of {len(summary)} users to {args.output}.')
@@ -0,0 +1,20 @@
+"""
+Checks of the cross-validated model comparison on synthetic analysis data.
+"""
+import warnings
+
+from sklearn.exceptions import ConvergenceWarning
+
+from cross_validation import best_models, cross_validate
+from synthetic_data import analysis_frame
+from variables import dependent_vars, demographics_dummies, demographics_ordinal, independent_vars
+
+
+def test_lasso_convergence_is_reported_not_warned():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', ConvergenceWarning)
+        scores = cross_validate(analysis_frame(1000), independent_vars + demographics_ordinal, dependent_vars[:2],
+                                demographics_dummies, lasso_max_iter=50)
+    assert not scores.loc[scores['model'] == 'lasso', 'converged'].all()
+    assert scores.loc[scores['model'] != 'lasso', 'converged'].all()
+    assert best_models(scores)['converged'].all()
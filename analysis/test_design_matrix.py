@@ -0,0 +1,31 @@
+"""
+Checks of DesignMatrix against building the same arrays from the DataFrame.
+"""
+import numpy as np
+import pandas as pd
+
+from design_matrix import DesignMatrix
+from regression import f_stat_regression, multiple_regression, process_features_targets
+from synthetic_data import analysis_frame
+from variables import dependent_vars, demographics_dummies
+
+metrics = ['accepted_per_shown', 'accepted_per_opportunity', 'accepted_char_per_active_hour', 'programming_experience']
+
+
+def test_design_matrix_matches_dataframe():
+    df = analysis_frame(400)
+    df.loc[::9, 'accepted_per_opportunity'] = None
+    design = DesignMatrix(df)
+    expected = process_features_targets(df, metrics, dependent_vars, demographics_dummies)
+    # The second call returns the cached arrays.
+    for result in (process_features_targets(design, metrics, dependent_vars, demographics_dummies),
+                   process_features_targets(design, metrics, dependent_vars, demographics_dummies)):
+        np.testing.assert_allclose(result[0], expected[0], atol=1e-10)
+        np.testing.assert_array_equal(result[1], expected[1])
+        assert result[2] == expected[2]
+    features, _, _ = process_features_targets(DesignMatrix(df, dtype=np.float32), metrics, dependent_vars, demographics_dummies)
+    np.testing.assert_allclose(features, expected[0], atol=1e-5)
+
+    pd.testing.assert_frame_equal(f_stat_regression(design, metrics, dependent_vars), f_stat_regression(df, metrics, dependent_vars))
+    pd.testing.assert_frame_equal(multiple_regression('ols', design, metrics, [], dependent_vars, demographics_dummies, verbose=False),
+                                  multiple_regression('ols', df, metrics, [], dependent_vars, demographics_dummies, verbose=False))
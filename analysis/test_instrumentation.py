@@ -0,0 +1,22 @@
+"""
+Checks that profiling is switched off and its report written however the profiled run ends.
+"""
+import json
+
+import pytest
+
+import instrumentation
+from instrumentation import profiling, stage
+
+
+def test_profiling_writes_report_when_run_fails(tmp_path):
+    with pytest.raises(RuntimeError):
+        with profiling(tmp_path / 'report.json'):
+            with stage('failing'):
+                raise RuntimeError('stage failed')
+    assert not instrumentation.enabled()
+    report = json.loads((tmp_path / 'report.json').read_text())
+    assert [entry['stage'] for entry in report['stages']] == ['failing']
+
+    with profiling(None) as profiler:
+        assert profiler is None and not instrumentation.enabled()
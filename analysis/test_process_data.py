@@ -0,0 +1,142 @@
+"""
+Checks of process_data against the original row-wise and full-run behavior, on synthetic surveys.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from process_data import (combine_survey_vars, deduplicate_responses, downcast_dtypes, likert_values, load_data, normalize_vars, process_data, process_survey,
+                          process_survey_incremental, process_telemetry, read_survey)
+from synthetic_data import analysis_frame, telemetry_block, write_survey, write_telemetry
+from variables import dependent_mapping, demographics_ordinal_mapping, independent_vars, telemetry_name_mapping, unchanged_windows
+
+deduplication_column = 'What is your GitHub username?-Open-Ended Response'
+
+
+def test_incremental_matches_full_run(tmp_path):
+    # Repeat responses in the second half of the file refer back to respondents of the first half.
+    combined_file = tmp_path / 'survey.tsv'
+    write_survey(combined_file, 3000, repeat_rate=0.2)
+    lines = combined_file.read_text().splitlines(keepends=True)
+    first_file = tmp_path / 'survey_first.tsv'
+    first_file.write_text(''.join(lines[:2 + 1500]))
+
+    process_survey_incremental(first_file, deduplication_column, tmp_path / 'state')
+    incremental = process_survey_incremental(combined_file, deduplication_column, tmp_path / 'state', refit=True)
+    full = process_survey(combined_file, deduplication_column)
+
+    incremental = incremental.drop(columns='response_hash').sort_values(by=deduplication_column).reset_index(drop=True)
+    full = full.sort_values(by=deduplication_column).reset_index(drop=True)
+    pd.testing.assert_frame_equal(incremental[full.columns], full)
+
+
+def test_deduplication_matches_row_wise_counts(tmp_path):
+    write_survey(tmp_path / 'survey.tsv', 2000, repeat_rate=0.2)
+    survey_df, _ = read_survey(tmp_path / 'survey.tsv')
+    survey_df = pd.concat([survey_df, survey_df.iloc[::50]], ignore_index=True)
+
+    # The original row-wise count and sorts, with stable sorts so ties keep the earlier response.
+    expected = survey_df.drop_duplicates()
+    unskipped_columns = [col for col in expected if not col.endswith('N/A')]
+    expected = expected.assign(n_notna=expected[unskipped_columns].apply(lambda row: sum(pd.notna(row)), axis=1))
+    expected = expected.sort_values(by='n_notna', ascending=False, kind='stable')
+    expected = expected.drop_duplicates(subset=deduplication_column, keep='first')
+
+    result, removed = deduplicate_responses(survey_df, deduplication_column)
+    pd.testing.assert_frame_equal(result.sort_index(), expected.sort_index())
+    assert removed == {'exact_duplicates': 40, 'repeat_responses': len(survey_df) - 40 - len(expected)}
+    assert result['Start Date'].is_monotonic_increasing
+
+
+def test_streamed_telemetry_matches_full_read(tmp_path):
+    write_telemetry(tmp_path / 'telemetry.csv', 1000)
+    tracking_ids = [f'tid{i}' for i in range(0, 1000, 3)] + [None]
+    expected = process_telemetry(tmp_path / 'telemetry.csv', tracking_ids=tracking_ids).reset_index(drop=True)
+    pd.testing.assert_frame_equal(process_telemetry(tmp_path / 'telemetry.csv', 97, tracking_ids), expected)
+
+    write_survey(tmp_path / 'survey.tsv', 600)
+    files = (tmp_path / 'survey.tsv', tmp_path / 'telemetry.csv')
+    expected = process_data(*files, tmp_path / 'full.csv', deduplication_column)
+    streamed = process_data(*files, tmp_path / 'streamed.csv', deduplication_column, telemetry_chunksize=97)
+    pd.testing.assert_frame_equal(streamed, expected)
+    assert (tmp_path / 'streamed.csv').read_bytes() == (tmp_path / 'full.csv').read_bytes()
+
+
+def test_process_data_computes_only_requested_metrics(tmp_path):
+    write_telemetry(tmp_path / 'telemetry.csv', 300)
+    write_survey(tmp_path / 'survey.tsv', 200)
+    files = (tmp_path / 'survey.tsv', tmp_path / 'telemetry.csv')
+    process_data(*files, tmp_path / 'all.csv', deduplication_column)
+    process_data(*files, tmp_path / 'independent.csv', deduplication_column, metrics=independent_vars)
+    assert (tmp_path / 'independent.csv').read_bytes() == (tmp_path / 'all.csv').read_bytes()
+
+    metrics = ['accepted_per_shown']
+    merged = process_data(*files, tmp_path / 'subset.csv', deduplication_column, telemetry_chunksize=97, metrics=metrics)
+    assert 'accepted_per_opportunity' not in merged
+    expected = pd.read_csv(tmp_path / 'all.csv').drop(columns=[v for v in independent_vars if v not in metrics])
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / 'subset.csv'), expected)
+
+
+def answer_blocks(rng, n, complete=False):
+    """Raw Likert and ordinal answer columns with single answers, several answers per row and unanswered rows."""
+    blocks = [[f'{text} - {answer}' for answer in likert_values + ['N/A']] for text in dependent_mapping.values()]
+    blocks += [[f'{text}-option {k}' for k in range(4)] for text in demographics_ordinal_mapping.values()]
+    columns = {}
+    for block in blocks:
+        answered = rng.random((n, len(block))) < 0.25
+        if complete:
+            # Every row answers each block, so decoded columns have no missing values.
+            answered[np.arange(n), rng.integers(0, min(len(block), 4), n)] = True
+        for k, column in enumerate(block):
+            columns[column] = np.where(answered[:, k], column.rsplit(' ', 1)[-1], None)
+    return pd.DataFrame(columns)
+
+
+def test_combine_survey_vars_engines_match():
+    rng = np.random.default_rng(0)
+    with_missing = answer_blocks(rng, 400)
+    with_missing.iloc[:20] = None
+    with_missing[f'{dependent_mapping["better_code"]} - Strongly Agree'] = np.nan
+    for df in (with_missing, answer_blocks(rng, 400, complete=True)):
+        for impute in (False, True):
+            expected = combine_survey_vars(df.copy(), impute=impute, engine='apply')
+            pd.testing.assert_frame_equal(combine_survey_vars(df.copy(), impute=impute, engine='numpy'), expected)
+
+
+def test_difference_metrics_keep_integer_dtype():
+    telemetry = telemetry_block(0, 0, 200).rename(columns=telemetry_name_mapping)
+    df = normalize_vars(telemetry)
+    for duration in unchanged_windows:
+        expected = telemetry['accepted'] - telemetry[f'substantially_changed_{duration}']
+        pd.testing.assert_series_equal(df[f'mostly_unchanged_{duration}'], expected, check_names=False)
+    assert df['accepted_per_shown'].dtype == np.float64
+
+
+def test_load_data_dtypes_match_cache(tmp_path):
+    pytest.importorskip('pyarrow')
+    data_file = tmp_path / 'merged.csv'
+    analysis_frame(300).to_csv(data_file, index=False)
+    cold = load_data(data_file)
+    pd.testing.assert_frame_equal(cold, downcast_dtypes(pd.read_csv(data_file)))
+    pd.testing.assert_frame_equal(load_data(data_file), cold)
+    # Touching the file changes its key, but the cache is found again by the hash of its contents.
+    cache_files = list(tmp_path.glob('merged.*.feather'))
+    stat = data_file.stat()
+    os.utime(data_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    pd.testing.assert_frame_equal(load_data(data_file), cold)
+    assert len(list(tmp_path.glob('merged.*.feather'))) == 1 and not cache_files[0].exists()
+
+
+def test_process_data_cache_matches_csv(tmp_path):
+    pytest.importorskip('pyarrow')
+    write_survey(tmp_path / 'survey.tsv', 300)
+    write_telemetry(tmp_path / 'telemetry.csv', 300)
+    process_data(tmp_path / 'survey.tsv', tmp_path / 'telemetry.csv', tmp_path / 'merged.csv', deduplication_column)
+    # The cache written by process_data holds what parsing the CSV gives, as does the cache of a cold load.
+    cached = load_data(tmp_path / 'merged.csv')
+    pd.testing.assert_frame_equal(cached, downcast_dtypes(pd.read_csv(tmp_path / 'merged.csv')))
+    for cache_file in tmp_path.glob('merged.*.feather'):
+        cache_file.unlink()
+    pd.testing.assert_frame_equal(load_data(tmp_path / 'merged.csv'), cached)
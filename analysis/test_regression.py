@@ -0,0 +1,78 @@
+"""
+Checks of the numpy engines of regression against statsmodels, on synthetic analysis data.
+"""
+import pandas as pd
+import pytest
+
+from design_matrix import DesignMatrix
+from regression import f_stat_regression, multiple_regression, multiple_regression_single_pred, residual_significance, rsquared_contribution
+from synthetic_data import analysis_frame
+from variables import dependent_vars, demographics_dummies
+
+metrics = ['accepted_per_shown', 'accepted_per_opportunity', 'accepted_char_per_active_hour']
+
+
+def test_f_stat_regression_matches_sklearn():
+    df = analysis_frame(400)
+    # Ratios with a zero denominator are missing, so pairs have different numbers of rows.
+    df.loc[::7, 'accepted_per_shown'] = None
+    expected = f_stat_regression(df, metrics, dependent_vars, engine='sklearn')
+    pd.testing.assert_frame_equal(f_stat_regression(df, metrics, dependent_vars), expected, atol=1e-4)
+
+
+def sorted_pairs(df):
+    return df.sort_values(by=['independent', 'dependent']).reset_index(drop=True)
+
+
+def test_rsquared_contribution_matches_statsmodels():
+    df = analysis_frame(400)
+    full = multiple_regression('ols', df, metrics, [], dependent_vars, demographics_dummies, verbose=False)
+    full_rsquared = full[['dependent', 'ols_model_rsquared', 'ols_model_rsquared_adj']].drop_duplicates()
+    args = (full_rsquared, df, metrics, dependent_vars, demographics_dummies)
+    expected = rsquared_contribution(*args, verbose=False, engine='statsmodels')
+    pd.testing.assert_frame_equal(sorted_pairs(rsquared_contribution(*args, verbose=False)), sorted_pairs(expected), atol=1e-4)
+
+
+def test_multiple_regression_ols_matches_statsmodels():
+    df = analysis_frame(400)
+    args = ('ols', df, metrics, ['programming_experience'], dependent_vars, demographics_dummies)
+    expected = multiple_regression(*args, verbose=False, engine='statsmodels')
+    pd.testing.assert_frame_equal(sorted_pairs(multiple_regression(*args, verbose=False)), sorted_pairs(expected), atol=1e-4)
+
+
+@pytest.mark.parametrize('design_matrix', [False, True])
+def test_single_pred_ols_matches_statsmodels(design_matrix):
+    df = analysis_frame(600)
+    data = DesignMatrix(df) if design_matrix else df
+    args = ('ols', data, metrics, ['programming_experience'], dependent_vars[:2], demographics_dummies)
+    expected = multiple_regression_single_pred(*args, verbose=False, engine='statsmodels')
+    result = multiple_regression_single_pred(*args, verbose=False, engine='numpy')
+    pd.testing.assert_frame_equal(sorted_pairs(result), sorted_pairs(expected), atol=1e-4)
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'statsmodels'])
+def test_single_pred_rejects_controls_among_predictors(engine):
+    with pytest.raises(ValueError, match='accepted_per_shown'):
+        multiple_regression_single_pred('ols', analysis_frame(100), metrics, ['accepted_per_shown'], dependent_vars[:1],
+                                        demographics_dummies, verbose=False, engine=engine)
+
+
+def test_single_pred_ordinal_skips_outcomes_with_one_category():
+    df = analysis_frame(300)
+    args = ('ordinal', df, metrics, [], dependent_vars[:2], demographics_dummies)
+    expected = multiple_regression_single_pred(*args, verbose=False)
+    df[dependent_vars[1]] = 3.0
+    result = multiple_regression_single_pred(*args, verbose=False)
+    constant = result['dependent'] == dependent_vars[1]
+    assert result.loc[constant, 'ordinal_coefficient'].isna().all() and not result.loc[constant, 'ordinal_converged'].any()
+    pd.testing.assert_frame_equal(result[~constant], expected[expected['dependent'] == dependent_vars[0]])
+
+
+def test_residual_significance_matches_statsmodels():
+    df = analysis_frame(300)
+    args = (df, metrics + ['accepted_per_active_hour'], [], 'aggregate_productivity', [])
+    expected = residual_significance(*args, levels=2, engine='statsmodels')
+    sort = ['n_predictors', 'baseline', 'independent']
+    for result in (residual_significance(*args, levels=2), residual_significance(*args, levels=2, n_jobs=2)):
+        pd.testing.assert_frame_equal(result.astype({'baseline': str}).sort_values(by=sort).reset_index(drop=True),
+                                      expected.astype({'baseline': str}).sort_values(by=sort).reset_index(drop=True), atol=1e-4)
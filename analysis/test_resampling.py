@@ -0,0 +1,53 @@
+"""
+Checks of the bootstrap intervals and permutation tests against statistics recomputed for every resample.
+"""
+import numpy as np
+
+import resampling
+from regression import f_stat_regression, multiple_regression, pairwise_correlation
+from resampling import (bootstrap_correlation, bootstrap_indices, bootstrap_ols, percentile_interval, permutation_correlation,
+                        permutation_indices, replicate_seeds)
+from synthetic_data import analysis_frame
+from variables import dependent_vars
+
+metrics = ['accepted_per_shown', 'accepted_per_opportunity', 'accepted_char_per_active_hour']
+
+
+def test_permutation_correlation_matches_pairwise(monkeypatch):
+    df = analysis_frame(500)
+    rng = np.random.default_rng(0)
+    for column in metrics[:2] + dependent_vars[:1]:
+        df.loc[rng.random(len(df)) < 0.1, column] = np.nan
+    # Small blocks split every chunk into several batches of permutations.
+    monkeypatch.setattr(resampling, 'permutation_block_size', 5000)
+    result = permutation_correlation(df, metrics, dependent_vars, 200, seed=0, chunk_size=30)
+
+    x, y = df[metrics].to_numpy(dtype=float), df[dependent_vars].to_numpy(dtype=float)
+    observed = np.abs(np.nan_to_num(pairwise_correlation(x, y)[0].T, nan=0.0))
+    indices = permutation_indices(replicate_seeds(200, 0), len(df))
+    corrs = np.abs(np.nan_to_num(np.stack([pairwise_correlation(x, y[rows])[0].T for rows in indices]), nan=0.0))
+    exceed = (corrs >= observed - 1e-12).sum(axis=0)
+    np.testing.assert_allclose(result['corr_perm_p_value'], ((exceed + 1) / 201).ravel().round(4))
+    assert (result['n_permutations'] == 200).all()
+
+
+def test_bootstrap_matches_refitting_each_sample():
+    df = analysis_frame(300)
+    indices = bootstrap_indices(replicate_seeds(40, 0), len(df))
+    correlations = np.stack([f_stat_regression(df.iloc[rows], metrics, dependent_vars[:2], engine='sklearn')['corr_coef'] for rows in indices])
+    result = bootstrap_correlation(df, metrics, dependent_vars[:2], 40, seed=0, chunk_size=15)
+    lower, upper = percentile_interval(correlations)
+    np.testing.assert_allclose(result['corr_coef_ci_lower'], lower, atol=1e-3)
+    np.testing.assert_allclose(result['corr_coef_ci_upper'], upper, atol=1e-3)
+
+    # Rows with missing values are dropped before resampling, as in multiple_regression.
+    complete = df[metrics + dependent_vars].dropna()
+    indices = bootstrap_indices(replicate_seeds(40, 0), len(complete))
+    fits = [multiple_regression('ols', complete.iloc[rows], metrics, [], dependent_vars, [], verbose=False, engine='statsmodels')
+            .set_index(['dependent', 'independent']).loc[[(d, i) for d in dependent_vars for i in metrics]] for rows in indices]
+    result = bootstrap_ols(df, metrics, [], dependent_vars, [], n_replicates=40, seed=0, n_jobs=2)
+    lower, upper = percentile_interval(np.stack([fit['ols_coefficient'] for fit in fits]))
+    np.testing.assert_allclose(result['ols_coefficient_ci_lower'], lower, atol=1e-3)
+    np.testing.assert_allclose(result['ols_coefficient_ci_upper'], upper, atol=1e-3)
+    lower, upper = percentile_interval(np.stack([fit['ols_model_rsquared'] for fit in fits]))
+    np.testing.assert_allclose(result['ols_model_rsquared_ci_lower'], lower, atol=1e-3)
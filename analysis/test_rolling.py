@@ -0,0 +1,45 @@
+"""
+Checks of the rolling window analysis against direct selections of each window's rows.
+"""
+import numpy as np
+import pandas as pd
+
+from regression import f_stat_regression, multiple_regression
+from rolling import rolling_analysis, window_rows
+from synthetic_data import analysis_frame
+from variables import demographics_dummies
+
+metrics = ['accepted_per_shown', 'accepted_per_opportunity', 'accepted_char_per_active_hour']
+
+
+def dated_frame(n):
+    df = analysis_frame(n)
+    # Whole days, so several responses share the earliest date.
+    df['Start Date'] = pd.Timestamp('2022-02-10') + pd.to_timedelta(np.random.default_rng(0).integers(0, 60, n), unit='D')
+    return df
+
+
+def test_first_window_matches_mask():
+    dates = np.sort(dated_frame(500)['Start Date'].to_numpy())
+    for expanding in (False, True):
+        start, end, first, last = window_rows(dates, '30D', '7D', expanding)[0]
+        in_window = (dates >= np.datetime64(start)) & (dates < np.datetime64(end))
+        assert (dates == dates[0]).sum() > 1 and in_window[0]
+        np.testing.assert_array_equal(np.arange(first, last), np.flatnonzero(in_window))
+    windows = window_rows(dates, '30D', '7D')
+    assert windows[-1][3] == len(dates)
+
+
+def test_rolling_matches_window_regressions():
+    df = dated_frame(1500)
+    result = rolling_analysis(df, metrics, [], 'aggregate_productivity', demographics_dummies)
+    for start, end in result[['window_start', 'window_end']].drop_duplicates().to_numpy()[[0, -1]]:
+        rows = df[(df['Start Date'] >= start) & (df['Start Date'] < end)]
+        window = result[result['window_start'] == start].reset_index(drop=True)
+        assert (window['n_window'] == len(rows)).all()
+        correlations = f_stat_regression(rows, metrics, ['aggregate_productivity'])
+        ols = multiple_regression('ols', rows, metrics, [], ['aggregate_productivity'], demographics_dummies, verbose=False)
+        ols = ols.set_index('independent').loc[metrics].reset_index()
+        np.testing.assert_allclose(window['corr_coef'], correlations['corr_coef'], atol=1e-4)
+        np.testing.assert_allclose(window['ols_coefficient'], ols['ols_coefficient'], atol=1e-4)
+        np.testing.assert_allclose(window['ols_model_rsquared'], ols['ols_model_rsquared'], atol=1e-4)
@@ -0,0 +1,30 @@
+"""
+Checks of the segmented analysis against running the regressions on each segment's rows.
+"""
+import pandas as pd
+
+from regression import f_stat_regression, multiple_regression
+from resampling import merge_pairs
+from segments import segment_analysis
+from synthetic_data import analysis_frame
+from variables import dependent_vars, demographics_dummies
+
+metrics = ['accepted_per_shown', 'accepted_per_opportunity', 'accepted_char_per_active_hour']
+
+
+def test_segments_match_direct_regressions():
+    df = analysis_frame(600)
+    for n_jobs in (None, 2):
+        result = segment_analysis(df, metrics, [], dependent_vars[:2], demographics_dummies, min_size=50, n_jobs=n_jobs)
+        labels = result['segment'].unique()
+        assert 'language_proficiency=1' in labels and any('Python' in label for label in labels)
+        for label in labels:
+            var, _, value = label.partition('=')
+            rows = df[df[var] == (float(value) if value else 1)]
+            expected = merge_pairs(
+                multiple_regression('ols', rows, metrics, [], dependent_vars[:2], demographics_dummies, verbose=False),
+                f_stat_regression(rows, metrics, dependent_vars[:2]))
+            segment = result[result['segment'] == label]
+            assert (segment['segment_size'] == len(rows)).all()
+            pd.testing.assert_frame_equal(segment.drop(columns=['segment', 'segment_size']).reset_index(drop=True),
+                                          expected.reset_index(drop=True), atol=1e-4)
@@ -0,0 +1,33 @@
+"""
+Checks of regressions solved from SufficientStats against the same regressions on the rows.
+"""
+import numpy as np
+import pandas as pd
+
+from regression import f_stat_regression, get_dummies, multiple_regression, rsquared_contribution
+from sufficient_stats import SufficientStats, accumulate
+from synthetic_data import analysis_frame
+from variables import dependent_vars, demographics_dummies
+
+metrics = ['accepted_per_shown', 'accepted_per_opportunity', 'accepted_char_per_active_hour']
+
+
+def test_sufficient_stats_match_rows(tmp_path):
+    df = analysis_frame(600)
+    df.loc[::11, 'accepted_per_opportunity'] = None
+    columns = metrics + dependent_vars + get_dummies(df, demographics_dummies)
+    shift = np.nan_to_num(df[columns].mean().to_numpy())
+    # Shards accumulated separately, saved and loaded, then merged, with rows added and removed again.
+    first = accumulate([df.iloc[:200], df.iloc[200:350]], columns, shift=shift)
+    first.save(tmp_path / 'first.npz')
+    extra = SufficientStats(columns, shift=shift).update(df.iloc[:50])
+    stats = SufficientStats.load(tmp_path / 'first.npz') + accumulate([df.iloc[350:], df.iloc[:50]], columns, shift=shift) - extra
+
+    pd.testing.assert_frame_equal(f_stat_regression(stats, metrics, dependent_vars), f_stat_regression(df, metrics, dependent_vars))
+    ols = multiple_regression('ols', df, metrics, [], dependent_vars, demographics_dummies, verbose=False)
+    pd.testing.assert_frame_equal(multiple_regression('ols', stats, metrics, [], dependent_vars, demographics_dummies, verbose=False),
+                                  ols, atol=1e-4)
+    full_rsquared = ols[['dependent', 'ols_model_rsquared', 'ols_model_rsquared_adj']].drop_duplicates()
+    pd.testing.assert_frame_equal(
+        rsquared_contribution(full_rsquared, stats, metrics, dependent_vars, demographics_dummies, verbose=False),
+        rsquared_contribution(full_rsquared, df, metrics, dependent_vars, demographics_dummies, verbose=False), atol=1e-4)
@@ -0,0 +1,38 @@
+"""
+Checks of the compiled survey header against flattening it column by column.
+"""
+import pandas as pd
+
+from survey_schema import compile_header, matching_columns, schema_for_columns
+from synthetic_data import write_survey
+from variables import demographics_dummies, demographics_ordinal_mapping
+
+
+def flatten_header(header):
+    """The original loop over the two header rows."""
+    last_question = None
+    columns = []
+    for question, response in header:
+        question = question.replace(
+            'Thinking of your experience using Copilot so far, please indicate your level of agreement with the following statements.', '')
+        if 'Unnamed:' not in question:
+            last_question = question
+        response = '' if 'Unnamed:' in response else response
+        if last_question and response:
+            columns.append(f'{last_question}-{response}')
+        elif last_question:
+            columns.append(last_question)
+        else:
+            columns.append(response)
+    return columns
+
+
+def test_compiled_header_matches_column_scan(tmp_path):
+    write_survey(tmp_path / 'survey.tsv', 10)
+    header = tuple(pd.read_csv(tmp_path / 'survey.tsv', sep='\t', header=[0, 1]).columns)
+    columns = flatten_header(header)
+    for schema in (compile_header(header), schema_for_columns(tuple(columns))):
+        assert schema.columns == columns
+        for text in demographics_dummies + list(demographics_ordinal_mapping.values()):
+            assert schema.answer_columns(text) == [col for col in columns if text in col]
+    assert matching_columns(columns, demographics_dummies) == [col for col in columns for var in demographics_dummies if var in col]
@@ -0,0 +1,60 @@
+"""
+Checks of the streaming event aggregation against counting the events one by one.
+"""
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from telemetry_aggregation import aggregate_events, counters, languages
+from variables import unchanged_windows
+
+
+def random_events(rng, n):
+    return pd.DataFrame({
+        'copilot_trackingId': rng.choice(['u1', 'u2', 'u3', 'u4', None], n),
+        'event': rng.choice(['issued', 'copilot/ghostText.shown', 'shown', 'accepted', 'postInsertion'], n),
+        'timestamp': (pd.Timestamp('2022-02-10', tz='UTC') + pd.to_timedelta(rng.integers(0, 3 * 86400, n), unit='s'))
+        .strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'language': rng.choice(['python', 'typescriptreact', 'go'], n),
+        'num_chars': rng.integers(1, 100, n),
+        'seconds': rng.choice(unchanged_windows + [45], n),
+        'edit_fraction': rng.choice([0.0, 0.2, 0.8], n)})
+
+
+def count_events(events, substantial_change=0.5):
+    """Per-user counters from a loop over the events."""
+    counts = defaultdict(lambda: dict.fromkeys(counters, 0))
+    hours = defaultdict(set)
+    for event in events.itertuples(index=False):
+        if pd.isna(event.copilot_trackingId):
+            continue
+        user, kind = counts[event.copilot_trackingId], event.event.rsplit('.', 1)[-1]
+        if kind == 'issued':
+            user['n_issued'] += 1
+        elif kind == 'shown':
+            user['n_shown'] += 1
+            hours[event.copilot_trackingId].add(event.timestamp[:13])
+            for counter, language_ids in languages.items():
+                user[counter] += event.language in language_ids
+        elif kind == 'accepted':
+            user['n_acc'] += 1
+            user['sum_char'] += event.num_chars
+        elif event.seconds in unchanged_windows:
+            user[f'n_unchanged_{event.seconds}_s'] += event.edit_fraction == 0
+            user[f'n_substantially_changed_{event.seconds}_s'] += event.edit_fraction > substantial_change
+    summary = pd.DataFrame.from_dict(counts, orient='index').astype(np.int64)
+    summary['n_partial_hours'] = [len(hours[user]) for user in summary.index]
+    return summary.sort_index()
+
+
+def test_aggregation_matches_event_loop(tmp_path):
+    rng = np.random.default_rng(0)
+    shards = [random_events(rng, 3000), random_events(rng, 2000)]
+    shards[0].to_csv(tmp_path / 'events.csv', index=False)
+    shards[1].to_json(tmp_path / 'events.jsonl', orient='records', lines=True)
+    expected = count_events(pd.concat(shards, ignore_index=True))
+    for n_jobs in (None, 2):
+        summary = aggregate_events([tmp_path / 'events.csv', tmp_path / 'events.jsonl'], chunksize=700, n_jobs=n_jobs)
+        summary = summary.set_index('copilot_trackingId').rename_axis(None)
+        pd.testing.assert_frame_equal(summary, expected[summary.columns])
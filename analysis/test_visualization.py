@@ -0,0 +1,47 @@
+"""
+Checks of the indexed incremental graph against filtering the results for the children of every node.
+"""
+import pandas as pd
+import pytest
+
+from regression import residual_significance
+from synthetic_data import analysis_frame
+
+pytest.importorskip('pyvis')
+from visualization import incremental_graph  # noqa: E402
+
+
+def scan_graph(results_df, max_levels, max_children_per_node=None, root=None):
+    """Nodes and edges of the original graph construction, which scanned every row for the children of each node."""
+    results_df = results_df.assign(id=results_df.index, parent_id=None)
+    top_nodes = results_df[results_df['n_predictors'] == 1].sort_values(by='ssr', kind='stable')
+    if root is None:
+        if max_children_per_node is not None:
+            top_nodes = top_nodes.head(max_children_per_node)
+    else:
+        top_nodes = top_nodes[top_nodes['independent'] == root]
+    nodes, edges = set(), set()
+    to_add = top_nodes.to_dict(orient='records')
+    while to_add:
+        node = to_add.pop()
+        nodes.add(node['id'])
+        if node['parent_id'] is not None:
+            edges.add((node['parent_id'], node['id']))
+        if node['n_predictors'] < max_levels:
+            separator = '' if node['baseline'] == '[]' else ', '
+            children = results_df[results_df['baseline'] == node['baseline'].replace(']', f"{separator}'{node['independent']}']")]
+            children = children.sort_values(by='ssr', kind='stable')
+            children = children.head(max_children_per_node) if max_children_per_node else children[children['p-value'] < 0.05]
+            to_add += children.assign(parent_id=node['id']).to_dict(orient='records')
+    return nodes, edges
+
+
+def test_incremental_graph_matches_scan(tmp_path):
+    metrics = ['accepted_per_shown', 'accepted_per_opportunity', 'accepted_char_per_active_hour', 'accepted_per_active_hour']
+    residual_significance(analysis_frame(300), metrics, [], 'aggregate_productivity', [], levels=3).to_csv(tmp_path / 'residuals.csv')
+    results_df = pd.read_csv(tmp_path / 'residuals.csv')
+    for options in ({'max_levels': 3}, {'max_levels': 3, 'max_children_per_node': 2}, {'max_levels': 3, 'max_children_per_node': 2, 'root': metrics[1]}):
+        nodes, edges = incremental_graph(results_df, **options)
+        expected_nodes, expected_edges = scan_graph(results_df, **options)
+        assert len(nodes) == len(expected_nodes) and {node_id for node_id, _ in nodes} == expected_nodes
+        assert len(edges) == len(expected_edges) and set(edges) == expected_edges
@@ -0,0 +1,23 @@
+"""
+Checks that tasks see the shared state in a pool and in this process, and that local state is restored after use.
+"""
+import pytest
+
+import worker_pool
+
+
+def shared_value(key):
+    return worker_pool.shared_state[key]
+
+
+def test_tasks_see_shared_state():
+    with worker_pool.executor({'value': 3}, n_jobs=2) as executor:
+        assert list(executor.map(shared_value, ['value'] * 4)) == [3] * 4
+
+    with worker_pool.local_state({'value': 1}):
+        with pytest.raises(RuntimeError):
+            with worker_pool.local_state({'value': 2}):
+                assert shared_value('value') == 2
+                raise RuntimeError('task failed')
+        assert shared_value('value') == 1
+    assert worker_pool.shared_state == {}
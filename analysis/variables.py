@@ -7,18 +7,15 @@ We are seeking to understand what behaviors correlate with and explain subjectiv
 of how useful synthesized code is to developers using Copilot.
 """
 
+# Time windows after acceptance at which accepted completions are checked for changes.
+unchanged_windows = [30, 120, 300, 600]
+
 telemetry_name_mapping = {
     "n_issued": "opportunity",
     "n_shown": "shown",
     "n_acc": "accepted",
-    "n_unchanged_30_s": "unchanged_30",
-    "n_unchanged_120_s": "unchanged_120",
-    "n_unchanged_300_s": "unchanged_300",
-    "n_unchanged_600_s": "unchanged_600",
-    "n_substantially_changed_30_s": "substantially_changed_30",
-    "n_substantially_changed_120_s": "substantially_changed_120",
-    "n_substantially_changed_300_s": "substantially_changed_300",
-    "n_substantially_changed_600_s": "substantially_changed_600",
+    **{f"n_unchanged_{duration}_s": f"unchanged_{duration}" for duration in unchanged_windows},
+    **{f"n_substantially_changed_{duration}_s": f"substantially_changed_{duration}" for duration in unchanged_windows},
     "n_py": "py",
     "n_js": "js",
     "n_ts": "ts",
@@ -26,6 +23,24 @@ telemetry_name_mapping = {
     "n_partial_hours": "active_hour",
 }
 
+# Registry of telemetry metrics derived in process_data.normalize_vars, as name: (numerator, denominator, derivation).
+# A 'difference' is numerator - denominator, a 'ratio' is numerator / denominator and missing where the denominator is zero.
+# Metrics may be derived from earlier entries of the registry.
+normalizing_events = ['active_hour', 'opportunity', 'shown', 'accepted']
+
+derived_metrics = {
+    f'mostly_unchanged_{duration}': ('accepted', f'substantially_changed_{duration}', 'difference')
+    for duration in unchanged_windows
+}
+for i, denominator in enumerate(normalizing_events[:-1]):
+    for numerator in normalizing_events[i + 1:]:
+        derived_metrics[f'{numerator}_per_{denominator}'] = (numerator, denominator, 'ratio')
+for numerator in (['accepted_char']
+                  + [f'mostly_unchanged_{duration}' for duration in unchanged_windows]
+                  + [f'unchanged_{duration}' for duration in unchanged_windows]):
+    for denominator in normalizing_events:
+        derived_metrics[f'{numerator}_per_{denominator}'] = (numerator, denominator, 'ratio')
+
 telemetry_vars = [
     'n_issued'
     'n_shown',
@@ -46,61 +61,11 @@ telemetry_vars = [
     'n_partial_hours'
 ]
 
-independent_vars = ['opportunity', 
-                    'shown', 
-                    'accepted',
-                    'unchanged_30', 
-                    'unchanged_120', 
-                    'unchanged_300', 
-                    'unchanged_600',
-                    'accepted_char', 
-                    'active_hour', 
-                    'mostly_unchanged_30',
-                    'mostly_unchanged_120', 
-                    'mostly_unchanged_300', 
-                    'mostly_unchanged_600',
-                    'opportunity_per_active_hour', 
-                    'shown_per_active_hour',
-                    'accepted_per_active_hour',
-                    'shown_per_opportunity', 
-                    'accepted_per_opportunity', 
-                    'accepted_per_shown',
-                    'accepted_char_per_active_hour', 
-                    'accepted_char_per_opportunity',
-                    'accepted_char_per_shown', 
-                    'accepted_char_per_accepted',
-                    'mostly_unchanged_30_per_active_hour',
-                    'mostly_unchanged_30_per_opportunity', 
-                    'mostly_unchanged_30_per_shown',
-                    'mostly_unchanged_30_per_accepted',
-                    'mostly_unchanged_120_per_active_hour',
-                    'mostly_unchanged_120_per_opportunity',
-                    'mostly_unchanged_120_per_shown', 
-                    'mostly_unchanged_120_per_accepted',
-                    'mostly_unchanged_300_per_active_hour',
-                    'mostly_unchanged_300_per_opportunity',
-                    'mostly_unchanged_300_per_shown', 
-                    'mostly_unchanged_300_per_accepted',
-                    'mostly_unchanged_600_per_active_hour',
-                    'mostly_unchanged_600_per_opportunity',
-                    'mostly_unchanged_600_per_shown', 
-                    'mostly_unchanged_600_per_accepted',
-                    'unchanged_30_per_active_hour', 
-                    'unchanged_30_per_opportunity',
-                    'unchanged_30_per_shown', 
-                    'unchanged_30_per_accepted',
-                    'unchanged_120_per_active_hour', 
-                    'unchanged_120_per_opportunity',
-                    'unchanged_120_per_shown', 
-                    'unchanged_120_per_accepted',
-                    'unchanged_300_per_active_hour', 
-                    'unchanged_300_per_opportunity',
-                    'unchanged_300_per_shown', 
-                    'unchanged_300_per_accepted',
-                    'unchanged_600_per_active_hour', 
-                    'unchanged_600_per_opportunity',
-                    'unchanged_600_per_shown', 
-                    'unchanged_600_per_accepted']
+independent_vars = (['opportunity', 'shown', 'accepted']
+                    + [f'unchanged_{duration}' for duration in unchanged_windows]
+                    + ['accepted_char', 'active_hour']
+                    + [name for name, (_, _, derivation) in derived_metrics.items() if derivation == 'difference']
+                    + [name for name, (_, _, derivation) in derived_metrics.items() if derivation == 'ratio'])
 
 demographics_dummies = [
     'Which of the following best describes what you do?',
@@ -1,51 +1,99 @@
+import ast
+import numpy as np
 import pandas as pd
 from pyvis.network import Network
 
 
-def visualize_incremental_graph(results_file, output_file, max_levels=2, max_children_per_node=None, root=None):
+def children_index(results_df):
     """
-    Reads in the output of regression.residual_significance to construct a graph visualization
-    of the relationship between each incremental predictor.
+    Index of the nodes in the output of regression.residual_significance by their parent.
+
+    A node's parent is the node fit with its baseline predictors, so the children of the node with baseline b and
+    predictor p are the nodes with baseline b + [p]. Baselines are parsed once into tuples.
+
+    :return: Dict mapping a tuple of predictors to the positional indices of the nodes with that baseline, sorted by ssr.
     """
-    results_df = pd.read_csv(results_file)
-    results_df['label'] = (
+    parsed = {baseline: tuple(ast.literal_eval(baseline)) for baseline in results_df['baseline'].unique()}
+    baselines = results_df['baseline'].map(parsed)
+    order = np.argsort(results_df['ssr'].to_numpy(), kind='stable')
+    groups = pd.Series(order).groupby(baselines.to_numpy()[order], sort=False)
+    return {baseline: positions.to_numpy() for baseline, positions in groups}
+
+
+def incremental_graph(results_df, max_levels=2, max_children_per_node=None, root=None, max_nodes=None):
+    """
+    Nodes and edges of the incremental predictor graph, expanded depth first from the top-level nodes.
+
+    :param max_children_per_node: If set, expand the lowest-ssr children of each node, else its children with p < 0.05.
+    :param root: If set, only expand from the top-level node of this predictor.
+    :param max_nodes: If set, stop adding nodes after this many and summarize the children left out of each node in a
+        single '+N more' node.
+    :return: Lists of nodes as (id, label) and edges as (parent id, child id). Node ids are the rows of results_df,
+        and summary nodes have string ids.
+    """
+    index = children_index(results_df)
+    labels = (
         results_df['independent']
         + '\np-value = '
         + results_df['p-value'].round(2).astype('str')
         + '\ncoef = '
         + results_df['coefficient'].round(2).astype('str')
         + '\nssr = '
-        + results_df['ssr'].round(2).astype('str'))
-    results_df['id'] = results_df.index
-    results_df['parent_id'] = None
-
-    g = Network(layout='hierarchical', height=1200, width=1800, directed=True)
+        + results_df['ssr'].round(2).astype('str')).to_numpy()
+    ids = results_df.index.tolist()
+    independent = results_df['independent'].to_numpy()
+    n_predictors = results_df['n_predictors'].to_numpy()
+    significant = results_df['p-value'].to_numpy() < 0.05
 
-    top_nodes = results_df[results_df['n_predictors'] == 1].sort_values(by='ssr')
+    top_nodes = index.get((), np.array([], dtype=int))
+    top_nodes = top_nodes[n_predictors[top_nodes] == 1]
     if root is None:
         if max_children_per_node is not None:
-            top_nodes = top_nodes.head(max_children_per_node)
+            top_nodes = top_nodes[:max_children_per_node]
     else:
-        top_nodes = top_nodes[top_nodes['independent'] == root]
-    to_add = top_nodes.to_dict(orient="records")
+        top_nodes = top_nodes[independent[top_nodes] == root]
+
+    nodes, edges = [], []
+    hidden = {}
+    # Stack of (position, parent id, predictors including the node's own), popped last in first out.
+    to_add = [(position, None, (independent[position],)) for position in top_nodes]
     while to_add:
-        node = to_add.pop()
-        g.add_node(node['id'], label=node['label'])
-        if node['parent_id'] is not None:
-            g.add_edge(node['parent_id'], node['id'])
-        if node['n_predictors'] < max_levels:
-            if node['baseline'] == '[]':
-                children = results_df[results_df['baseline'] == node['baseline'].replace(
-                    ']', f"'{node['independent']}']")].sort_values(by='ssr')
-            else:
-                children = results_df[results_df['baseline'] == node['baseline'].replace(
-                    ']', f", '{node['independent']}']")].sort_values(by='ssr')
+        position, parent_id, predictors = to_add.pop()
+        if max_nodes is not None and len(nodes) >= max_nodes:
+            hidden[parent_id] = hidden.get(parent_id, 0) + 1
+            continue
+        nodes.append((ids[position], labels[position]))
+        if parent_id is not None:
+            edges.append((parent_id, ids[position]))
+        if n_predictors[position] < max_levels:
+            children = index.get(predictors, np.array([], dtype=int))
             if max_children_per_node:
-                children = children.head(max_children_per_node)
+                children = children[:max_children_per_node]
             else:
-                children = children[children['p-value'] < 0.05]
-            children['parent_id'] = node['id']
-            to_add += children.to_dict(orient="records")
+                children = children[significant[children]]
+            to_add += [(child, ids[position], predictors + (independent[child],)) for child in children]
+
+    for parent_id, n_hidden in hidden.items():
+        summary_id = f'more_{parent_id}'
+        nodes.append((summary_id, f'+{n_hidden} more'))
+        if parent_id is not None:
+            edges.append((parent_id, summary_id))
+    return nodes, edges
+
+
+def visualize_incremental_graph(results_file, output_file, max_levels=2, max_children_per_node=None, root=None, max_nodes=None):
+    """
+    Reads in the output of regression.residual_significance to construct a graph visualization
+    of the relationship between each incremental predictor. See incremental_graph for the options.
+    """
+    results_df = pd.read_csv(results_file)
+    nodes, edges = incremental_graph(results_df, max_levels, max_children_per_node, root, max_nodes)
+
+    g = Network(layout='hierarchical', height=1200, width=1800, directed=True)
+    for node_id, label in nodes:
+        g.add_node(node_id, label=label)
+    for parent_id, node_id in edges:
+        g.add_edge(parent_id, node_id)
 
     g.show(output_file)
 
@@ -0,0 +1,32 @@
+"""
+worker_pool.py
+
+State shared by every task of an analysis, such as the data and settings, sent to each worker process once instead
+of with every task. Task functions read it from `shared_state`, whether they run in a pool or in this process.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+
+shared_state = {}
+
+
+def set_shared_state(state):
+    """Process pool initializer that receives the state shared by every task once per process."""
+    shared_state.clear()
+    shared_state.update(state)
+
+
+@contextlib.contextmanager
+def local_state(state):
+    """Context manager setting the shared state for tasks run in this process, and restoring the previous state after."""
+    previous = dict(shared_state)
+    set_shared_state(state)
+    try:
+        yield shared_state
+    finally:
+        set_shared_state(previous)
+
+
+def executor(state, n_jobs):
+    """Process pool of n_jobs workers whose tasks see the given shared state."""
+    return ProcessPoolExecutor(max_workers=n_jobs, initializer=set_shared_state, initargs=(state,))